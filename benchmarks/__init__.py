@@ -0,0 +1,8 @@
+# encoding: utf-8
+
+'''
+Benchmarks for ckanext-discovery.
+
+The benchmarks are not part of the test suite. See the "Development"
+section of the README for how to run them.
+'''
@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+'''
+Synthetic search corpora.
+
+Real search logs follow a Zipf distribution: a few terms are used very
+often while most terms are used rarely. ``ZipfCorpus`` generates
+vocabularies and search queries with that property, so that benchmarks
+can be run at different scales without access to real data.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bisect
+import random
+
+
+# Syllables from which the words of a vocabulary are built. Words only
+# consist of lower-case ASCII letters so that they survive the query
+# normalization unchanged.
+SYLLABLES = [
+    'ba', 'be', 'bi', 'bo', 'bu', 'da', 'de', 'di', 'do', 'du', 'fa', 'fe',
+    'fi', 'fo', 'fu', 'ga', 'ge', 'gi', 'go', 'gu', 'ka', 'ke', 'ki', 'ko',
+    'ku', 'la', 'le', 'li', 'lo', 'lu', 'ma', 'me', 'mi', 'mo', 'mu', 'na',
+    'ne', 'ni', 'no', 'nu', 'pa', 'pe', 'pi', 'po', 'pu', 'ra', 're', 'ri',
+    'ro', 'ru', 'sa', 'se', 'si', 'so', 'su', 'ta', 'te', 'ti', 'to', 'tu',
+]
+
+# Distribution of the number of words per query
+QUERY_LENGTHS = [1] * 45 + [2] * 30 + [3] * 17 + [4] * 8
+
+
+def make_word(index):
+    '''
+    Create the word with the given index.
+
+    Different indices give different words. Each word has at least two
+    syllables.
+    '''
+    syllables = []
+    while True:
+        index, digit = divmod(index, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+        if not index and len(syllables) >= 2:
+            break
+    return ''.join(reversed(syllables))
+
+
+class ZipfCorpus(object):
+    '''
+    A Zipf-distributed vocabulary of ``num_terms`` words.
+
+    The probability of the word with rank ``k`` is proportional to
+    ``1 / k ** exponent``. Ranks are assigned randomly so that the
+    lexicographic order of the words is unrelated to their frequency.
+    The corpus is deterministic for a given ``seed``.
+    '''
+    def __init__(self, num_terms, exponent=1.1, seed=0):
+        self.num_terms = num_terms
+        self.exponent = exponent
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.words = [make_word(i) for i in xrange(num_terms)]
+        self.random.shuffle(self.words)
+        weights = (1 / k ** exponent for k in xrange(1, num_terms + 1))
+        self._cumulative = _accumulate(weights)
+        self._total = self._cumulative[-1]
+
+    def word(self):
+        '''
+        Draw a random word.
+        '''
+        x = self.random.random() * self._total
+        index = bisect.bisect_right(self._cumulative, x)
+        return self.words[min(index, self.num_terms - 1)]
+
+    def query(self, length=None):
+        '''
+        Draw a random query.
+
+        Returns a list of ``length`` different words. By default the
+        length is drawn from a realistic distribution of query lengths.
+        '''
+        if length is None:
+            length = self.random.choice(QUERY_LENGTHS)
+        length = min(length, self.num_terms)
+        words = []
+        while len(words) < length:
+            word = self.word()
+            if word not in words:
+                words.append(word)
+        return words
+
+    def queries(self, num, length=None):
+        '''
+        Generate ``num`` random queries.
+        '''
+        for _ in xrange(num):
+            yield self.query(length)
+
+    def fork(self, seed):
+        '''
+        Create a copy of the corpus with its own random state.
+
+        The copy shares the vocabulary with the original corpus, which
+        makes forking cheap. Use it to draw queries from several threads.
+        '''
+        fork = object.__new__(ZipfCorpus)
+        fork.__dict__.update(self.__dict__)
+        fork.seed = (self.seed, seed)
+        fork.random = random.Random(hash(fork.seed))
+        return fork
+
+
+def _accumulate(values):
+    '''
+    Cumulative sums of values.
+    '''
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
@@ -0,0 +1,364 @@
+# encoding: utf-8
+
+'''
+Concurrent load harness for the search_suggestions plugin.
+
+Simulates many users that type search queries and submit them at the
+same time. Each virtual user repeatedly draws a query from a synthetic
+corpus (see ``corpus``) and types it keystroke by keystroke, requesting
+suggestions via the ``discovery_search_suggest`` action after every
+keystroke. The complete query is then stored like a submitted search
+(see ``search_suggestions.store_search``).
+
+Users run as threads, optionally spread across several processes. The
+harness reports the throughput and the latency percentiles of both
+operations as well as the errors that occurred, classified into
+deadlocks, serialization failures, lock and statement timeouts,
+exhaustion of the connection pool and other errors.
+
+Usage::
+
+    python -m benchmarks.load -c /etc/ckan/default/development.ini --yes
+
+WARNING: The harness deletes all search statistics that are stored in
+the configured backend. Do not run it against a production database.
+
+The harness is also run by the load test in the test suite, see the
+"Development" section of the README.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import json
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+
+from .corpus import ZipfCorpus
+
+
+OPERATIONS = ['suggest', 'store']
+
+# Error categories. Errors that don't fit any of the other categories are
+# counted as "other".
+ERROR_CATEGORIES = ['deadlock', 'serialization_failure', 'lock_timeout',
+                    'statement_timeout', 'pool_timeout', 'other']
+
+# PostgreSQL error codes, see
+# https://www.postgresql.org/docs/current/static/errcodes-appendix.html
+_PG_ERROR_CATEGORIES = {
+    '40P01': 'deadlock',
+    '40001': 'serialization_failure',
+    '55P03': 'lock_timeout',
+    '57014': 'statement_timeout',
+}
+
+# Backends that use the extension's SQLAlchemy engines
+SQL_BACKENDS = ['postgresql', 'sqlite']
+
+# Maximum number of error messages that are kept per category
+MAX_ERROR_SAMPLES = 5
+
+
+def keystrokes(words):
+    '''
+    The query strings seen while a user types a query.
+
+    Yields one string per keystroke, i.e. all non-empty prefixes of the
+    query. Words are separated by single spaces.
+    '''
+    q = ' '.join(words)
+    for i in xrange(1, len(q) + 1):
+        yield q[:i]
+
+
+def classify_error(e):
+    '''
+    Classify an exception raised during a database operation.
+
+    Returns one of ``ERROR_CATEGORIES``.
+    '''
+    from sqlalchemy.exc import DBAPIError, TimeoutError
+    if isinstance(e, TimeoutError):
+        # Raised by SQLAlchemy if no connection is available in the pool
+        return 'pool_timeout'
+    if isinstance(e, DBAPIError):
+        pgcode = getattr(e.orig, 'pgcode', None)
+        if pgcode in _PG_ERROR_CATEGORIES:
+            return _PG_ERROR_CATEGORIES[pgcode]
+        if 'database is locked' in unicode(e.orig):
+            # SQLite
+            return 'lock_timeout'
+    return 'other'
+
+
+class LoadStats(object):
+    '''
+    Thread-safe collection of latencies and errors.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.errors = {op: collections.Counter() for op in OPERATIONS}
+        self.error_samples = collections.defaultdict(list)
+
+    def __getstate__(self):
+        # Locks cannot be pickled, which is necessary to return the
+        # statistics from a worker process.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, operation, duration):
+        '''
+        Record the duration of a successful operation in seconds.
+        '''
+        with self._lock:
+            self.latencies[operation].append(duration)
+
+    def record_error(self, operation, e):
+        '''
+        Record an exception raised by an operation.
+        '''
+        category = classify_error(e)
+        with self._lock:
+            self.errors[operation][category] += 1
+            samples = self.error_samples[category]
+            if len(samples) < MAX_ERROR_SAMPLES:
+                samples.append(traceback.format_exc())
+
+    def merge(self, other):
+        '''
+        Add the latencies and errors of another ``LoadStats`` instance.
+        '''
+        with self._lock:
+            for op in OPERATIONS:
+                self.latencies[op].extend(other.latencies[op])
+                self.errors[op].update(other.errors[op])
+            for category, samples in other.error_samples.iteritems():
+                own = self.error_samples[category]
+                own.extend(samples[:MAX_ERROR_SAMPLES - len(own)])
+
+    def num_errors(self, categories=None):
+        '''
+        Total number of errors, optionally only for some categories.
+        '''
+        return sum(count for errors in self.errors.itervalues()
+                   for category, count in errors.iteritems()
+                   if categories is None or category in categories)
+
+    def report(self, duration):
+        '''
+        Summarize the statistics of a run that took ``duration`` seconds.
+        '''
+        from .search_suggestions import percentiles
+        report = {'duration_seconds': duration, 'operations': {}}
+        for op in OPERATIONS:
+            latencies = [d * 1000 for d in self.latencies[op]]
+            report['operations'][op] = {
+                'num': len(latencies),
+                'per_second': len(latencies) / duration,
+                'latency_ms': (percentiles(latencies, (50, 90, 99, 99.9))
+                               if latencies else None),
+                'errors': {c: self.errors[op][c] for c in ERROR_CATEGORIES},
+            }
+        report['error_samples'] = dict(self.error_samples)
+        return report
+
+
+def _user(index, corpus, stats, end, keystroke_delay, think_time):
+    '''
+    Simulate a single user until ``end``.
+    '''
+    import ckan.plugins.toolkit as toolkit
+    from ckanext.discovery.plugins.search_suggestions import store_search
+    suggest = toolkit.get_action('discovery_search_suggest')
+    client = 'load:{}'.format(index)
+    while time.time() < end:
+        words = corpus.query()
+        for q in keystrokes(words):
+            start = time.time()
+            if start >= end:
+                return
+            try:
+                suggest({'user': ''}, {'q': q})
+            except Exception as e:
+                stats.record_error('suggest', e)
+            else:
+                stats.record('suggest', time.time() - start)
+            if keystroke_delay:
+                time.sleep(keystroke_delay)
+        start = time.time()
+        try:
+            store_search(' '.join(words), client)
+        except Exception as e:
+            stats.record_error('store', e)
+        else:
+            stats.record('store', time.time() - start)
+        if think_time:
+            time.sleep(think_time)
+
+
+def _run_users(args):
+    '''
+    Run a group of users in threads of the current process.
+
+    Returns a ``LoadStats`` instance.
+    '''
+    (first_index, num_users, corpus, duration, keystroke_delay,
+     think_time) = args
+    stats = LoadStats()
+    end = time.time() + duration
+    threads = []
+    for index in xrange(first_index, first_index + num_users):
+        # Each user needs its own random state for reproducible results
+        user_corpus = corpus.fork(index)
+        thread = threading.Thread(target=_user, args=(
+            index, user_corpus, stats, end, keystroke_delay, think_time))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+def _dispose_engines():
+    '''
+    Close the database connections of the extension.
+
+    Must be called before forking worker processes, since connections
+    cannot be shared between processes. New connections are opened on
+    demand.
+    '''
+    from ckanext.discovery.model import get_engine, get_read_replica
+    from ckanext.discovery.plugins.search_suggestions.backends import \
+        get_backend
+    backend = get_backend()
+    if getattr(backend, 'source', backend).name not in SQL_BACKENDS:
+        return
+    get_engine().dispose()
+    replica = get_read_replica()
+    if replica is not None:
+        replica.engine.dispose()
+
+
+def run_load(corpus, users=10, duration=10, processes=1, keystroke_delay=0,
+             think_time=0):
+    '''
+    Run a load test.
+
+    ``users`` virtual users draw queries from ``corpus`` (a
+    ``ZipfCorpus``) for ``duration`` seconds. The users are distributed
+    evenly across ``processes`` processes. ``keystroke_delay`` is the
+    time in seconds between two keystrokes and ``think_time`` is the time
+    between submitting a query and starting to type the next one.
+
+    Returns a ``LoadStats`` instance and the actual duration in seconds.
+    '''
+    processes = max(1, min(processes, users))
+    groups = []
+    first_index = 0
+    for i in xrange(processes):
+        num_users = users // processes + (1 if i < users % processes else 0)
+        groups.append((first_index, num_users, corpus, duration,
+                       keystroke_delay, think_time))
+        first_index += num_users
+    start = time.time()
+    if processes == 1:
+        stats = _run_users(groups[0])
+    else:
+        _dispose_engines()
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_run_users, groups)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        stats = LoadStats()
+        for result in results:
+            stats.merge(result)
+    return stats, time.time() - start
+
+
+def parse_args(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Load harness for the search_suggestions plugin')
+    parser.add_argument('-c', '--config', required=True,
+                        help='CKAN configuration file')
+    parser.add_argument('--yes', action='store_true',
+                        help='Confirm that stored statistics may be deleted')
+    parser.add_argument('--terms', type=int, default=10000,
+                        help='Vocabulary size')
+    parser.add_argument('--queries-per-term', type=float, default=2,
+                        help='Number of queries stored before the run per '
+                             'vocabulary term')
+    parser.add_argument('--users', type=int, default=20,
+                        help='Number of concurrent users')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of processes across which the users '
+                             'are distributed')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Duration of the run in seconds')
+    parser.add_argument('--keystroke-delay', type=float, default=0,
+                        help='Seconds between two keystrokes of a user')
+    parser.add_argument('--think-time', type=float, default=0,
+                        help='Seconds between two queries of a user')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the random number generator')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Output file for the JSON results')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    from .search_suggestions import load_ckan, log, populate
+    args = parse_args(sys.argv[1:] if args is None else args)
+    if not args.yes:
+        sys.exit('The load harness deletes all stored search statistics. '
+                 'Use --yes to confirm.')
+    load_ckan(args.config)
+
+    from ckanext.discovery.plugins.search_suggestions.backends import \
+        get_backend
+    backend = get_backend()
+    backend.create_tables()
+    corpus = ZipfCorpus(args.terms, seed=args.seed)
+    num_queries = int(args.terms * args.queries_per_term)
+    log('Storing {} queries'.format(num_queries))
+    populate(backend, corpus, num_queries)
+    log('Running {} users in {} processes for {} seconds'.format(
+        args.users, args.processes, args.duration))
+    stats, duration = run_load(corpus, args.users, args.duration,
+                               args.processes, args.keystroke_delay,
+                               args.think_time)
+    report = stats.report(duration)
+    report['backend'] = backend.name
+    report['args'] = {k: v for k, v in vars(args).iteritems()
+                      if k not in ('config', 'output', 'yes')}
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        log('Results written to {}'.format(args.output))
+    if stats.num_errors():
+        sys.exit('{} errors occurred.'.format(stats.num_errors()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# encoding: utf-8
+
+'''
+Benchmarks for the search_suggestions plugin.
+
+For each vocabulary size, the stored statistics are replaced by a
+synthetic, Zipf-distributed query log (see ``corpus``). Then
+
+* the latency of computing suggestions is measured for different query
+  lengths and prefix lengths of the last word,
+* the throughput of storing queries is measured, and
+* the size of the stored statistics is determined.
+
+For backends that use SQL the number of statements per operation is
+reported, too (see ``ckanext.discovery.instrumentation``). The results
+are written as JSON so that different runs can be compared.
+
+Usage::
+
+    python -m benchmarks.search_suggestions \
+        -c /etc/ckan/default/development.ini --yes
+
+WARNING: The benchmark deletes all search statistics that are stored in
+the configured backend. Do not run it against a production database.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import collections
+import datetime
+import json
+import os.path
+import platform
+import subprocess
+import sys
+import time
+
+from .corpus import ZipfCorpus
+
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_QUERY_LENGTHS = [1, 2, 3, 4]
+
+# Prefix lengths of the last word. 0 means that the last word is complete
+# (i.e. followed by a space).
+DEFAULT_PREFIX_LENGTHS = [0, 1, 2, 4]
+
+# Number of queries that are aggregated before they are written while
+# populating the backend.
+POPULATE_BATCH_SIZE = 100000
+
+
+def load_ckan(config_file):
+    '''
+    Load the CKAN configuration and plugins.
+    '''
+    from ckan.lib.cli import load_config
+    load_config(os.path.abspath(config_file))
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    '''
+    Compute percentiles using the nearest-rank method.
+
+    Returns a dict that maps ``'p50'`` etc. to the percentiles. Also
+    contains the mean and the maximum.
+    '''
+    values = sorted(values)
+    result = {}
+    for p in ps:
+        rank = max(0, int(round(p / 100 * len(values))) - 1)
+        result['p{}'.format(p)] = values[rank]
+    result['mean'] = sum(values) / len(values)
+    result['max'] = values[-1]
+    return result
+
+
+def populate(backend, corpus, num_queries):
+    '''
+    Replace the stored statistics with queries from a corpus.
+
+    Returns the duration in seconds.
+    '''
+    from ckanext.discovery.plugins.search_suggestions.backends import \
+        count_words
+    start = time.time()
+    backend.clear()
+    remaining = num_queries
+    while remaining:
+        num = min(remaining, POPULATE_BATCH_SIZE)
+        remaining -= num
+        terms = collections.Counter()
+        cooccurrences = collections.Counter()
+        for words in corpus.queries(num):
+            query_terms, query_cooccurrences = count_words(words)
+            terms.update(query_terms)
+            cooccurrences.update(query_cooccurrences)
+        records = [(w, None, c) for w, c in terms.iteritems()]
+        records.extend((w1, w2, c) for (w1, w2), c
+                       in cooccurrences.iteritems())
+        backend.bulk_upsert(records)
+    return time.time() - start
+
+
+def table_sizes(backend):
+    '''
+    Determine the size of the stored statistics.
+    '''
+    from ckanext.discovery.model import get_engine
+    from ckanext.discovery.plugins.search_suggestions.model import (
+        CoOccurrence,
+        SearchTerm,
+    )
+    source = getattr(backend, 'source', backend)
+    if source.name != 'postgresql':
+        return {
+            'terms': sum(1 for _ in backend.iter_terms()),
+            'cooccurrences': sum(1 for _ in backend.iter_cooccurrences()),
+        }
+    engine = get_engine()
+    sizes = {}
+    for key, cls in [('terms', SearchTerm), ('cooccurrences', CoOccurrence)]:
+        table = cls.__tablename__
+        sizes[key] = engine.execute(
+            'SELECT COUNT(*) FROM {}'.format(table)).scalar()
+        sizes[key + '_bytes'] = engine.execute(
+            'SELECT pg_total_relation_size(%s)', table).scalar()
+    return sizes
+
+
+def make_query_string(words, prefix_length):
+    '''
+    Turn a list of words into a query string as typed by a user.
+    '''
+    if not prefix_length:
+        return ' '.join(words) + ' '
+    return ' '.join(words[:-1] + [words[-1][:prefix_length]])
+
+
+def bench_suggest(corpus, query_length, prefix_length, num):
+    '''
+    Measure the latency of computing suggestions.
+    '''
+    from ckanext.discovery.instrumentation import measure
+    from ckanext.discovery.plugins.search_suggestions.action import \
+        get_suggestions
+    durations = []
+    statements = 0
+    num_suggestions = 0
+    for words in corpus.queries(num, query_length):
+        q = make_query_string(words, prefix_length)
+        start = time.time()
+        with measure() as stats:
+            suggestions = get_suggestions(q, time_budget=0)
+        durations.append((time.time() - start) * 1000)
+        statements += stats.statements
+        num_suggestions += len(suggestions)
+    return {
+        'query_length': query_length,
+        'prefix_length': prefix_length,
+        'num': num,
+        'latency_ms': percentiles(durations),
+        'statements_per_call': statements / num,
+        'suggestions_per_call': num_suggestions / num,
+    }
+
+
+def bench_store(corpus, num):
+    '''
+    Measure the throughput of storing queries.
+    '''
+    from ckanext.discovery.instrumentation import measure
+    from ckanext.discovery.plugins.search_suggestions import SearchQuery
+    from ckanext.discovery.plugins.search_suggestions.writer import \
+        get_writer
+    start = time.time()
+    with measure() as stats:
+        for words in corpus.queries(num):
+            SearchQuery(' '.join(words)).store()
+        get_writer().flush()
+    duration = time.time() - start
+    return {
+        'num': num,
+        'queries_per_second': num / duration,
+        'statements_per_query': stats.statements / num,
+    }
+
+
+def get_revision():
+    '''
+    Get the git revision of the extension.
+    '''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the search_suggestions plugin')
+    parser.add_argument('-c', '--config', required=True,
+                        help='CKAN configuration file')
+    parser.add_argument('--yes', action='store_true',
+                        help='Confirm that stored statistics may be deleted')
+    parser.add_argument('--sizes', type=_int_list, default=DEFAULT_SIZES,
+                        help='Comma-separated vocabulary sizes')
+    parser.add_argument('--queries-per-term', type=float, default=2,
+                        help='Number of stored queries per vocabulary term')
+    parser.add_argument('--query-lengths', type=_int_list,
+                        default=DEFAULT_QUERY_LENGTHS,
+                        help='Comma-separated query lengths for suggestions')
+    parser.add_argument('--prefix-lengths', type=_int_list,
+                        default=DEFAULT_PREFIX_LENGTHS,
+                        help='Comma-separated prefix lengths of the last '
+                             'word, 0 for a complete word')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='Number of suggestion requests per combination')
+    parser.add_argument('--store-queries', type=int, default=2000,
+                        help='Number of queries for the store benchmark')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the random number generator')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Output file for the JSON results')
+    return parser.parse_args(args)
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+    if not args.yes:
+        sys.exit('The benchmark deletes all stored search statistics. Use '
+                 '--yes to confirm.')
+    load_ckan(args.config)
+
+    from ckanext.discovery.plugins.search_suggestions.backends import \
+        get_backend
+    backend = get_backend()
+    backend.create_tables()
+    results = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'revision': get_revision(),
+            'backend': backend.name,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {k: v for k, v in vars(args).iteritems()
+                     if k not in ('config', 'output', 'yes')},
+        },
+        'results': [],
+    }
+    for size in args.sizes:
+        log('Vocabulary size {}'.format(size))
+        corpus = ZipfCorpus(size, seed=args.seed)
+        num_queries = int(size * args.queries_per_term)
+        log('  Storing {} queries'.format(num_queries))
+        populate_duration = populate(backend, corpus, num_queries)
+        result = {
+            'num_terms': size,
+            'num_queries': num_queries,
+            'populate_seconds': populate_duration,
+            'sizes': table_sizes(backend),
+            'suggest': [],
+        }
+        for query_length in args.query_lengths:
+            for prefix_length in args.prefix_lengths:
+                log('  Suggestions for {} words, prefix length {}'.format(
+                    query_length, prefix_length))
+                result['suggest'].append(bench_suggest(
+                    corpus, query_length, prefix_length, args.samples))
+        log('  Storing queries')
+        result['store'] = bench_store(corpus, args.store_queries)
+        results['results'].append(result)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        log('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# encoding: utf-8
+
+'''
+Benchmarks for the local similarity engine of the similar_datasets plugin.
+
+For each number of datasets, synthetic datasets are generated: each
+dataset belongs to a topic and consists of words of that topic and of
+random, Zipf-distributed words (see ``corpus``). Then
+
+* the time for computing the signatures is measured,
+* the index is built and its build time and size are determined,
+* the latency of queries is measured, and
+* the results of the queries are compared to the exact most similar
+  datasets (by Jaccard similarity) to determine the recall.
+
+The peak memory usage of the process is reported after each step. The
+benchmark neither uses the database nor Solr. The results are written
+as JSON so that different runs can be compared.
+
+Usage::
+
+    python -m benchmarks.similar_datasets
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import datetime
+import heapq
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from .corpus import ZipfCorpus
+from .search_suggestions import get_revision, percentiles
+
+
+DEFAULT_SIZES = [10000, 100000]
+
+# Number of datasets per topic
+TOPIC_SIZE = 20
+
+# Number of words of each topic
+TOPIC_WORDS = 30
+
+
+def make_datasets(num, topic_words, noise_words, seed=0):
+    '''
+    Generate the word sets of synthetic datasets.
+
+    Each topic consists of ``TOPIC_WORDS`` words that are drawn uniformly
+    from the vocabulary. Each dataset contains ``topic_words`` randomly
+    chosen words of its topic and ``noise_words`` random words from a
+    Zipf-distributed vocabulary.
+    '''
+    rand = random.Random(seed)
+    corpus = ZipfCorpus(max(num, 1000), seed=seed)
+    num_topics = max(1, num // TOPIC_SIZE)
+    topics = [rand.sample(corpus.words, TOPIC_WORDS)
+              for _ in xrange(num_topics)]
+    datasets = []
+    for i in xrange(num):
+        words = set(rand.sample(topics[i % num_topics], topic_words))
+        words.update(corpus.query(noise_words))
+        datasets.append(words)
+    return datasets
+
+
+def jaccard(a, b):
+    intersection = len(a & b)
+    return intersection / (len(a) + len(b) - intersection)
+
+
+def max_rss_mb():
+    '''
+    Peak memory usage of the process in MB.
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024
+
+
+def bench_signatures(datasets):
+    '''
+    Compute the signatures of all datasets.
+
+    Returns the signatures and the duration in seconds.
+    '''
+    from ckanext.discovery.plugins.similar_datasets.local import \
+        compute_signature
+    start = time.time()
+    signatures = [compute_signature(words) for words in datasets]
+    return signatures, time.time() - start
+
+
+def bench_queries(index, datasets, signatures, num_results, samples, seed=0):
+    '''
+    Measure the latency and the recall of queries.
+
+    The recall is the fraction of the exact ``num_results`` most similar
+    datasets (by Jaccard similarity) that are found. Since many datasets
+    are almost equally similar, the ratio of the summed Jaccard
+    similarities of the found and of the exact datasets is reported,
+    too.
+    '''
+    rand = random.Random(seed)
+    rows = rand.sample(xrange(len(datasets)), min(samples, len(datasets)))
+    durations = []
+    found = 0
+    expected = 0
+    found_similarity = 0
+    expected_similarity = 0
+    for row in rows:
+        id = '{:08d}'.format(row)
+        start = time.time()
+        result = index.query(signatures[row], num_results, exclude=id)
+        durations.append((time.time() - start) * 1000)
+        exact = heapq.nlargest(
+            num_results,
+            ((jaccard(datasets[row], words), other)
+             for other, words in enumerate(datasets) if other != row))
+        expected_similarity += sum(score for score, _ in exact)
+        exact = {'{:08d}'.format(other) for score, other in exact if score}
+        found += len(exact & {id for id, _ in result})
+        expected += len(exact)
+        found_similarity += sum(jaccard(datasets[row], datasets[int(id)])
+                                for id, _ in result)
+    return {
+        'num': len(rows),
+        'latency_ms': percentiles(durations),
+        'recall': found / expected if expected else None,
+        'similarity_ratio': (found_similarity / expected_similarity
+                             if expected_similarity else None),
+    }
+
+
+def parse_args(args):
+    def int_list(value):
+        return [int(x) for x in value.split(',')]
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the local similarity engine')
+    parser.add_argument('--sizes', type=int_list, default=DEFAULT_SIZES,
+                        help='Comma-separated numbers of datasets')
+    parser.add_argument('--topic-words', type=int, default=15,
+                        help='Number of topic words per dataset')
+    parser.add_argument('--noise-words', type=int, default=15,
+                        help='Number of random words per dataset')
+    parser.add_argument('--num-results', type=int, default=5,
+                        help='Number of similar datasets per query')
+    parser.add_argument('--samples', type=int, default=100,
+                        help='Number of queries')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the random number generator')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Output file for the JSON results')
+    return parser.parse_args(args)
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def main(args=None):
+    args = parse_args(sys.argv[1:] if args is None else args)
+
+    from ckanext.discovery.plugins.similar_datasets.local import (
+        build_index,
+        LocalIndex,
+        NUM_BANDS,
+        NUM_HASHES,
+    )
+    results = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'revision': get_revision(),
+            'num_hashes': NUM_HASHES,
+            'num_bands': NUM_BANDS,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {k: v for k, v in vars(args).iteritems()
+                     if k != 'output'},
+        },
+        'results': [],
+    }
+    directory = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            log('{} datasets'.format(size))
+            datasets = make_datasets(size, args.topic_words,
+                                     args.noise_words, args.seed)
+            log('  Computing signatures')
+            signatures, signature_duration = bench_signatures(datasets)
+            result = {
+                'num_datasets': size,
+                'signature_ms_per_dataset': signature_duration * 1000 / size,
+                'signatures_max_rss_mb': max_rss_mb(),
+            }
+            log('  Building index')
+            path = os.path.join(directory, '{}.idx'.format(size))
+            start = time.time()
+            build_index((('{:08d}'.format(row), signature)
+                         for row, signature in enumerate(signatures)), path)
+            result['build_seconds'] = time.time() - start
+            result['build_max_rss_mb'] = max_rss_mb()
+            result['index_bytes'] = os.path.getsize(path)
+            log('  Querying')
+            index = LocalIndex(path)
+            result['query'] = bench_queries(index, datasets, signatures,
+                                            args.num_results, args.samples,
+                                            args.seed)
+            result['query_max_rss_mb'] = max_rss_mb()
+            results['results'].append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        log('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
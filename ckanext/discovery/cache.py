@@ -0,0 +1,96 @@
+# encoding: utf-8
+
+'''
+In-process caching.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    '''
+    A thread-safe LRU cache whose entries expire.
+
+    At most ``max_size`` entries are kept; when the cache is full the
+    least recently used entry is evicted. Entries expire ``ttl`` seconds
+    after they have been set.
+    '''
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+        #: Number of successful lookups
+        self.hits = 0
+
+        #: Number of lookups for missing or expired entries
+        self.misses = 0
+
+    def get(self, key, default=None):
+        '''
+        Get the value for a key.
+
+        Returns ``default`` if there is no entry for the key or if the
+        entry has expired.
+        '''
+        with self._lock:
+            try:
+                expires_at, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at < time.time():
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as recently used
+            self._entries[key] = (expires_at, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        '''
+        Set the value for a key.
+        '''
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, key):
+        '''
+        Remove the entry for a key.
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self):
+        '''
+        Get the keys of all entries, including expired ones.
+
+        Does not affect the usage order or the hit and miss counters.
+        '''
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
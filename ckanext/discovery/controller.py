@@ -0,0 +1,29 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import ckan.plugins.toolkit as toolkit
+
+from .metrics import get_registry, is_enabled
+
+
+class MetricsController(toolkit.BaseController):
+    '''
+    Exposes the metrics of the discovery plugins.
+    '''
+    def metrics(self):
+        '''
+        Render the metrics in the Prometheus text format.
+
+        Only available to sysadmins and only if metrics are enabled.
+        '''
+        if not is_enabled():
+            toolkit.abort(404, toolkit._('Metrics are disabled'))
+        try:
+            toolkit.check_access('sysadmin', {'user': toolkit.c.user})
+        except toolkit.NotAuthorized:
+            toolkit.abort(403, toolkit._('Not authorized to see this page'))
+        toolkit.response.headers[b'Content-Type'] = \
+            b'text/plain; version=0.0.4; charset=utf-8'
+        return get_registry().render()
@@ -0,0 +1,85 @@
+# encoding: utf-8
+
+'''
+Time budgets for operations.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    '''
+    Raised when the time budget of an operation is exhausted.
+    '''
+    pass
+
+
+_local = threading.local()
+
+
+class Deadline(object):
+    '''
+    A time budget for an operation.
+
+    ``budget`` is the available time in seconds. A budget of ``None`` or
+    0 means that there is no time limit.
+
+    When used as a context manager the deadline becomes the current
+    deadline of the thread (see ``get_current_deadline``), which allows
+    lower layers (for example database access) to respect it.
+    '''
+    def __init__(self, budget=None):
+        self.start = time.time()
+        self.expires_at = (self.start + budget) if budget else None
+
+    def elapsed(self):
+        '''
+        Seconds since the deadline was created.
+        '''
+        return time.time() - self.start
+
+    def remaining(self):
+        '''
+        Remaining seconds or ``None`` if there is no time limit.
+        '''
+        if self.expires_at is None:
+            return None
+        return max(0, self.expires_at - time.time())
+
+    def expired(self):
+        '''
+        Whether the time budget is exhausted.
+        '''
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def check(self):
+        '''
+        Raise ``DeadlineExceeded`` if the time budget is exhausted.
+        '''
+        if self.expired():
+            raise DeadlineExceeded()
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, *args):
+        _local.stack.pop()
+
+
+def get_current_deadline():
+    '''
+    Get the current deadline of the thread.
+
+    Returns ``None`` if there is no current deadline.
+    '''
+    try:
+        return _local.stack[-1]
+    except (AttributeError, IndexError):
+        return None
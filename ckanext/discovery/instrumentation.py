@@ -0,0 +1,139 @@
+# encoding: utf-8
+
+'''
+Instrumentation of database access.
+
+Counts the SQL statements executed by the extension together with the
+number of rows they returned or affected and the time they took.
+Statements are attributed to the measurements that are active in the
+current thread (see ``measure``). Actions and hooks are wrapped using
+``instrumented``, which logs a summary of each invocation.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class StatementStats(object):
+    '''
+    Statistics of the SQL statements executed during a measurement.
+    '''
+    def __init__(self, name=None):
+        self.name = name
+
+        #: Number of executed statements
+        self.statements = 0
+
+        #: Number of rows returned or affected by the statements
+        self.rows = 0
+
+        #: Total duration of the statements in seconds
+        self.duration = 0
+
+    def add(self, rows, duration):
+        '''
+        Add an executed statement.
+        '''
+        self.statements += 1
+        self.rows += rows
+        self.duration += duration
+
+    def __unicode__(self):
+        return '{} statements, {} rows, {:.1f}ms'.format(
+               self.statements, self.rows, self.duration * 1000)
+
+    def __repr__(self):
+        r = '<{} {!r}: {}>'.format(self.__class__.__name__, self.name,
+                                   unicode(self))
+        return r.encode('utf-8')
+
+
+def _get_active():
+    try:
+        return _local.active
+    except AttributeError:
+        _local.active = []
+        return _local.active
+
+
+def record_statement(rows, duration):
+    '''
+    Record an executed statement.
+
+    The statement is added to all active measurements of the current
+    thread. Only needs to be called for database access that does not
+    use an instrumented SQLAlchemy engine (see ``instrument_engine``).
+    '''
+    for stats in _get_active():
+        stats.add(rows, duration)
+
+
+@contextlib.contextmanager
+def measure(name=None):
+    '''
+    Context manager for counting the statements of an operation.
+
+    Returns a ``StatementStats`` instance that contains the statements
+    executed by the current thread while the context manager is active.
+    Measurements can be nested.
+    '''
+    stats = StatementStats(name)
+    active = _get_active()
+    active.append(stats)
+    try:
+        yield stats
+    finally:
+        active.remove(stats)
+
+
+def instrumented(name):
+    '''
+    Decorator for counting the statements of a function call.
+
+    A summary of the statements executed by each call is logged using
+    the ``DEBUG`` level.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            with measure(name) as stats:
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    log.debug('%s: %s', name, stats)
+        return wrapped
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info['discovery_statement_start'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info.pop('discovery_statement_start', None)
+    duration = (time.time() - start) if start else 0
+    # The row count is -1 if the DBAPI driver cannot determine it
+    record_statement(max(cursor.rowcount, 0), duration)
+
+
+def instrument_engine(engine):
+    '''
+    Record the statements executed via an SQLAlchemy engine.
+    '''
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
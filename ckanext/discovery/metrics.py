@@ -0,0 +1,318 @@
+# encoding: utf-8
+
+'''
+Metrics for monitoring the discovery plugins.
+
+The plugins record counters and latency histograms in a registry (see
+``get_registry``). The registry can be read programmatically via
+``Registry.collect`` and is exposed in the Prometheus text format by the
+``discovery`` plugin (see ``controller.MetricsController``).
+
+Metrics are only recorded if ``ckanext.discovery.metrics.enabled`` is
+true. Otherwise recording a value returns immediately.
+
+Each CKAN process has its own registry. If CKAN is run using several
+worker processes then each scrape only returns the values of the process
+that handled the request.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import contextlib
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+
+from .plugins import get_config
+
+
+# Default upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def is_enabled():
+    '''
+    Whether metrics are recorded.
+    '''
+    return toolkit.asbool(get_config('metrics.enabled', False))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in labels) + '}'
+
+
+class Metric(object):
+    '''
+    Base class for metrics.
+
+    ``name`` is the metric's name, ``help`` is a short description and
+    ``label_names`` is a list of the names of the metric's labels. Label
+    values are passed as keyword arguments when recording values.
+    '''
+    type = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('Metric "{}" expects the labels {}'.format(
+                             self.name, ', '.join(self.label_names)))
+        return tuple((name, labels[name]) for name in self.label_names)
+
+    def clear(self):
+        '''
+        Reset all recorded values.
+        '''
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        '''
+        The current values of the metric.
+
+        Returns a list of ``(suffix, labels, value)`` tuples, where
+        ``labels`` is a tuple of ``(name, value)`` pairs.
+        '''
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    '''
+    A value that only increases.
+
+    By convention the names of counters end with ``_total``.
+    '''
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''
+        Increase the counter.
+        '''
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('', key, value)
+                    for key, value in sorted(self._values.iteritems())]
+
+
+class Histogram(Metric):
+    '''
+    The distribution of observed values, usually durations in seconds.
+
+    ``buckets`` is a sorted list of the upper bounds of the buckets.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        '''
+        Record an observed value.
+        '''
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * len(self.buckets), 0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        '''
+        Context manager that records the duration of its body.
+        '''
+        if not is_enabled():
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.iteritems()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', key + (('le', bound),),
+                                    cumulative))
+                samples.append(('_sum', key, total))
+                samples.append(('_count', key, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    '''
+    A value that is read when the metrics are collected.
+
+    ``function`` is called without arguments and must return either a
+    number or a dict that maps label values to numbers. For metrics with
+    more than one label the keys of the dict are tuples of label values.
+    '''
+    type = 'gauge'
+    suffix = ''
+
+    def __init__(self, name, help, function, label_names=()):
+        super(Gauge, self).__init__(name, help, label_names)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not isinstance(value, dict):
+            return [(self.suffix, (), value)]
+        samples = []
+        for key, v in sorted(value.iteritems()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            samples.append((self.suffix, tuple(zip(self.label_names, key)),
+                            v))
+        return samples
+
+
+class CounterFunction(Gauge):
+    '''
+    A counter whose value is read when the metrics are collected.
+
+    Useful for exposing counts that are maintained elsewhere anyway. See
+    ``Gauge`` for the return value of ``function``.
+    '''
+    type = 'counter'
+
+
+class Registry(object):
+    '''
+    A collection of metrics.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            try:
+                metric = self._metrics[name]
+            except KeyError:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+        if not isinstance(metric, cls):
+            raise ValueError('Metric "{}" is already registered as a {}'
+                             .format(name, metric.type))
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        '''
+        Get or create a ``Counter``.
+        '''
+        return self._register(Counter, name, help, label_names)
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Get or create a ``Histogram``.
+        '''
+        return self._register(Histogram, name, help, label_names, buckets)
+
+    def gauge(self, name, help, function, label_names=()):
+        '''
+        Get or create a ``Gauge``.
+        '''
+        return self._register(Gauge, name, help, function, label_names)
+
+    def counter_function(self, name, help, function, label_names=()):
+        '''
+        Get or create a ``CounterFunction``.
+        '''
+        return self._register(CounterFunction, name, help, function,
+                              label_names)
+
+    def clear(self):
+        '''
+        Reset the values of all metrics.
+        '''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+    def collect(self):
+        '''
+        Get the current values of all metrics.
+
+        Returns a dict that maps the name of each metric to a dict with
+        the keys ``type``, ``help`` and ``samples``. The latter is a list
+        of ``(name, labels, value)`` tuples where ``labels`` is a dict.
+        '''
+        with self._lock:
+            metrics = sorted(self._metrics.iteritems())
+        result = {}
+        for name, metric in metrics:
+            result[name] = {
+                'type': metric.type,
+                'help': metric.help,
+                'samples': [(name + suffix, dict(labels), value)
+                            for suffix, labels, value in metric.samples()],
+            }
+        return result
+
+    def render(self):
+        '''
+        Render the current values in the Prometheus text format.
+        '''
+        with self._lock:
+            metrics = sorted(self._metrics.iteritems())
+        lines = []
+        for name, metric in metrics:
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.type))
+            for suffix, labels, value in metric.samples():
+                labels = [(k, _format_value(v) if k == 'le' else v)
+                          for k, v in labels]
+                lines.append('{}{}{} {}'.format(name, suffix,
+                             _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+
+
+def get_registry():
+    '''
+    Get the registry of the discovery plugins.
+    '''
+    return _registry
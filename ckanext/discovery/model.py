@@ -3,16 +3,86 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import contextlib
 import logging
+import math
+import threading
+import time
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
-from ckan.model.meta import Session
+from ckan.common import config
+
+from .deadline import DeadlineExceeded, get_current_deadline
+from .instrumentation import instrument_engine
+from .plugins import get_config
 
 
 log = logging.getLogger(__name__)
 
+_lock = threading.Lock()
+_engine = None
+_engine_url = None
+_session = None
+
+
+def get_engine():
+    '''
+    Get the engine for the primary database.
+
+    The extension uses its own engine (and hence its own connection pool)
+    so that its transactions are independent from those of CKAN. The
+    database URL is taken from ``ckanext.discovery.sqlalchemy.url`` and
+    defaults to CKAN's ``sqlalchemy.url``. The pool size can be set via
+    ``ckanext.discovery.sqlalchemy.pool_size``.
+    '''
+    global _engine, _engine_url, _session
+    url = get_config('sqlalchemy.url') or config.get('sqlalchemy.url')
+    with _lock:
+        # Compare with the configured URL instead of ``_engine.url``,
+        # whose string form can differ (for example for escaped
+        # passwords)
+        if _engine is None or _engine_url != url:
+            if _engine is not None:
+                _engine.dispose()
+            kwargs = {}
+            if url.startswith('postgres'):
+                kwargs['pool_size'] = int(get_config('sqlalchemy.pool_size',
+                                                     5))
+            _engine = create_engine(url, **kwargs)
+            _engine_url = url
+            instrument_engine(_engine)
+            _session = scoped_session(sessionmaker(bind=_engine,
+                                                   autoflush=False))
+        return _engine
+
+
+def get_session():
+    '''
+    Get the ORM session for the primary database.
+
+    The session is bound to the engine returned by ``get_engine`` and is
+    separate from CKAN's session. Changes have to be committed
+    explicitly.
+    '''
+    get_engine()
+    return _session
+
+
+@contextlib.contextmanager
+def transaction():
+    '''
+    Context manager for a short transaction on the primary database.
+
+    Returns a connection. The transaction is committed when the context
+    manager exits normally and rolled back otherwise.
+    '''
+    with get_engine().begin() as conn:
+        yield conn
+
 
 class Object(object):
     '''
@@ -22,6 +92,8 @@ class Object(object):
 
         Base = declarative_base(cls=Object)
 
+    Queries use the session returned by ``get_session``, not CKAN's
+    session.
     '''
     __abstract__ = True
 
@@ -46,9 +118,10 @@ class Object(object):
             # Since the object doesn't exist, try to create it
             kwargs.update(create_kwargs or {})
             obj = cls(**kwargs)
+            session = get_session()
             try:
-                with Session.begin_nested():
-                    Session.add(obj)
+                with session.begin_nested():
+                    session.add(obj)
                 return obj
             except IntegrityError as e:
                 log.exception(e)
@@ -69,5 +142,199 @@ class Object(object):
 
     @classmethod
     def query(cls):
-        return Session.query(cls)
+        return get_session().query(cls)
+
+
+class ReadReplica(object):
+    '''
+    A read-only database connection, usually to a replica.
+
+    ``url`` is the SQLAlchemy URL of the database. ``pool_size`` is the
+    size of the connection pool and ``statement_timeout`` is the maximum
+    duration of a single statement in milliseconds (PostgreSQL only, 0
+    disables the timeout).
+
+    ``max_lag`` is the maximum replication lag in seconds. If the
+    replica lags further behind the primary then it is not used. The lag
+    is checked at most every ``LAG_CHECK_INTERVAL`` seconds.
+
+    If reading from the replica fails then it is not used for the next
+    ``retry_interval`` seconds.
+    '''
+    LAG_CHECK_INTERVAL = 5
 
+    def __init__(self, url, pool_size=5, statement_timeout=0, max_lag=30,
+                 retry_interval=30):
+        self.url = url
+        self.max_lag = max_lag
+        self.retry_interval = retry_interval
+        kwargs = {}
+        if url.startswith('postgres'):
+            kwargs['pool_size'] = pool_size
+            options = '-c default_transaction_read_only=on'
+            if statement_timeout:
+                options += ' -c statement_timeout={:d}'.format(
+                           statement_timeout)
+            kwargs['connect_args'] = {'options': options}
+        self.engine = create_engine(url, **kwargs)
+        instrument_engine(self.engine)
+        self.session = scoped_session(sessionmaker(bind=self.engine,
+                                                   autoflush=False))
+        self._lock = threading.Lock()
+        self._unavailable_until = 0
+        self._lag_checked_at = 0
+        self._lag = 0
+
+    @classmethod
+    def from_config(cls):
+        '''
+        Create an instance from the CKAN configuration.
+
+        Returns ``None`` if no read replica has been configured.
+        '''
+        url = get_config('sqlalchemy.read_url')
+        if not url:
+            return None
+        return cls(
+            url,
+            pool_size=int(get_config('sqlalchemy.read_pool_size', 5)),
+            statement_timeout=int(get_config(
+                'sqlalchemy.read_statement_timeout', 0)),
+            max_lag=float(get_config('sqlalchemy.read_max_lag', 30)),
+            retry_interval=float(get_config(
+                'sqlalchemy.read_retry_interval', 30)),
+        )
+
+    def mark_failed(self):
+        '''
+        Mark the replica as temporarily unavailable.
+        '''
+        log.warning('Read replica is not available, using the primary '
+                    'database for the next {} seconds'.format(
+                    self.retry_interval))
+        self._unavailable_until = time.time() + self.retry_interval
+        self.session.remove()
+
+    def _get_lag(self):
+        '''
+        Get the replication lag in seconds.
+
+        Returns 0 if the database is not a replica.
+        '''
+        if not self.url.startswith('postgres'):
+            return 0
+        try:
+            lag = self.session.execute('''
+                SELECT EXTRACT(EPOCH FROM now() -
+                               pg_last_xact_replay_timestamp())
+            ''').scalar()
+        finally:
+            self.session.close()
+        return lag or 0
+
+    def is_available(self):
+        '''
+        Whether the replica should be used.
+
+        Returns ``False`` if the replica has failed recently or if its
+        replication lag is too big.
+        '''
+        now = time.time()
+        if now < self._unavailable_until:
+            return False
+        with self._lock:
+            if now - self._lag_checked_at > self.LAG_CHECK_INTERVAL:
+                self._lag_checked_at = now
+                try:
+                    self._lag = self._get_lag()
+                except DBAPIError:
+                    log.exception('Could not determine replication lag')
+                    self.mark_failed()
+                    return False
+                if self._lag > self.max_lag:
+                    log.warning(('Replication lag of read replica is {:.1f}s, '
+                                'using the primary database').format(
+                                self._lag))
+        return self._lag <= self.max_lag
+
+
+_read_replica = None
+
+
+def get_read_replica():
+    '''
+    Get the configured read replica.
+
+    Returns ``None`` if no read replica is configured.
+    '''
+    global _read_replica
+    url = get_config('sqlalchemy.read_url')
+    if not url:
+        return None
+    if _read_replica is None or _read_replica.url != url:
+        _read_replica = ReadReplica.from_config()
+    return _read_replica
+
+
+def _apply_deadline(session, deadline):
+    '''
+    Limit the duration of the session's statements to a deadline.
+
+    Sets PostgreSQL's ``statement_timeout`` for the current transaction
+    to the remaining time of the deadline. Does nothing for other
+    databases.
+    '''
+    if session.bind.dialect.name != 'postgresql':
+        return
+    timeout = int(math.ceil(deadline.remaining() * 1000))
+    session.execute('SET LOCAL statement_timeout = {:d}'.format(
+                    max(timeout, 1)))
+
+
+def run_read(func):
+    '''
+    Run a read-only database operation.
+
+    ``func`` is called with an SQLAlchemy session as its only argument
+    and its return value is returned. If a read replica is configured
+    and available then its session is used, otherwise the session for
+    the primary database (see ``get_session``) is used. If the operation
+    fails on the replica then it is repeated on the primary database.
+
+    If there is a current deadline (see
+    ``ckanext.discovery.deadline.get_current_deadline``) then the
+    operation's statements are limited to the remaining time and
+    ``DeadlineExceeded`` is raised once the deadline has expired.
+    '''
+    deadline = get_current_deadline()
+    if deadline is not None and deadline.remaining() is None:
+        deadline = None
+
+    def run(session):
+        if deadline is not None:
+            deadline.check()
+            _apply_deadline(session, deadline)
+        try:
+            return func(session)
+        except DBAPIError:
+            if deadline is not None and deadline.expired():
+                # The statement has been cancelled due to the timeout
+                raise DeadlineExceeded()
+            raise
+
+    replica = get_read_replica()
+    if replica is not None and replica.is_available():
+        try:
+            return run(replica.session)
+        except DBAPIError:
+            log.exception('Error while reading from the read replica')
+            replica.mark_failed()
+        finally:
+            # End the transaction so that replica connections are not
+            # left idle in a transaction between requests.
+            replica.session.close()
+    session = get_session()
+    try:
+        return run(session)
+    finally:
+        session.close()
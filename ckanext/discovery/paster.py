@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import inspect
+import sys
+
+from ckan.lib.cli import CkanCommand
+
+# Do not import modules for CKAN or ckanext-discovery here (unless you know
+# what you're doing), since their loggers won't work if imported before the
+# CKAN configuration has been loaded.
+
+
+def _error(msg):
+    sys.exit('ERROR: ' + msg)
+
+
+class DiscoveryCommand(CkanCommand):
+    """
+    Utilities for the discovery plugins.
+
+    Sub-commands:
+
+        clear-traces:
+            Delete the saved traces of all processes.
+
+        traces [NUM]:
+            Show the NUM (default: 10) slowest traced requests of all
+            processes. Tracing is enabled via
+            ckanext.discovery.tracing.sample_rate.
+
+    """
+    max_args = None
+    min_args = 0
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def command(self):
+        if not self.args:
+            _error('Missing command name. Try --help.')
+        self._load_config()
+        cmd = self.args[0]
+        try:
+            method = getattr(self, 'cmd_' + cmd.replace('-', '_'))
+        except AttributeError:
+            _error('Unknown command "{}". Try --help.'.format(cmd))
+        spec = inspect.getargspec(method)
+        if not spec.varargs and len(self.args) > len(spec.args):
+            _error('Too many arguments for command "{}". Try --help.'.format(
+                   cmd))
+        method(*self.args[1:])
+
+    def cmd_traces(self, num=10):
+        from .tracing import get_directory, load_traces
+        try:
+            num = int(num)
+        except ValueError:
+            _error('Number of traces must be an integer.')
+        traces = load_traces(get_directory())[:num]
+        if not traces:
+            print('No traces have been recorded.')
+        for trace in traces:
+            print(trace.format())
+            print()
+
+    def cmd_clear_traces(self):
+        from .tracing import clear_traces, get_directory
+        num = clear_traces(get_directory())
+        print('Deleted the traces of {} processes.'.format(num))
@@ -18,9 +18,20 @@ log = logging.getLogger(__name__)
 
 
 class DiscoveryPlugin(plugins.SingletonPlugin, DefaultTranslation):
+    plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.ITranslation)
 
+    #
+    # IRoutes
+    #
+
+    def before_map(self, map):
+        controller = 'ckanext.discovery.controller:MetricsController'
+        map.connect('discovery_metrics', '/ckan-admin/discovery/metrics',
+                    controller=controller, action='metrics')
+        return map
+
     #
     # ITemplateHelpers
     #
@@ -8,22 +8,49 @@ import re
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
-from ckan.model.meta import Session
 
-from .model import SearchTerm, CoOccurrence
+from .admission import get_admission_filter, get_client
+from .backends import get_backend
 from .interfaces import ISearchTermPreprocessor
+from .sampling import get_effective_sample_rate, get_sampler
+from .writer import get_writer
 from .. import get_config
+from ...instrumentation import instrumented
+from ...metrics import get_registry
+from ...profiling import profile
+from ...tracing import span, trace
 
 
 log = logging.getLogger(__name__)
 
+_registry = get_registry()
+_store_duration = _registry.histogram(
+    'discovery_query_storage_duration_seconds',
+    'Duration of storing search queries')
+_store_results = _registry.counter(
+    'discovery_queries_total',
+    'Search queries by the outcome of storing them', ['result'])
+_registry.counter_function(
+    'discovery_queries_rejected_total',
+    'Search queries rejected by the admission filter',
+    lambda: dict(get_admission_filter().rejected), ['reason'])
+_registry.gauge(
+    'discovery_query_sample_rate',
+    'Effective sampling rate for storing search queries',
+    get_effective_sample_rate)
+_registry.gauge(
+    'discovery_query_writer_pending',
+    'Search queries that have been collected but not written yet',
+    lambda: get_writer().pending)
+
 
 class SearchQuery(object):
     '''
     A single search query.
 
     Provides the actual query string (``.string``), its normalized words
-    (``.words``) and context terms (``.context_terms``).
+    (``.words``) and context terms (``.context_terms``). The context
+    terms are instances of ``backends.Term``.
     '''
 
     # Maximum number of terms to take into account when computing suggestions
@@ -32,16 +59,23 @@ class SearchQuery(object):
     def __init__(self, query_string):
         self.string = query_string.lower()
         self.words = self._split_query(self.string)
+        self._context_terms = None
 
-        if self.is_last_word_complete:
-            context_words = self.words[-self.MAX_CONTEXT_TERMS:]
-        else:
-            context_words = self.words[-(self.MAX_CONTEXT_TERMS + 1):-1]
-        if context_words:
-            self.context_terms = set(SearchTerm.filter(SearchTerm.term.in_(
-                                     context_words)))
-        else:
-            self.context_terms = set()
+    @property
+    def context_terms(self):
+        '''
+        The terms of the words that provide the context for suggestions.
+
+        The terms are loaded from the backend on first access, so that
+        queries which are only stored don't require a read.
+        '''
+        if self._context_terms is None:
+            if self.is_last_word_complete:
+                context_words = self.words[-self.MAX_CONTEXT_TERMS:]
+            else:
+                context_words = self.words[-(self.MAX_CONTEXT_TERMS + 1):-1]
+            self._context_terms = set(get_backend().get_terms(context_words))
+        return self._context_terms
 
     @property
     def is_last_word_complete(self):
@@ -82,18 +116,18 @@ class SearchQuery(object):
         preprocessed = (preprocess_search_term(w) for w in q.split())
         return [w for w in preprocessed if w]
 
-    def store(self):
+    def store(self, weight=1):
         '''
-        Store the query in the database.
+        Store the query using the configured backend.
+
+        The query is counted ``weight`` times.
+
+        Depending on the configuration, the query may be collected and
+        stored later together with other queries (see
+        ``writer.QueryWriter``).
         '''
-        log.debug('Remembering the search "{}"'.format(' '.join(self.words)))
-        terms = sorted((SearchTerm.get_or_create(term=t) for t in self.words),
-                       key=lambda t: t.term)
-        for i, term1 in enumerate(terms):
-            term1.count += 1
-            for term2 in terms[i + 1:]:
-                CoOccurrence.get_or_create(term1=term1, term2=term2).count += 1
-        Session.commit()
+        log.debug('Remembering the search "%s"', ' '.join(self.words))
+        get_writer().add(self.words, weight)
 
 
 def preprocess_search_term(term):
@@ -128,22 +162,56 @@ def reprocess():
 
     Passes all stored search terms to all implementations of the
     ``ISearchTermPreprocessor`` interface. Terms that are rejected are
-    deleted from the database, changed terms are stored.
+    deleted, changed terms are stored.
 
     Useful after changing a preprocessor.
     '''
     log.debug('Reprocessing stored search terms')
-    for term in Session.query(SearchTerm).yield_per(100):
-        preprocessed = preprocess_search_term(term.term)
-        if not preprocessed:
-            log.debug('Deleting {}'.format(term))
-            Session.delete(term)
-        else:
-            term.term = preprocessed
-    Session.commit()
+    get_backend().reprocess(preprocess_search_term)
     log.debug('Reprocessing complete')
 
 
+def store_search(query_string, client=None, user_agent=None):
+    '''
+    Store a search query, subject to admission and sampling.
+
+    ``client`` identifies the user or host that sent the query (see
+    ``admission.get_client``) and ``user_agent`` is the user agent of the
+    request.
+
+    Returns True if the query was stored and False if it was rejected
+    or not sampled. Errors of the backend are propagated.
+    '''
+    with _store_duration.time():
+        result = _store_search(query_string, client, user_agent)
+    _store_results.inc(result=result)
+    return result == 'stored'
+
+
+def _store_search(query_string, client, user_agent):
+    with span('tokenize'):
+        query = SearchQuery(query_string)
+    # Reject duplicates (for example if a user refines the results of a
+    # text search via facets) and bot traffic before any database work is
+    # done.
+    with span('admission'):
+        admitted = get_admission_filter().admit(client, query.words,
+                                                user_agent)
+    if not admitted:
+        return 'rejected'
+    writer = get_writer()
+    with span('sampling'):
+        sampler = get_sampler()
+        sampler.adjust(writer)
+        weight = sampler.sample()
+    if not weight:
+        log.debug('Search query not sampled')
+        return 'not_sampled'
+    with span('store'):
+        query.store(weight)
+    return 'stored'
+
+
 def _is_user_text_search(context, query):
     '''
     Decide if a search query is a user-initiated text search.
@@ -181,8 +249,9 @@ class SearchSuggestionsPlugin(plugins.SingletonPlugin):
     # IPackageController
     #
 
+    @instrumented('search_suggestions.after_search')
     def after_search(self, search_results, search_params):
-        log.debug('after_search {}'.format(search_params))
+        log.debug('after_search %s', search_params)
         if not toolkit.asbool(get_config('search_suggestions.store_queries',
                               True)):
             return search_results
@@ -191,11 +260,10 @@ class SearchSuggestionsPlugin(plugins.SingletonPlugin):
             if not _is_user_text_search(toolkit.c, q):
                 log.debug('Not a user search')
                 return search_results
-            # TODO: If a user performs a text-based search and then
-            # continuously refines the result via facets then we end up with
-            # many entries for basically the same search, which might screw up
-            # our scoring.
-            SearchQuery(q).store()
+            with trace('search_suggestions.after_search', q=q), \
+                    profile('search_suggestions.after_search', q=q):
+                store_search(q, get_client(toolkit.c, toolkit.request),
+                             toolkit.request.environ.get('HTTP_USER_AGENT'))
         except Exception:
             # Log exception but don't cause search request to fail
             log.exception('An exception occurred while storing a search query')
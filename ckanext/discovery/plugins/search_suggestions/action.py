@@ -7,140 +7,200 @@ import collections
 import itertools
 import logging
 
-from sqlalchemy.orm.exc import NoResultFound
-
 from ckan.logic import validate
 import ckan.plugins.toolkit as toolkit
-from ckan.lib.navl.validators import not_missing, not_empty
+from ckan.lib.navl.validators import ignore_missing, not_missing, not_empty
+from ckan.logic.validators import boolean_validator
 
-from .model import SearchTerm, CoOccurrence
+from .backends import get_backend
 from . import SearchQuery
 from .. import get_config
+from ...cache import TTLCache
+from ...deadline import Deadline, DeadlineExceeded
+from ...instrumentation import instrumented
+from ...metrics import get_registry
+from ...profiling import profile
+from ...tracing import span, trace
 
 
 log = logging.getLogger(__name__)
 
+_suggest_duration = get_registry().histogram(
+    'discovery_search_suggest_duration_seconds',
+    'Duration of search suggestion requests')
+
 
 def search_suggest_schema():
     return {
-        'q': [not_missing, unicode]
+        'q': [not_missing, unicode],
+        'profile': [ignore_missing, boolean_validator],
     }
 
 
 @toolkit.auth_allow_anonymous_access
 def search_suggest_auth(context, data_dict):
-    # Allow access by everybody
+    # Allow access by everybody. Sysadmins don't reach this function, so
+    # profiling is only available to them.
+    if toolkit.asbool(data_dict.get('profile', False)):
+        return {'success': False,
+                'msg': 'Only sysadmins can profile search suggestions'}
     return {'success': True}
 
 
+def _similarity(term1, term2, count):
+    '''
+    The similarity of two terms.
+
+    ``term1`` and ``term2`` are ``Term`` instances and ``count`` is the
+    number of their co-occurrences.
+
+    Returns a float between 0 (no similarity) and 1 (terms only occur
+    in combination).
+    '''
+    return count / (term1.count + term2.count - count)
+
+
 def _get_score(terms, weights=None):
     '''
     Compute similarity score for a set of terms.
 
-    ``terms`` is an iterable of ``SearchTerm`` instances.
+    ``terms`` is an iterable of ``Term`` instances.
 
     ``weights`` is an optional list of weights of the same length as
     ``terms``. If it is not given every term has the same weight.
     '''
-    log.debug('Scoring {}'.format([t.term for t in terms]))
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug('Scoring %s', [t.term for t in terms])
     weights = weights or ([1] * len(terms))
     weighted_terms = sorted(zip(terms, weights), key=lambda x: x[0].term)
+    pairs = [(x1, x2) for i, x1 in enumerate(weighted_terms[:-1])
+             for x2 in weighted_terms[i + 1:]]
+    # Fetch all co-occurrence counts at once instead of one per pair
+    if pairs:
+        counts = get_backend().get_cooccurrence_counts(
+            (term1.term, term2.term) for (term1, _), (term2, _) in pairs)
     score = 0
-    for i, (term1, weight1) in enumerate(weighted_terms[:-1]):
-        for term2, weight2 in weighted_terms[i + 1:]:
-            try:
-                coocc = CoOccurrence.one(term1=term1, term2=term2)
-                score += (weight1 + weight2) * coocc.similarity
-            except NoResultFound:
-                log.debug('  {} and {} have no co-occurrences'.format(
-                         term1.term, term2.term))
-                pass
-    log.debug('  Non-normalized score is {}'.format(score))
+    for (term1, weight1), (term2, weight2) in pairs:
+        count = counts[(term1.term, term2.term)]
+        if count:
+            score += (weight1 + weight2) * _similarity(term1, term2, count)
+        elif debug:
+            log.debug('  %s and %s have no co-occurrences', term1.term,
+                      term2.term)
+    log.debug('  Non-normalized score is %s', score)
     try:
         score = score / (sum(weights) * (len(terms) - 1))
     except ZeroDivisionError:
         # Either only one term or all weights are zero
         score = 0
 
-    log.debug('  Final score is {}'.format(score))
+    log.debug('  Final score is %s', score)
     return score
 
 
-@toolkit.side_effect_free
-@validate(search_suggest_schema)
-def search_suggest_action(context, data_dict):
+_cache = None
+
+
+def _get_cache():
     '''
-    Search query auto-completion and suggestions.
+    Get the cache for suggestions.
 
-    Takes a single string parameter ``q`` which contains the search
-    query.
+    The cache stores the results of complete suggestion computations.
+    They are only used when the time budget of a request is exhausted.
+    '''
+    global _cache
+    max_size = int(get_config('search_suggestions.cache_size', 1000))
+    ttl = float(get_config('search_suggestions.cache_ttl', 300))
+    if _cache is None or _cache.max_size != max_size or _cache.ttl != ttl:
+        _cache = TTLCache(max_size, ttl)
+    return _cache
 
-    Returns a list of dictionaries, sorted decreasingly by relevance.
-    Each dictionary contains two keys ``label`` and ``value``, which
-    contain an HTML string and a plain-text value for the suggestion.
 
-    Statistics show that almost all search queries contain 3 terms or
-    less. Hence this function only takes the last 4 terms into account
-    when computing similarity scores.
+#: Number of degraded responses by the kind of fallback that was used
+degraded_responses = collections.Counter()
 
-    The maximum number of suggestions offered can be set via the config
-    option ``ckanext.discovery.search_suggestions.limit``, it defaults
-    to 4.
-    '''
-    log.debug('discovery_search_suggest {!r}'.format(data_dict['q']))
-    toolkit.check_access('discovery_search_suggest', context, data_dict)
+get_registry().counter_function(
+    'discovery_search_suggest_degraded_total',
+    'Search suggestion requests that exceeded their time budget',
+    lambda: dict(degraded_responses), ['fallback'])
 
-    # In the following, a "term" is always an instance of ``SearchTerm``,
-    # and a "word" is a normalized search token.
 
-    query = SearchQuery(data_dict['q'])
-    if not query.words:
-        return []
-    limit = int(get_config('search_suggestions.limit', 4))
+def _cache_requests():
+    if _cache is None:
+        return {}
+    return {'hit': _cache.hits, 'miss': _cache.misses}
 
-    log.debug('words = {}'.format(query.words))
-    log.debug('is_last_word_complete = {}'.format(query.is_last_word_complete))
-    log.debug(b'context_terms = {}'.format(query.context_terms))
 
-    # Maps tuples of terms to scores
-    scores = {}
+get_registry().counter_function(
+    'discovery_search_suggest_cache_requests_total',
+    'Lookups in the cache of search suggestions', _cache_requests, ['result'])
 
-    #
-    # Step 1: Auto-complete the last word
-    #
 
-    ac_terms = []
-    if not query.is_last_word_complete:
-        ac_terms = SearchTerm.by_prefix(query.last_word)
-        ac_terms = [t for t in ac_terms if t.term not in query.words[:-1]]
-
-        # Score auto-completions
-        total_count = sum(t.count for t in ac_terms)
-        num_context = len(query.context_terms)
-        factor = 1 / (1 + num_context)
-        for t in ac_terms:
-            if t.term == query.last_word:
-                continue
-            term_score = t.count / total_count
-            context_score = _get_score(query.context_terms.union((t,)))
-            scores[(t,)] = factor * (term_score + num_context * context_score)
-    log.debug(b'ac_terms = {}'.format(ac_terms))
+def _degrade(key, deadline, partial=None):
+    '''
+    Get a fallback result after the time budget has been exhausted.
 
-    #
-    # Step 2: Suggest an additional search term
-    #
+    In order of preference, the fallback is the cached result for the
+    same query, the given partial result (auto-completions only) or an
+    empty list.
+    '''
+    result = _get_cache().get(key)
+    if result is not None:
+        kind = 'cache'
+    elif partial is not None:
+        kind = 'autocomplete'
+        result = partial
+    else:
+        kind = 'empty'
+        result = []
+    degraded_responses[kind] += 1
+    log.warning(('Search suggestions for {!r} exceeded the time budget after '
+                '{:.0f}ms, using fallback "{}"').format(key[0],
+                deadline.elapsed() * 1000, kind))
+    return result
+
+
+def _autocomplete(query, backend, scores):
+    '''
+    Auto-complete the last word of a query.
+
+    Returns the list of auto-completion terms. Their scores are stored
+    in ``scores``.
+    '''
+    if query.is_last_word_complete:
+        return []
+    ac_terms = backend.get_terms_by_prefix(query.last_word)
+    ac_terms = [t for t in ac_terms if t.term not in query.words[:-1]]
+
+    # Score auto-completions
+    total_count = sum(t.count for t in ac_terms)
+    num_context = len(query.context_terms)
+    factor = 1 / (1 + num_context)
+    for t in ac_terms:
+        if t.term == query.last_word:
+            continue
+        term_score = t.count / total_count
+        context_score = _get_score(query.context_terms.union((t,)))
+        scores[(t,)] = factor * (term_score + num_context * context_score)
+    return ac_terms
+
+
+def _extend(query, backend, ac_terms, scores, limit, deadline):
+    '''
+    Suggest an additional search term.
 
+    The scores of the extension candidates are stored in ``scores``.
+    Raises ``DeadlineExceeded`` if the deadline expires.
+    '''
     # Get extension candidates
     ext_terms = set()
-    for term in query.context_terms.union(ac_terms):
-        cooccs = CoOccurrence.for_term(term) \
-                             .order_by(CoOccurrence.count) \
-                             .limit(limit)
-        for coocc in cooccs:
-            other = coocc.term2 if coocc.term1 == term else coocc.term1
-            ext_terms.add(other)
+    with span('extension'):
+        for term in query.context_terms.union(ac_terms):
+            deadline.check()
+            ext_terms.update(backend.get_cooccurring_terms(term.term, limit))
     ext_terms = [t for t in ext_terms if t.term not in query.words]
-    log.debug(b'ext_terms = {}'.format(ext_terms))
+    log.debug(b'ext_terms = %s', ext_terms)
 
     # Combine extension candidates with auto-completion suggestions
     if ac_terms:
@@ -148,7 +208,7 @@ def search_suggest_action(context, data_dict):
                              if x[0] != x[1]]
     else:
         ac_ext_candidates = [(t,) for t in ext_terms]
-    log.debug(b'ac_ext_candidates = {}'.format(ac_ext_candidates))
+    log.debug(b'ac_ext_candidates = %s', ac_ext_candidates)
 
     # When ranking extensions, their relation to tokens the user has
     # already finished is more important than to an auto-completion
@@ -158,21 +218,23 @@ def search_suggest_action(context, data_dict):
     weights.update((w, 1) for w in query.words)
 
     # Score extension candidates
-    for ac_ext_terms in ac_ext_candidates:
-        terms = list(query.context_terms.union(ac_ext_terms))
-        score = _get_score(terms, [weights[t.term] for t in terms])
-        if score > 0:
-            scores[ac_ext_terms] = score
-    log.debug(b'scores = {}'.format(scores))
+    with span('scoring'):
+        for ac_ext_terms in ac_ext_candidates:
+            deadline.check()
+            terms = list(query.context_terms.union(ac_ext_terms))
+            score = _get_score(terms, [weights[t.term] for t in terms])
+            if score > 0:
+                scores[ac_ext_terms] = score
 
-    #
-    # Step 3: Format suggestions for output
-    #
 
+def _format(query, ac_terms, scores, limit):
+    '''
+    Format scored suggestions for output.
+    '''
     suggestions = sorted(scores.iterkeys(), key=scores.get, reverse=True)
     suggestions = list(suggestions)[:limit]
     suggestions = [' '.join([t.term for t in terms]) for terms in suggestions]
-    log.debug('suggestions = {}'.format(suggestions))
+    log.debug('suggestions = %s', suggestions)
     if ac_terms:
         prefix = query.string
 
@@ -193,3 +255,120 @@ def search_suggest_action(context, data_dict):
         for s in suggestions
     ]
 
+
+def get_suggestions(query_string, limit=None, time_budget=None):
+    '''
+    Compute the suggestions for a search query.
+
+    This is the implementation of ``discovery_search_suggest`` without
+    the action function machinery (validation and authorization), so
+    that it can be called directly, for example from benchmarks.
+
+    ``limit`` is the maximum number of suggestions and ``time_budget``
+    the time available in seconds. They default to the values from the
+    configuration.
+
+    Returns a list of suggestions in the format described in
+    ``search_suggest_action``.
+    '''
+    if limit is None:
+        limit = int(get_config('search_suggestions.limit', 4))
+    if time_budget is None:
+        time_budget = float(get_config('search_suggestions.time_budget',
+                                       0)) / 1000
+    key = (query_string.lower(), limit)
+
+    # In the following, a "term" is always an instance of ``Term``, and a
+    # "word" is a normalized search token.
+
+    backend = get_backend()
+    with Deadline(time_budget) as deadline:
+        with span('tokenize'):
+            query = SearchQuery(query_string)
+        if not query.words:
+            return []
+
+        log.debug('words = %s', query.words)
+        log.debug('is_last_word_complete = %s', query.is_last_word_complete)
+
+        # Maps tuples of terms to scores
+        scores = {}
+
+        #
+        # Step 1: Auto-complete the last word
+        #
+
+        try:
+            with span('context_terms'):
+                context_terms = query.context_terms
+            log.debug(b'context_terms = %s', context_terms)
+            with span('autocomplete'):
+                ac_terms = _autocomplete(query, backend, scores)
+        except DeadlineExceeded:
+            return _degrade(key, deadline)
+        log.debug(b'ac_terms = %s', ac_terms)
+
+        #
+        # Step 2: Suggest an additional search term
+        #
+
+        ac_scores = dict(scores)
+        try:
+            deadline.check()
+            _extend(query, backend, ac_terms, scores, limit, deadline)
+        except DeadlineExceeded:
+            partial = None
+            if ac_scores:
+                partial = _format(query, ac_terms, ac_scores, limit)
+            return _degrade(key, deadline, partial)
+        log.debug(b'scores = %s', scores)
+
+    #
+    # Step 3: Format suggestions for output
+    #
+
+    with span('formatting'):
+        result = _format(query, ac_terms, scores, limit)
+    _get_cache().set(key, result)
+    return result
+
+
+@toolkit.side_effect_free
+@validate(search_suggest_schema)
+@instrumented('discovery_search_suggest')
+def search_suggest_action(context, data_dict):
+    '''
+    Search query auto-completion and suggestions.
+
+    Takes a single string parameter ``q`` which contains the search
+    query.
+
+    Returns a list of dictionaries, sorted decreasingly by relevance.
+    Each dictionary contains two keys ``label`` and ``value``, which
+    contain an HTML string and a plain-text value for the suggestion.
+
+    Statistics show that almost all search queries contain 3 terms or
+    less. Hence this function only takes the last 4 terms into account
+    when computing similarity scores.
+
+    The maximum number of suggestions offered can be set via the config
+    option ``ckanext.discovery.search_suggestions.limit``, it defaults
+    to 4.
+
+    The time available for computing the suggestions can be limited via
+    ``ckanext.discovery.search_suggestions.time_budget`` (in
+    milliseconds). If the budget is exhausted then the remaining steps
+    are skipped and the previous result for the same query, only the
+    auto-completions, or no suggestions are returned instead.
+
+    Sysadmins can pass ``profile=true`` to capture a ``cProfile``
+    profile of the call, see ``ckanext.discovery.profiling``.
+    '''
+    log.debug('discovery_search_suggest %r', data_dict['q'])
+    toolkit.check_access('discovery_search_suggest', context, data_dict)
+    with _suggest_duration.time():
+        with trace('discovery_search_suggest', q=data_dict['q']), \
+                profile('discovery_search_suggest',
+                        force=data_dict.get('profile', False),
+                        q=data_dict['q']):
+            return get_suggestions(data_dict['q'])
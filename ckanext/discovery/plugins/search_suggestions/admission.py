@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+'''
+Admission of search queries for storage.
+
+The admission filter decides cheaply, without any database access,
+whether a search query should be stored at all. It rejects queries by
+crawlers, queries from clients that search too often, and queries that
+the same client has recently searched for already (for example when a
+user refines the results of a text search via facets).
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import logging
+import re
+import threading
+import time
+
+from .. import get_config
+from ...cache import TTLCache
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_USER_AGENTS = r'bot|crawl|spider|slurp|archiver'
+
+
+class AdmissionFilter(object):
+    '''
+    Decides whether a search query is stored.
+
+    A query is rejected if
+
+    * the client's user agent matches the regular expression
+      ``user_agents`` (case-insensitive),
+
+    * the client has sent more than ``rate_limit`` queries during the
+      last ``rate_window`` seconds (a ``rate_limit`` of 0 disables the
+      limit), or
+
+    * the client has searched for the same words during the last
+      ``ttl`` seconds. The order of the words is ignored.
+
+    At most ``max_size`` clients and queries are remembered.
+    '''
+    def __init__(self, ttl=600, max_size=10000,
+                 user_agents=DEFAULT_USER_AGENTS, rate_limit=0,
+                 rate_window=60):
+        self.user_agents = re.compile(user_agents, re.I) if user_agents \
+                           else None
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self._lock = threading.Lock()
+        self._fingerprints = TTLCache(max_size, ttl)
+        self._rates = TTLCache(max_size, rate_window)
+
+        #: Number of rejected queries by reason
+        self.rejected = collections.Counter()
+
+    def clear(self):
+        '''
+        Forget all remembered clients and queries.
+        '''
+        self._fingerprints.clear()
+        self._rates.clear()
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        log.debug('Search query not admitted for storage (%s)', reason)
+        return False
+
+    def admit(self, client, words, user_agent=None):
+        '''
+        Decide whether a search query is stored.
+
+        ``client`` identifies the client (see ``get_client``), ``words``
+        are the normalized words of the query and ``user_agent`` is the
+        client's user agent string.
+
+        Returns ``True`` if the query should be stored. The query is
+        then remembered for the duplicate check.
+        '''
+        if (self.user_agents is not None and user_agent
+                and self.user_agents.search(user_agent)):
+            return self._reject('user_agent')
+        fingerprint = (client, ' '.join(sorted(set(words))))
+        with self._lock:
+            if self.rate_limit:
+                now = time.time()
+                start, count = self._rates.get(client, (now, 0))
+                if now - start >= self.rate_window:
+                    start, count = now, 0
+                self._rates.set(client, (start, count + 1))
+                if count >= self.rate_limit:
+                    return self._reject('rate')
+            if fingerprint in self._fingerprints:
+                return self._reject('duplicate')
+            self._fingerprints.set(fingerprint, True)
+        return True
+
+
+def get_trusted_proxies():
+    '''
+    Get the addresses of the trusted reverse proxies.
+
+    Taken from ``ckanext.discovery.search_suggestions.trusted_proxies``
+    (a space-separated list of IP addresses). Returns a set.
+    '''
+    return set(get_config('search_suggestions.trusted_proxies', '').split())
+
+
+def get_client(context, request):
+    '''
+    Identify the client of a web request.
+
+    Logged in users are identified by their name, anonymous users by
+    their IP address. The ``X-Forwarded-For`` header is only used if the
+    request comes from a trusted reverse proxy (see
+    ``get_trusted_proxies``). In that case the right-most address in the
+    header that is not a trusted proxy is used, since clients can put
+    arbitrary addresses in front of it.
+    '''
+    if context.user:
+        return 'user:' + context.user
+    address = request.environ.get('REMOTE_ADDR', '')
+    trusted = get_trusted_proxies()
+    if address in trusted:
+        forwarded = request.environ.get('HTTP_X_FORWARDED_FOR', '')
+        for hop in reversed(forwarded.split(',')):
+            hop = hop.strip()
+            if hop:
+                address = hop
+                if hop not in trusted:
+                    break
+    return 'ip:' + address
+
+
+_filter = None
+_filter_options = None
+
+
+def get_admission_filter():
+    '''
+    Get the admission filter for search queries.
+
+    The filter is re-created if its configuration changes.
+    '''
+    global _filter, _filter_options
+    options = dict(
+        ttl=float(get_config('search_suggestions.admission.ttl', 600)),
+        max_size=int(get_config('search_suggestions.admission.max_size',
+                                10000)),
+        user_agents=get_config('search_suggestions.admission.user_agents',
+                               DEFAULT_USER_AGENTS),
+        rate_limit=int(get_config('search_suggestions.admission.rate_limit',
+                                  0)),
+        rate_window=float(get_config(
+                          'search_suggestions.admission.rate_window', 60)),
+    )
+    if _filter is None or _filter_options != options:
+        _filter = AdmissionFilter(**options)
+        _filter_options = options
+    return _filter
@@ -0,0 +1,300 @@
+# encoding: utf-8
+
+'''
+Storage backends for the search suggestion statistics.
+
+A backend stores how often each search term has been used and how often
+two search terms have been used together. The backend that is used is
+selected via the configuration option
+``ckanext.discovery.search_suggestions.backend``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import collections
+import importlib
+import itertools
+import logging
+
+from ... import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+#: A search term and the number of times it has been used.
+Term = collections.namedtuple('Term', ['term', 'count'])
+
+
+# Maps backend names to the classes that implement them. The classes are
+# given as ``module:class`` strings relative to this package so that the
+# modules of unused backends are never imported.
+BACKENDS = {
+    'postgresql': 'postgresql:PostgreSQLBackend',
+    'sqlite': 'sqlite:SQLiteBackend',
+    'memory': 'memory:MemoryBackend',
+    'redis': 'redis:RedisBackend',
+}
+
+DEFAULT_BACKEND = 'postgresql'
+
+_backend = None
+
+
+def get_backend():
+    '''
+    Get the configured storage backend.
+
+    The backend instance is created on the first call and re-used
+    afterwards. It is re-created if the configured backend changes.
+    '''
+    global _backend
+    name = get_config('search_suggestions.backend', DEFAULT_BACKEND)
+    if _backend is None or _backend.name != name:
+        _backend = _create_backend(name)
+    return _backend
+
+
+def _create_backend(name):
+    '''
+    Create a backend instance by name.
+    '''
+    try:
+        module_name, class_name = BACKENDS[name].split(':')
+    except KeyError:
+        raise ValueError('Unknown search suggestions backend "{}". '
+                         'Supported backends are: {}'.format(
+                             name, ', '.join(sorted(BACKENDS))))
+    module = importlib.import_module('.' + module_name, __name__)
+    log.debug('Using search suggestions backend "%s"', name)
+    return getattr(module, class_name).from_config()
+
+
+def count_words(words):
+    '''
+    Count the terms and co-occurrences in a list of words.
+
+    Duplicate words are only counted once.
+
+    Returns a tuple ``(terms, cooccurrences)``. ``terms`` is a dict that
+    maps each word to its count and ``cooccurrences`` is a dict that
+    maps lexicographically sorted pairs of words to their count. The
+    result can be passed directly to ``Backend.upsert``.
+    '''
+    words = sorted(set(words))
+    terms = dict.fromkeys(words, 1)
+    cooccurrences = {}
+    for i, word1 in enumerate(words):
+        for word2 in words[i + 1:]:
+            cooccurrences[(word1, word2)] = 1
+    return terms, cooccurrences
+
+
+def reprocess_counts(preprocess, terms, cooccurrences):
+    '''
+    Re-process term and co-occurrence counts.
+
+    ``preprocess`` is a callable that is called with each word. If it
+    returns a false value then the term and its co-occurrences are
+    dropped, otherwise the word is replaced by the return value. Terms
+    that are mapped onto the same word are merged.
+
+    ``terms`` is an iterable of ``Term`` instances and ``cooccurrences``
+    is an iterable of ``(word1, word2, count)`` tuples.
+
+    Returns a tuple ``(terms, cooccurrences)`` in the format expected
+    by ``Backend.upsert``.
+    '''
+    renamed = {}
+    new_terms = collections.Counter()
+    for term in terms:
+        preprocessed = preprocess(term.term)
+        if preprocessed:
+            renamed[term.term] = preprocessed
+            new_terms[preprocessed] += term.count
+    new_cooccurrences = collections.Counter()
+    for word1, word2, count in cooccurrences:
+        try:
+            pair = tuple(sorted((renamed[word1], renamed[word2])))
+        except KeyError:
+            # At least one of the terms has been rejected
+            continue
+        if pair[0] != pair[1]:
+            new_cooccurrences[pair] += count
+    return dict(new_terms), dict(new_cooccurrences)
+
+
+def _batches(iterable, size):
+    '''
+    Split an iterable into lists of at most ``size`` items.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Backend(object):
+    '''
+    Base class for storage backends.
+
+    All methods that take or return a pair of words expect the pair to
+    be sorted lexicographically.
+    '''
+    #: The name under which the backend is selected in the configuration
+    name = None
+
+    @classmethod
+    def from_config(cls):
+        '''
+        Create a backend instance using the CKAN configuration.
+        '''
+        return cls()
+
+    def create_tables(self):
+        '''
+        Create the storage structures if they don't exist already.
+
+        Existing data is kept.
+        '''
+        pass
+
+    def clear(self):
+        '''
+        Delete all stored terms and co-occurrences.
+        '''
+        raise NotImplementedError()
+
+    def upsert(self, terms, cooccurrences):
+        '''
+        Increment the counts of terms and co-occurrences.
+
+        ``terms`` is a dict that maps words to count increments.
+        ``cooccurrences`` is a dict that maps sorted pairs of words to
+        count increments. Terms and co-occurrences that don't exist yet
+        are created.
+        '''
+        raise NotImplementedError()
+
+    def bulk_upsert(self, records, batch_size=10000):
+        '''
+        Increment the counts of many terms and co-occurrences.
+
+        ``records`` is an iterable of ``(word1, word2, count)`` tuples.
+        For terms ``word2`` is ``None``, for co-occurrences the pair of
+        words must be sorted. The records are consumed in batches of
+        ``batch_size``, so memory usage does not depend on the number of
+        records.
+
+        Returns the number of records.
+        '''
+        num = 0
+        for batch in _batches(records, batch_size):
+            terms = collections.Counter()
+            cooccurrences = collections.Counter()
+            for word1, word2, count in batch:
+                if word2 is None:
+                    terms[word1] += count
+                else:
+                    cooccurrences[(word1, word2)] += count
+            self.upsert(dict(terms), dict(cooccurrences))
+            num += len(batch)
+        return num
+
+    def store_words(self, words):
+        '''
+        Store the words of a single search query.
+        '''
+        self.upsert(*count_words(words))
+
+    def get_terms(self, words):
+        '''
+        Get the stored terms for some words.
+
+        Returns a list of ``Term`` instances. Words that have not been
+        stored are ignored.
+        '''
+        raise NotImplementedError()
+
+    def get_terms_by_prefix(self, prefix):
+        '''
+        Get all stored terms that start with a prefix.
+
+        Returns a list of ``Term`` instances.
+        '''
+        raise NotImplementedError()
+
+    def get_cooccurring_terms(self, word, limit):
+        '''
+        Get the terms that co-occur with a word.
+
+        Returns a list of at most ``limit`` ``Term`` instances, sorted by
+        increasing co-occurrence count.
+        '''
+        raise NotImplementedError()
+
+    def get_cooccurrence_count(self, word1, word2):
+        '''
+        Get the number of co-occurrences of two words.
+
+        Returns 0 if the words have never been used together.
+        '''
+        raise NotImplementedError()
+
+    def get_cooccurrence_counts(self, pairs):
+        '''
+        Get the numbers of co-occurrences of several pairs of words.
+
+        ``pairs`` is an iterable of pairs of words. Returns a dict that
+        maps each pair to the number of its co-occurrences (0 if the words
+        have never been used together).
+
+        Backends should override this method if they can retrieve the
+        counts of many pairs at once.
+        '''
+        return {pair: self.get_cooccurrence_count(*pair) for pair in pairs}
+
+    def iter_terms(self):
+        '''
+        Iterate over all stored terms.
+
+        Yields ``Term`` instances.
+        '''
+        raise NotImplementedError()
+
+    def iter_cooccurrences(self):
+        '''
+        Iterate over all stored co-occurrences.
+
+        Yields tuples ``(word1, word2, count)``.
+        '''
+        raise NotImplementedError()
+
+    def reprocess(self, preprocess):
+        '''
+        Re-process the stored terms.
+
+        ``preprocess`` is a callable that is called with each stored
+        word. If it returns a false value then the term and its
+        co-occurrences are deleted. Otherwise the term is replaced by the
+        return value.
+        '''
+        terms, cooccurrences = reprocess_counts(preprocess,
+                                                self.iter_terms(),
+                                                self.iter_cooccurrences())
+        self.clear()
+        self.upsert(terms, cooccurrences)
+
+    def prune(self, min_count):
+        '''
+        Delete rarely used terms.
+
+        All terms that have been used less than ``min_count`` times are
+        deleted, together with their co-occurrences.
+
+        Returns the number of deleted terms.
+        '''
+        raise NotImplementedError()
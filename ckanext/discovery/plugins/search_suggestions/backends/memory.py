@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+'''
+In-memory storage backend for search suggestions.
+
+All statistics are kept in the memory of the current process and are
+lost when it terminates. This backend is mostly useful for tests and
+benchmarks.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bisect
+import collections
+import threading
+
+from . import Backend, Term
+
+
+class MemoryBackend(Backend):
+    '''
+    Storage backend that keeps all data in memory.
+    '''
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # Maps words to counts
+            self._terms = {}
+
+            # Sorted list of all words for prefix lookups
+            self._words = []
+
+            # Maps sorted pairs of words to counts
+            self._cooccurrences = {}
+
+            # Maps each word to the set of words it co-occurs with
+            self._neighbours = collections.defaultdict(set)
+
+    def _add_term(self, word, count):
+        if word not in self._terms:
+            bisect.insort(self._words, word)
+            self._terms[word] = 0
+        self._terms[word] += count
+
+    def _add_cooccurrence(self, word1, word2, count):
+        pair = (word1, word2)
+        self._cooccurrences[pair] = self._cooccurrences.get(pair, 0) + count
+        self._neighbours[word1].add(word2)
+        self._neighbours[word2].add(word1)
+
+    def _delete_term(self, word):
+        del self._terms[word]
+        del self._words[bisect.bisect_left(self._words, word)]
+        for other in self._neighbours.pop(word, ()):
+            self._neighbours[other].discard(word)
+            del self._cooccurrences[tuple(sorted((word, other)))]
+
+    def upsert(self, terms, cooccurrences):
+        with self._lock:
+            for word, count in terms.iteritems():
+                self._add_term(word, count)
+            for (word1, word2), count in cooccurrences.iteritems():
+                for word in (word1, word2):
+                    if word not in self._terms:
+                        self._add_term(word, 0)
+                self._add_cooccurrence(word1, word2, count)
+
+    def get_terms(self, words):
+        with self._lock:
+            return [Term(w, self._terms[w]) for w in set(words)
+                    if w in self._terms]
+
+    def get_terms_by_prefix(self, prefix):
+        with self._lock:
+            terms = []
+            i = bisect.bisect_left(self._words, prefix)
+            for word in self._words[i:]:
+                if not word.startswith(prefix):
+                    break
+                terms.append(Term(word, self._terms[word]))
+            return terms
+
+    def get_cooccurring_terms(self, word, limit):
+        with self._lock:
+            others = sorted(
+                self._neighbours.get(word, ()),
+                key=lambda w: self._cooccurrences[tuple(sorted((word, w)))]
+            )
+            return [Term(w, self._terms[w]) for w in others[:limit]]
+
+    def get_cooccurrence_count(self, word1, word2):
+        with self._lock:
+            return self._cooccurrences.get((word1, word2), 0)
+
+    def get_cooccurrence_counts(self, pairs):
+        with self._lock:
+            return {pair: self._cooccurrences.get(pair, 0) for pair in pairs}
+
+    def iter_terms(self):
+        with self._lock:
+            terms = [Term(w, self._terms[w]) for w in self._words]
+        return iter(terms)
+
+    def iter_cooccurrences(self):
+        with self._lock:
+            cooccurrences = [(w1, w2, c) for (w1, w2), c
+                             in self._cooccurrences.iteritems()]
+        return iter(cooccurrences)
+
+    def reprocess(self, preprocess):
+        with self._lock:
+            super(MemoryBackend, self).reprocess(preprocess)
+
+    def prune(self, min_count):
+        with self._lock:
+            rare = [w for w, c in self._terms.iteritems() if c < min_count]
+            for word in rare:
+                self._delete_term(word)
+            return len(rare)
@@ -0,0 +1,401 @@
+# encoding: utf-8
+
+'''
+PostgreSQL storage backend for search suggestions.
+
+Stores the statistics in CKAN's database using the tables defined in
+``ckanext.discovery.plugins.search_suggestions.model``. Prefix lookups
+use PostgreSQL's full text search.
+
+All database access uses the extension's own engine and session (see
+``ckanext.discovery.model``) so that storing search statistics never
+interferes with CKAN's own transactions. Writes are performed in a
+single short transaction per batch.
+
+The reads required for computing suggestions are sent to the read
+replica if one is configured (see ``ckanext.discovery.model.run_read``).
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+from sqlalchemy import bindparam, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from . import _batches, Backend, reprocess_counts, Term
+from ..model import SearchTerm, CoOccurrence, create_tables
+from ....model import get_session, run_read, transaction
+
+
+log = logging.getLogger(__name__)
+
+_terms = SearchTerm.__table__
+_cooccurrences = CoOccurrence.__table__
+
+# Maximum number of attempts for an upsert. An upsert has to be retried if
+# a concurrent transaction has inserted one of the same rows.
+MAX_UPSERT_ATTEMPTS = 3
+
+# Number of terms or co-occurrences that are written at once by
+# ``reprocess``
+REPROCESS_BATCH_SIZE = 1000
+
+# Statement that blocks concurrent writes until the end of the transaction
+_LOCK_TABLES = '''
+    LOCK TABLE {terms}, {cooccurrences} IN SHARE ROW EXCLUSIVE MODE
+'''.format(terms=SearchTerm.__tablename__,
+           cooccurrences=CoOccurrence.__tablename__)
+
+# Statements that merge the records in the staging table of a bulk upsert
+# into the actual tables.
+_BULK_MERGE = [
+    _LOCK_TABLES,
+    '''
+    CREATE TEMPORARY TABLE discovery_import_term ON COMMIT DROP AS
+    SELECT word AS term, SUM(count) AS count FROM (
+        SELECT word1 AS word, count FROM discovery_import
+        WHERE word2 IS NULL
+        UNION ALL
+        SELECT word1, 0 FROM discovery_import WHERE word2 IS NOT NULL
+        UNION ALL
+        SELECT word2, 0 FROM discovery_import WHERE word2 IS NOT NULL
+    ) AS words GROUP BY word
+    ''',
+    '''
+    UPDATE {terms} SET count = {terms}.count + i.count
+    FROM discovery_import_term AS i
+    WHERE {terms}.term = i.term AND i.count <> 0
+    ''',
+    '''
+    INSERT INTO {terms} (term, count)
+    SELECT i.term, i.count FROM discovery_import_term AS i
+    WHERE NOT EXISTS (SELECT 1 FROM {terms} WHERE {terms}.term = i.term)
+    ''',
+    '''
+    CREATE TEMPORARY TABLE discovery_import_cooccurrence ON COMMIT DROP AS
+    SELECT t1.id AS term1_id, t2.id AS term2_id, SUM(i.count) AS count
+    FROM discovery_import AS i
+    JOIN {terms} AS t1 ON t1.term = i.word1
+    JOIN {terms} AS t2 ON t2.term = i.word2
+    WHERE i.word2 IS NOT NULL
+    GROUP BY t1.id, t2.id
+    ''',
+    '''
+    UPDATE {cooccurrences} SET count = {cooccurrences}.count + i.count
+    FROM discovery_import_cooccurrence AS i
+    WHERE {cooccurrences}.term1_id = i.term1_id
+    AND {cooccurrences}.term2_id = i.term2_id
+    ''',
+    '''
+    INSERT INTO {cooccurrences} (term1_id, term2_id, count)
+    SELECT i.term1_id, i.term2_id, i.count
+    FROM discovery_import_cooccurrence AS i
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {cooccurrences} AS c
+        WHERE c.term1_id = i.term1_id AND c.term2_id = i.term2_id
+    )
+    ''',
+]
+_BULK_MERGE = [sql.format(terms=SearchTerm.__tablename__,
+                          cooccurrences=CoOccurrence.__tablename__)
+               for sql in _BULK_MERGE]
+
+
+def _copy_escape(value):
+    '''
+    Escape a value for PostgreSQL's ``COPY`` text format.
+    '''
+    if value is None:
+        return b'\\N'
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r').encode('utf-8'))
+
+
+class _CopyFile(object):
+    '''
+    File-like object that provides records for ``COPY ... FROM STDIN``.
+
+    The records are converted lazily, so they don't have to be held in
+    memory.
+    '''
+    def __init__(self, records):
+        self._lines = (b'\t'.join([_copy_escape(word1), _copy_escape(word2),
+                                   b'{:d}'.format(count)]) + b'\n'
+                       for word1, word2, count in records)
+        self._buffer = b''
+
+        #: Number of records that have been read
+        self.num = 0
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+            self.num += 1
+            chunks.append(line)
+            length += len(line)
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class PostgreSQLBackend(Backend):
+    '''
+    Storage backend using CKAN's PostgreSQL database.
+    '''
+    name = 'postgresql'
+
+    def create_tables(self):
+        create_tables()
+
+    def clear(self):
+        with transaction() as conn:
+            # Co-occurrences are removed via ``ON DELETE CASCADE``
+            conn.execute(_terms.delete())
+
+    def upsert(self, terms, cooccurrences):
+        for attempt in range(1, MAX_UPSERT_ATTEMPTS + 1):
+            try:
+                with transaction() as conn:
+                    ids = self._upsert_terms(conn, terms, cooccurrences)
+                    self._upsert_cooccurrences(conn, ids, cooccurrences)
+                return
+            except IntegrityError:
+                if attempt == MAX_UPSERT_ATTEMPTS:
+                    raise
+                log.debug('Concurrent insert during upsert, retrying')
+
+    def bulk_upsert(self, records, batch_size=10000):
+        '''
+        Increment the counts of many terms and co-occurrences.
+
+        The records are streamed into a temporary staging table via
+        ``COPY`` and then merged into the actual tables using a few
+        set-based statements, all in a single transaction. Concurrent
+        writes are blocked during the merge.
+        '''
+        with transaction() as conn:
+            conn.execute('''
+                CREATE TEMPORARY TABLE discovery_import (
+                    word1 TEXT NOT NULL,
+                    word2 TEXT,
+                    count INTEGER NOT NULL
+                ) ON COMMIT DROP
+            ''')
+            copy_file = _CopyFile(records)
+            cursor = conn.connection.cursor()
+            try:
+                cursor.copy_expert('COPY discovery_import FROM STDIN',
+                                   copy_file, size=1024 * 1024)
+            finally:
+                cursor.close()
+            log.debug('Merging {} records'.format(copy_file.num))
+            for sql in _BULK_MERGE:
+                conn.execute(sql)
+        return copy_file.num
+
+    def _upsert_terms(self, conn, terms, cooccurrences):
+        '''
+        Insert or update search terms.
+
+        Returns a dict that maps the words of all terms and co-occurrences
+        to their IDs.
+        '''
+        words = set(terms)
+        for pair in cooccurrences:
+            words.update(pair)
+        if not words:
+            return {}
+        query = select([_terms.c.term, _terms.c.id])
+        ids = dict(conn.execute(query.where(_terms.c.term.in_(words)))
+                   .fetchall())
+        missing = sorted(words.difference(ids))
+        if missing:
+            conn.execute(_terms.insert(),
+                         [{'term': w, 'count': terms.get(w, 0)}
+                          for w in missing])
+            ids.update(conn.execute(query.where(_terms.c.term.in_(missing)))
+                       .fetchall())
+        # Rows are updated in a fixed order to avoid deadlocks between
+        # concurrent upserts.
+        updates = [{'_id': ids[w], '_count': terms[w]} for w in sorted(terms)
+                   if w not in missing and terms[w]]
+        if updates:
+            conn.execute(_terms.update()
+                         .where(_terms.c.id == bindparam('_id'))
+                         .values(count=_terms.c.count + bindparam('_count')),
+                         updates)
+        return ids
+
+    def _upsert_cooccurrences(self, conn, ids, cooccurrences):
+        '''
+        Insert or update co-occurrences.
+
+        ``ids`` maps words to the IDs of their terms.
+        '''
+        if not cooccurrences:
+            return
+        counts = {(ids[w1], ids[w2]): c for (w1, w2), c
+                  in cooccurrences.iteritems()}
+        id_columns = tuple_(_cooccurrences.c.term1_id,
+                            _cooccurrences.c.term2_id)
+        existing = set(tuple(row) for row in conn.execute(
+                       select([_cooccurrences.c.term1_id,
+                               _cooccurrences.c.term2_id])
+                       .where(id_columns.in_(list(counts)))))
+        missing = sorted(set(counts).difference(existing))
+        if missing:
+            conn.execute(_cooccurrences.insert(), [
+                {'term1_id': id1, 'term2_id': id2, 'count': counts[(id1, id2)]}
+                for id1, id2 in missing
+            ])
+        updates = [{'_id1': id1, '_id2': id2, '_count': counts[(id1, id2)]}
+                   for id1, id2 in sorted(existing)]
+        if updates:
+            conn.execute(_cooccurrences.update()
+                         .where(_cooccurrences.c.term1_id == bindparam('_id1'))
+                         .where(_cooccurrences.c.term2_id == bindparam('_id2'))
+                         .values(count=_cooccurrences.c.count
+                                 + bindparam('_count')),
+                         updates)
+
+    def get_terms(self, words):
+        if not words:
+            return []
+
+        def read(session):
+            terms = session.query(SearchTerm) \
+                           .filter(SearchTerm.term.in_(words))
+            return [Term(t.term, t.count) for t in terms]
+
+        return run_read(read)
+
+    def get_terms_by_prefix(self, prefix):
+        def read(session):
+            terms = session.query(SearchTerm) \
+                           .filter(SearchTerm.has_prefix(prefix))
+            return [Term(t.term, t.count) for t in terms]
+
+        return run_read(read)
+
+    def get_cooccurring_terms(self, word, limit):
+        def read(session):
+            term = session.query(SearchTerm.id).filter_by(term=word).first()
+            if term is None:
+                return []
+            # Select the other terms directly instead of loading them via
+            # the relationships of each CoOccurrence
+            other = aliased(SearchTerm)
+            c = CoOccurrence
+            is_other = (((c.term1_id == term.id) & (c.term2_id == other.id))
+                        | ((c.term2_id == term.id) & (c.term1_id == other.id)))
+            rows = session.query(other.term, other.count) \
+                          .select_from(CoOccurrence) \
+                          .join(other, is_other) \
+                          .order_by(CoOccurrence.count) \
+                          .limit(limit)
+            return [Term(t, count) for t, count in rows]
+
+        return run_read(read)
+
+    def get_cooccurrence_count(self, word1, word2):
+        def read(session):
+            term1 = aliased(SearchTerm)
+            term2 = aliased(SearchTerm)
+            return session.query(CoOccurrence.count) \
+                          .join(term1, CoOccurrence.term1_id == term1.id) \
+                          .join(term2, CoOccurrence.term2_id == term2.id) \
+                          .filter(term1.term == word1, term2.term == word2) \
+                          .scalar()
+
+        return run_read(read) or 0
+
+    def get_cooccurrence_counts(self, pairs):
+        pairs = list(set(pairs))
+        if not pairs:
+            return {}
+
+        def read(session):
+            term1 = aliased(SearchTerm)
+            term2 = aliased(SearchTerm)
+            rows = session.query(term1.term, term2.term, CoOccurrence.count) \
+                          .select_from(CoOccurrence) \
+                          .join(term1, CoOccurrence.term1_id == term1.id) \
+                          .join(term2, CoOccurrence.term2_id == term2.id) \
+                          .filter(tuple_(term1.term, term2.term).in_(pairs))
+            return {(word1, word2): count for word1, word2, count in rows}
+
+        counts = run_read(read)
+        return {pair: counts.get(pair, 0) for pair in pairs}
+
+    def iter_terms(self):
+        session = get_session()
+        try:
+            query = session.query(SearchTerm.term, SearchTerm.count)
+            for term, count in query.yield_per(100):
+                yield Term(term, count)
+        finally:
+            session.close()
+
+    def iter_cooccurrences(self):
+        term1 = aliased(SearchTerm)
+        term2 = aliased(SearchTerm)
+        session = get_session()
+        try:
+            query = session.query(term1.term, term2.term, CoOccurrence.count) \
+                           .select_from(CoOccurrence) \
+                           .join(term1, CoOccurrence.term1_id == term1.id) \
+                           .join(term2, CoOccurrence.term2_id == term2.id)
+            for row in query.yield_per(100):
+                yield tuple(row)
+        finally:
+            session.close()
+
+    def reprocess(self, preprocess):
+        '''
+        Re-process the stored terms.
+
+        See ``Backend.reprocess``. Terms that are mapped onto the same
+        word are merged. Everything happens in a single transaction,
+        concurrent writes are blocked.
+        '''
+        c = _cooccurrences
+        term1 = _terms.alias()
+        term2 = _terms.alias()
+        cooccurrences_query = select([term1.c.term, term2.c.term, c.c.count]) \
+            .select_from(c.join(term1, c.c.term1_id == term1.c.id)
+                          .join(term2, c.c.term2_id == term2.c.id))
+        with transaction() as conn:
+            conn.execute(_LOCK_TABLES)
+            terms = (Term(*row) for row in conn.execute(
+                     select([_terms.c.term, _terms.c.count])))
+            cooccurrences = (tuple(row) for row
+                             in conn.execute(cooccurrences_query))
+            terms, cooccurrences = reprocess_counts(preprocess, terms,
+                                                    cooccurrences)
+            # Co-occurrences are removed via ``ON DELETE CASCADE``
+            conn.execute(_terms.delete())
+            ids = {}
+            for words in _batches(sorted(terms), REPROCESS_BATCH_SIZE):
+                ids.update(self._upsert_terms(
+                           conn, {w: terms[w] for w in words}, {}))
+            for pairs in _batches(sorted(cooccurrences),
+                                  REPROCESS_BATCH_SIZE):
+                self._upsert_cooccurrences(
+                    conn, ids, {p: cooccurrences[p] for p in pairs})
+
+    def prune(self, min_count):
+        with transaction() as conn:
+            result = conn.execute(_terms.delete()
+                                  .where(_terms.c.count < min_count))
+            return result.rowcount
@@ -0,0 +1,315 @@
+# encoding: utf-8
+
+'''
+Redis storage backend for search suggestions.
+
+This backend mirrors the search statistics of another backend (the
+"source", usually ``postgresql``) into Redis and answers all read
+requests from there. Writes go to the source first and are then
+written through to Redis. The source remains the authoritative copy of
+the data: if Redis is unavailable then reads fall back to the source,
+and the mirror can be rebuilt at any time using ``sync``.
+
+The mirror is stored under versioned keys, so that a sync can build a new
+copy of the mirror while the old one is still being used. The following
+Redis keys are used (all prefixed with the configured key prefix):
+
+``version``
+    The version of the current mirror. It is set once a sync has been
+    completed. As long as it doesn't exist, reads use the source.
+
+``next_version``
+    Counter for the versions of the mirror.
+
+``<version>:terms:lex``
+    Sorted set containing all words with a score of 0, used for prefix
+    lookups via ``ZRANGEBYLEX``.
+
+``<version>:terms:count``
+    Sorted set that maps each word to its count.
+
+``<version>:neighbours:<word>``
+    Sorted set that maps each word that co-occurs with ``<word>`` to the
+    number of co-occurrences.
+
+Requires the ``redis`` Python package.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from . import Backend, Term, _create_backend
+from ... import get_config
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_URL = 'redis://localhost:6379/0'
+DEFAULT_PREFIX = 'ckanext-discovery:search_suggestions:'
+
+# Number of commands that are sent to Redis in a single pipeline during
+# a sync.
+SYNC_BATCH_SIZE = 1000
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class RedisBackend(Backend):
+    '''
+    Storage backend that mirrors another backend into Redis.
+
+    ``source`` is the backend instance that stores the authoritative
+    copy of the data and ``client`` is a Redis client instance.
+    '''
+    name = 'redis'
+
+    def __init__(self, source, client, prefix=DEFAULT_PREFIX):
+        self.source = source
+        self.client = client
+        self.prefix = prefix
+        self._version_key = prefix + 'version'
+        self._next_version_key = prefix + 'next_version'
+
+    @classmethod
+    def from_config(cls):
+        if redis is None:
+            raise RuntimeError('The "redis" search suggestions backend '
+                               + 'requires the "redis" Python package.')
+        source_name = get_config('search_suggestions.redis.source',
+                                 'postgresql')
+        if source_name == cls.name:
+            raise ValueError('The "redis" backend cannot use itself as its '
+                             + 'source.')
+        url = get_config('search_suggestions.redis.url', DEFAULT_URL)
+        prefix = get_config('search_suggestions.redis.prefix', DEFAULT_PREFIX)
+        return cls(_create_backend(source_name),
+                   redis.StrictRedis.from_url(url), prefix)
+
+    def _key(self, version, name):
+        return '{}{}:{}'.format(self.prefix, version, name)
+
+    def _lex_key(self, version):
+        return self._key(version, 'terms:lex')
+
+    def _count_key(self, version):
+        return self._key(version, 'terms:count')
+
+    def _neighbours_key(self, version, word):
+        return self._key(version, 'neighbours:' + word)
+
+    def _get_version(self):
+        '''
+        Get the version of the current mirror.
+
+        Returns None if no sync has been completed yet.
+        '''
+        return _decode(self.client.get(self._version_key))
+
+    def _mirror(self, pipe, version, terms, cooccurrences):
+        '''
+        Add term and co-occurrence increments to a Redis pipeline.
+        '''
+        lex_key = self._lex_key(version)
+        count_key = self._count_key(version)
+        words = set(terms)
+        for pair in cooccurrences:
+            words.update(pair)
+        for word in words:
+            # Raw commands are used because the signatures of the
+            # corresponding client methods differ between redis-py
+            # versions.
+            pipe.execute_command('ZADD', lex_key, 0, word)
+            pipe.execute_command('ZINCRBY', count_key, terms.get(word, 0),
+                                 word)
+        for (word1, word2), count in cooccurrences.iteritems():
+            pipe.execute_command('ZINCRBY',
+                                 self._neighbours_key(version, word1),
+                                 count, word2)
+            pipe.execute_command('ZINCRBY',
+                                 self._neighbours_key(version, word2),
+                                 count, word1)
+
+    def _delete_keys(self, keys):
+        for i in range(0, len(keys), SYNC_BATCH_SIZE):
+            self.client.delete(*keys[i:i + SYNC_BATCH_SIZE])
+
+    def _delete_old_versions(self, version):
+        '''
+        Delete the keys of mirror versions older than ``version``.
+
+        Keys of newer versions belong to syncs that are still running and
+        are kept. Keys of old, unversioned mirrors are deleted, too.
+        '''
+        control_keys = {self._version_key, self._next_version_key}
+        keys = []
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            key = _decode(key)
+            if key in control_keys:
+                continue
+            key_version = key[len(self.prefix):].split(':', 1)[0]
+            if key_version.isdigit() and int(key_version) >= version:
+                continue
+            keys.append(key)
+        self._delete_keys(keys)
+
+    def sync(self):
+        '''
+        Rebuild the Redis mirror from the source backend.
+
+        The new mirror is built under new keys while the old one is still
+        used for reading. Once it is complete, it replaces the old one.
+        Writes that happen during the sync may be missing from the new
+        mirror.
+        '''
+        log.debug('Syncing Redis mirror from "{}" backend'.format(
+                  self.source.name))
+        version = self.client.incr(self._next_version_key)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            num = 0
+            for term in self.source.iter_terms():
+                self._mirror(pipe, version, {term.term: term.count}, {})
+                num += 1
+                if num % SYNC_BATCH_SIZE == 0:
+                    pipe.execute()
+            for word1, word2, count in self.source.iter_cooccurrences():
+                self._mirror(pipe, version, {}, {(word1, word2): count})
+                num += 1
+                if num % SYNC_BATCH_SIZE == 0:
+                    pipe.execute()
+            pipe.execute()
+        except Exception:
+            # Remove the incomplete mirror
+            self._delete_keys(list(self.client.scan_iter(
+                              match=self._key(version, '*'))))
+            raise
+        self.client.set(self._version_key, version)
+        self._delete_old_versions(version)
+        log.debug('Sync complete')
+
+    def _get_counts(self, version, words):
+        '''
+        Get the counts of words from Redis.
+
+        Returns a list of ``Term`` instances for those words that exist.
+        '''
+        count_key = self._count_key(version)
+        pipe = self.client.pipeline(transaction=False)
+        for word in words:
+            pipe.zscore(count_key, word)
+        counts = pipe.execute()
+        return [Term(w, int(c)) for w, c in zip(words, counts)
+                if c is not None]
+
+    def _read(self, method_name, *args):
+        '''
+        Perform a read operation.
+
+        Calls the method of the given name on Redis. If Redis is not
+        available or if the mirror has not been synced yet then the
+        method of the source backend is used instead.
+        '''
+        try:
+            version = self._get_version()
+            if version is not None:
+                return getattr(self, '_redis_' + method_name)(version, *args)
+        except redis.RedisError:
+            log.exception('Redis is not available, reading from the "{}" '
+                          'backend instead'.format(self.source.name))
+        return getattr(self.source, method_name)(*args)
+
+    def create_tables(self):
+        self.source.create_tables()
+
+    def clear(self):
+        self.source.clear()
+        self.sync()
+
+    def upsert(self, terms, cooccurrences):
+        self.source.upsert(terms, cooccurrences)
+        try:
+            version = self._get_version()
+            if version is None:
+                return
+            pipe = self.client.pipeline(transaction=False)
+            self._mirror(pipe, version, terms, cooccurrences)
+            pipe.execute()
+        except redis.RedisError:
+            log.exception('Could not write to Redis mirror, run a sync to '
+                          'restore it')
+
+    def bulk_upsert(self, records, batch_size=10000):
+        # Use the source's bulk path and rebuild the mirror afterwards
+        num = self.source.bulk_upsert(records, batch_size)
+        self.sync()
+        return num
+
+    def get_terms(self, words):
+        return self._read('get_terms', list(set(words)))
+
+    def _redis_get_terms(self, version, words):
+        return self._get_counts(version, words)
+
+    def get_terms_by_prefix(self, prefix):
+        return self._read('get_terms_by_prefix', prefix)
+
+    def _redis_get_terms_by_prefix(self, version, prefix):
+        prefix = prefix.encode('utf-8')
+        words = self.client.zrangebylex(self._lex_key(version),
+                                        b'[' + prefix,
+                                        b'[' + prefix + b'\xff')
+        return self._get_counts(version, [_decode(w) for w in words])
+
+    def get_cooccurring_terms(self, word, limit):
+        return self._read('get_cooccurring_terms', word, limit)
+
+    def _redis_get_cooccurring_terms(self, version, word, limit):
+        if limit <= 0:
+            return []
+        # The neighbours are sorted by increasing co-occurrence count
+        words = self.client.zrange(self._neighbours_key(version, word), 0,
+                                   limit - 1)
+        return self._get_counts(version, [_decode(w) for w in words])
+
+    def get_cooccurrence_count(self, word1, word2):
+        return self._read('get_cooccurrence_count', word1, word2)
+
+    def _redis_get_cooccurrence_count(self, version, word1, word2):
+        return int(self.client.zscore(self._neighbours_key(version, word1),
+                                      word2) or 0)
+
+    def get_cooccurrence_counts(self, pairs):
+        return self._read('get_cooccurrence_counts', list(pairs))
+
+    def _redis_get_cooccurrence_counts(self, version, pairs):
+        pipe = self.client.pipeline(transaction=False)
+        for word1, word2 in pairs:
+            pipe.zscore(self._neighbours_key(version, word1), word2)
+        return {pair: int(count or 0)
+                for pair, count in zip(pairs, pipe.execute())}
+
+    def iter_terms(self):
+        return self.source.iter_terms()
+
+    def iter_cooccurrences(self):
+        return self.source.iter_cooccurrences()
+
+    def reprocess(self, preprocess):
+        self.source.reprocess(preprocess)
+        self.sync()
+
+    def prune(self, min_count):
+        num = self.source.prune(min_count)
+        self.sync()
+        return num
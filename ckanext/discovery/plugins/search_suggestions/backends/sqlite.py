@@ -0,0 +1,314 @@
+# encoding: utf-8
+
+'''
+SQLite storage backend for search suggestions.
+
+Stores the statistics in an SQLite database. Prefix lookups use SQLite's
+FTS5 full text search extension, which must be available in the SQLite
+library used by Python.
+
+The path of the database file is set via the configuration option
+``ckanext.discovery.search_suggestions.sqlite.path``. It defaults to
+``:memory:``, which uses a private in-memory database for each process.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+from . import Backend, Term, reprocess_counts
+from ... import get_config
+from ....instrumentation import record_statement
+
+
+log = logging.getLogger(__name__)
+
+
+_SCHEMA = '''
+    PRAGMA foreign_keys = ON;
+
+    CREATE TABLE IF NOT EXISTS discovery_searchterm (
+        id INTEGER PRIMARY KEY,
+        term TEXT NOT NULL UNIQUE,
+        count INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS discovery_searchterm_fts USING fts5(
+        term,
+        content='discovery_searchterm',
+        content_rowid='id',
+        tokenize="unicode61 remove_diacritics 0 tokenchars '-'"
+    );
+
+    -- Keep the full text index in sync with the terms table
+    CREATE TRIGGER IF NOT EXISTS discovery_searchterm_fts_insert
+    AFTER INSERT ON discovery_searchterm BEGIN
+        INSERT INTO discovery_searchterm_fts (rowid, term)
+        VALUES (new.id, new.term);
+    END;
+    CREATE TRIGGER IF NOT EXISTS discovery_searchterm_fts_delete
+    AFTER DELETE ON discovery_searchterm BEGIN
+        INSERT INTO discovery_searchterm_fts (discovery_searchterm_fts,
+                                              rowid, term)
+        VALUES ('delete', old.id, old.term);
+    END;
+    CREATE TRIGGER IF NOT EXISTS discovery_searchterm_fts_update
+    AFTER UPDATE OF term ON discovery_searchterm BEGIN
+        INSERT INTO discovery_searchterm_fts (discovery_searchterm_fts,
+                                              rowid, term)
+        VALUES ('delete', old.id, old.term);
+        INSERT INTO discovery_searchterm_fts (rowid, term)
+        VALUES (new.id, new.term);
+    END;
+
+    CREATE TABLE IF NOT EXISTS discovery_cooccurrence (
+        term1_id INTEGER NOT NULL
+            REFERENCES discovery_searchterm (id) ON DELETE CASCADE,
+        term2_id INTEGER NOT NULL
+            REFERENCES discovery_searchterm (id) ON DELETE CASCADE,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (term1_id, term2_id)
+    );
+    CREATE INDEX IF NOT EXISTS discovery_cooccurrence_term2_id_idx
+    ON discovery_cooccurrence (term2_id);
+'''
+
+
+# Maximum number of word pairs in a single query
+_MAX_PAIRS_PER_QUERY = 400
+
+# Number of rows fetched at once when iterating over a table
+_FETCH_BATCH_SIZE = 1000
+
+
+def _fts_prefix_query(prefix):
+    '''
+    Create an FTS5 query that matches terms starting with a prefix.
+    '''
+    return '^"{}"*'.format(prefix.replace('"', '""'))
+
+
+class _InstrumentedCursor(object):
+    '''
+    Wrapper for an SQLite cursor that records the executed statements.
+
+    See ``ckanext.discovery.instrumentation``.
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def _run(self, method, sql, params):
+        start = time.time()
+        result = method(sql, params)
+        record_statement(max(self._cursor.rowcount, 0), time.time() - start)
+        return result
+
+    def execute(self, sql, params=()):
+        return self._run(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, params):
+        return self._run(self._cursor.executemany, sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class SQLiteBackend(Backend):
+    '''
+    Storage backend using an SQLite database.
+    '''
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA foreign_keys = ON')
+        self.create_tables()
+
+    @classmethod
+    def from_config(cls):
+        return cls(get_config('search_suggestions.sqlite.path', ':memory:'))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''
+        Context manager for a transaction.
+
+        Returns a cursor. The transaction is committed when the context
+        manager exits normally and rolled back otherwise.
+        '''
+        with self._lock:
+            with self._conn:
+                yield _InstrumentedCursor(self._conn.cursor())
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            start = time.time()
+            rows = self._conn.execute(sql, params).fetchall()
+            record_statement(len(rows), time.time() - start)
+            return rows
+
+    def _iter_query(self, sql, params=()):
+        '''
+        Like ``_query`` but fetches the rows in batches.
+
+        The lock is held until the iteration has finished, since a
+        rollback on the shared connection would invalidate the cursor.
+        '''
+        with self._lock:
+            start = time.time()
+            cursor = self._conn.execute(sql, params)
+            num_rows = 0
+            duration = time.time() - start
+            while True:
+                start = time.time()
+                rows = cursor.fetchmany(_FETCH_BATCH_SIZE)
+                duration += time.time() - start
+                if not rows:
+                    break
+                num_rows += len(rows)
+                for row in rows:
+                    yield row
+            record_statement(num_rows, duration)
+
+    def create_tables(self):
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def clear(self):
+        with self._transaction() as cursor:
+            self._clear(cursor)
+
+    def _clear(self, cursor):
+        cursor.execute('DELETE FROM discovery_cooccurrence')
+        cursor.execute('DELETE FROM discovery_searchterm')
+
+    def upsert(self, terms, cooccurrences):
+        with self._transaction() as cursor:
+            self._upsert(cursor, terms, cooccurrences)
+
+    def _upsert(self, cursor, terms, cooccurrences):
+        words = set(terms)
+        for pair in cooccurrences:
+            words.update(pair)
+        cursor.executemany('''
+            INSERT OR IGNORE INTO discovery_searchterm (term, count)
+            VALUES (?, 0)
+        ''', ((w,) for w in words))
+        cursor.executemany('''
+            UPDATE discovery_searchterm SET count = count + ? WHERE term = ?
+        ''', ((c, w) for w, c in terms.iteritems()))
+        cursor.executemany('''
+            INSERT OR IGNORE INTO discovery_cooccurrence (term1_id, term2_id)
+            SELECT t1.id, t2.id
+            FROM discovery_searchterm AS t1, discovery_searchterm AS t2
+            WHERE t1.term = ? AND t2.term = ?
+        ''', list(cooccurrences))
+        cursor.executemany('''
+            UPDATE discovery_cooccurrence SET count = count + ?
+            WHERE term1_id = (
+                SELECT id FROM discovery_searchterm WHERE term = ?
+            ) AND term2_id = (
+                SELECT id FROM discovery_searchterm WHERE term = ?
+            )
+        ''', ((c, w1, w2) for (w1, w2), c in cooccurrences.iteritems()))
+
+    def get_terms(self, words):
+        words = list(set(words))
+        if not words:
+            return []
+        placeholders = ', '.join('?' * len(words))
+        rows = self._query('''
+            SELECT term, count FROM discovery_searchterm
+            WHERE term IN ({})
+        '''.format(placeholders), words)
+        return [Term(*row) for row in rows]
+
+    def get_terms_by_prefix(self, prefix):
+        rows = self._query('''
+            SELECT t.term, t.count
+            FROM discovery_searchterm_fts AS f
+            JOIN discovery_searchterm AS t ON t.id = f.rowid
+            WHERE discovery_searchterm_fts MATCH ?
+        ''', (_fts_prefix_query(prefix),))
+        return [Term(*row) for row in rows]
+
+    def get_cooccurring_terms(self, word, limit):
+        rows = self._query('''
+            SELECT other.term, other.count
+            FROM discovery_searchterm AS t
+            JOIN discovery_cooccurrence AS c
+                ON t.id IN (c.term1_id, c.term2_id)
+            JOIN discovery_searchterm AS other
+                ON other.id = (CASE WHEN c.term1_id = t.id
+                               THEN c.term2_id ELSE c.term1_id END)
+            WHERE t.term = ?
+            ORDER BY c.count
+            LIMIT ?
+        ''', (word, limit))
+        return [Term(*row) for row in rows]
+
+    def get_cooccurrence_count(self, word1, word2):
+        rows = self._query('''
+            SELECT c.count
+            FROM discovery_cooccurrence AS c
+            JOIN discovery_searchterm AS t1 ON t1.id = c.term1_id
+            JOIN discovery_searchterm AS t2 ON t2.id = c.term2_id
+            WHERE t1.term = ? AND t2.term = ?
+        ''', (word1, word2))
+        return rows[0][0] if rows else 0
+
+    def get_cooccurrence_counts(self, pairs):
+        pairs = list(set(pairs))
+        counts = dict.fromkeys(pairs, 0)
+        # Stay below SQLite's default limit of 999 parameters per statement
+        for i in xrange(0, len(pairs), _MAX_PAIRS_PER_QUERY):
+            batch = pairs[i:i + _MAX_PAIRS_PER_QUERY]
+            conditions = ' OR '.join(['(t1.term = ? AND t2.term = ?)']
+                                     * len(batch))
+            rows = self._query('''
+                SELECT t1.term, t2.term, c.count
+                FROM discovery_cooccurrence AS c
+                JOIN discovery_searchterm AS t1 ON t1.id = c.term1_id
+                JOIN discovery_searchterm AS t2 ON t2.id = c.term2_id
+                WHERE {}
+            '''.format(conditions), [w for pair in batch for w in pair])
+            for word1, word2, count in rows:
+                counts[(word1, word2)] = count
+        return counts
+
+    def iter_terms(self):
+        rows = self._iter_query('''
+            SELECT term, count FROM discovery_searchterm ORDER BY term
+        ''')
+        return (Term(*row) for row in rows)
+
+    def iter_cooccurrences(self):
+        return self._iter_query('''
+            SELECT t1.term, t2.term, c.count
+            FROM discovery_cooccurrence AS c
+            JOIN discovery_searchterm AS t1 ON t1.id = c.term1_id
+            JOIN discovery_searchterm AS t2 ON t2.id = c.term2_id
+        ''')
+
+    def reprocess(self, preprocess):
+        with self._lock:
+            terms, cooccurrences = reprocess_counts(preprocess,
+                                                    self.iter_terms(),
+                                                    self.iter_cooccurrences())
+            with self._transaction() as cursor:
+                self._clear(cursor)
+                self._upsert(cursor, terms, cooccurrences)
+
+    def prune(self, min_count):
+        with self._transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM discovery_searchterm WHERE count < ?
+            ''', (min_count,))
+            return cursor.rowcount
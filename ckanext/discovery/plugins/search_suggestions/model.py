@@ -11,7 +11,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.sql import func
 
-from ...model import Object
+from ...model import get_engine, Object
 
 
 log = logging.getLogger(__name__)
@@ -42,13 +42,18 @@ class SearchTerm(Base):
         '''
         Find search terms with a given prefix.
         '''
+        return cls.filter(cls.has_prefix(prefix))
+
+    @classmethod
+    def has_prefix(cls, prefix):
+        '''
+        Filter criterion for search terms with a given prefix.
+        '''
         # In our SQLAlchemy version the language cannot be specified in the
         # `match` function, so we construct the query explicitly. See
         # https://bitbucket.org/zzzeek/sqlalchemy/issues/3078
         tsquery = func.to_tsquery('pg_catalog.simple', "'{}':*".format(prefix))
-        return cls.filter(
-            cls.term_tsvector.op('@@')(tsquery)
-        )
+        return cls.term_tsvector.op('@@')(tsquery)
 
 
 # Register a trigger that automatically updates the `term_tsvector` column
@@ -122,6 +127,5 @@ def create_tables():
     Create the necessary database tables.
     '''
     log.debug('Creating database tables')
-    from ckan.model.meta import engine
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine())
 
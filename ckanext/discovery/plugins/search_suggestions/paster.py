@@ -3,7 +3,9 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import inspect
 import sys
+import time
 
 from ckan.lib.cli import CkanCommand
 
@@ -22,22 +24,58 @@ class SearchSuggestionsCommand(CkanCommand):
 
     Sub-commands:
 
+        export FILE [FORMAT]:
+            Export the stored search terms and co-occurrences to FILE ("-"
+            for standard output). FORMAT is either "ndjson" or "csv" and
+            is guessed from the file name by default.
+
+        import FILE [FORMAT]:
+            Import search terms and co-occurrences from a file created by
+            the export command. The imported counts are added to the
+            stored ones.
+
         init:
-            Initialize database tables. Deletes all stored search terms.
+            Initialize the storage of the configured backend. Previously
+            stored search terms are kept.
 
         list:
             List all currently stored search terms.
 
+        prune MIN_COUNT:
+            Delete all search terms that have been used less than MIN_COUNT
+            times.
+
+        replay [--processes=N] [--path-prefix=PREFIX] LOGFILE [LOGFILE ...]:
+            Extract the dataset searches from web server access logs (in
+            the common or combined log format, optionally compressed using
+            gzip or bzip2) and store them. Requests by user agents that
+            match ckanext.discovery.search_suggestions.admission.user_agents
+            are ignored. Parsing is done by N worker processes (defaults to
+            the number of CPUs). PREFIX is the path under which CKAN is
+            deployed, in the format of ckan.root_path (which is used by
+            default).
+
         reprocess:
             Re-process the stored search terms via the current implementations
             of the ISearchTermPreprocessor interface.
 
+        sync:
+            Rebuild the Redis mirror of the "redis" backend from its source
+            backend.
+
     """
-    max_args = 1
+    max_args = None
     min_args = 0
     usage = __doc__
     summary = __doc__.strip().split('\n')[0]
 
+    def __init__(self, name):
+        super(SearchSuggestionsCommand, self).__init__(name)
+        self.parser.add_option('-p', '--processes', type='int', default=None,
+                               help='Number of worker processes for replay')
+        self.parser.add_option('--path-prefix', default=None,
+                               help='Path under which CKAN is deployed')
+
     def command(self):
         if not self.args:
             _error('Missing command name. Try --help.')
@@ -47,12 +85,16 @@ class SearchSuggestionsCommand(CkanCommand):
             method = getattr(self, 'cmd_' + cmd)
         except AttributeError:
             _error('Unknown command "{}". Try --help.'.format(cmd))
-        method()
+        spec = inspect.getargspec(method)
+        if not spec.varargs and len(self.args) > len(spec.args):
+            _error('Too many arguments for command "{}". Try --help.'.format(
+                   cmd))
+        method(*self.args[1:])
 
     def cmd_init(self):
-        from .model import create_tables
+        from .backends import get_backend
         print('Creating database tables...')
-        create_tables()
+        get_backend().create_tables()
         print('Done.')
 
     def cmd_reprocess(self):
@@ -62,8 +104,92 @@ class SearchSuggestionsCommand(CkanCommand):
         print('Done.')
 
     def cmd_list(self):
-        from ckan.model.meta import Session
-        from .model import SearchTerm
-        for term in Session.query(SearchTerm).yield_per(100):
+        from .backends import get_backend
+        for term in get_backend().iter_terms():
             print(term.term)
 
+    def _open(self, filename, format, mode):
+        from .transfer import FORMATS, guess_format
+        format = format or guess_format(filename)
+        if format not in FORMATS:
+            _error('Unknown format "{}". Supported formats are: {}'.format(
+                   format, ', '.join(FORMATS)))
+        if filename == '-':
+            return (sys.stdin if mode == 'rb' else sys.stdout), format
+        try:
+            return open(filename, mode), format
+        except IOError as e:
+            _error('Could not open "{}": {}'.format(filename, e))
+
+    def cmd_export(self, filename=None, format=None):
+        from .backends import get_backend
+        from .transfer import export_statistics
+        if filename is None:
+            _error('Missing file name. Try --help.')
+        f, format = self._open(filename, format, 'wb')
+        try:
+            num = export_statistics(get_backend(), f, format)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+        if f is not sys.stdout:
+            print('Exported {} records.'.format(num))
+
+    def cmd_import(self, filename=None, format=None):
+        from .backends import get_backend
+        from .transfer import import_statistics
+        if filename is None:
+            _error('Missing file name. Try --help.')
+        f, format = self._open(filename, format, 'rb')
+        try:
+            num = import_statistics(get_backend(), f, format)
+        except ValueError as e:
+            _error('Could not import "{}": {}'.format(filename, e))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        print('Imported {} records.'.format(num))
+
+    def cmd_replay(self, *filenames):
+        from .admission import get_admission_filter
+        from .backends import get_backend
+        from .replay import replay
+        if not filenames:
+            _error('Missing log file. Try --help.')
+        user_agents = get_admission_filter().user_agents
+        start = time.time()
+        print('Reading access logs...')
+        try:
+            result = replay(filenames, self.options.processes,
+                            user_agents.pattern if user_agents else None,
+                            self.options.path_prefix)
+        except IOError as e:
+            _error('Could not read access log: {}'.format(e))
+        print('Found {} searches in {} lines.'.format(result.num_queries,
+              result.num_lines))
+        print('Storing {} terms and {} co-occurrences...'.format(
+              len(result.terms), len(result.cooccurrences)))
+        get_backend().bulk_upsert(result.records())
+        print('Done in {:.0f} seconds.'.format(time.time() - start))
+
+    def cmd_sync(self):
+        from .backends import get_backend
+        backend = get_backend()
+        if not hasattr(backend, 'sync'):
+            _error('The "{}" backend does not support syncing.'.format(
+                   backend.name))
+        print('Syncing Redis mirror...')
+        backend.sync()
+        print('Done.')
+
+    def cmd_prune(self, min_count=None):
+        from .backends import get_backend
+        if min_count is None:
+            _error('Missing minimum count. Try --help.')
+        try:
+            min_count = int(min_count)
+        except ValueError:
+            _error('Minimum count must be an integer.')
+        num = get_backend().prune(min_count)
+        print('Deleted {} search terms.'.format(num))
+
@@ -0,0 +1,231 @@
+# encoding: utf-8
+
+'''
+Replay of web server access logs.
+
+Extracts the text searches from access logs in the common or combined
+log format and aggregates their term and co-occurrence counts. This
+allows a new installation to start with suggestions based on the
+searches of the past.
+
+The queries are normalized exactly like live queries (see
+``SearchQuery``), including all ``ISearchTermPreprocessor``
+implementations. Parsing is spread across a pool of worker processes.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import bz2
+import collections
+import gzip
+import itertools
+import logging
+import multiprocessing
+import re
+import threading
+import urlparse
+
+from ckan.common import config
+
+from . import SearchQuery
+from .backends import count_words
+
+
+log = logging.getLogger(__name__)
+
+# Matches the request, the status code and (for the combined log format)
+# the user agent of a log line.
+_LINE_PATTERN = re.compile(
+    br'"GET (?P<url>\S+) [^"]*" (?P<status>\d{3}) \S+'
+    br'(?: "[^"]*" "(?P<user_agent>[^"]*)")?'
+)
+
+# Optional locale in the path of a URL
+_LOCALE_PATTERN = r'(?:/[a-z]{2}(?:_[A-Za-z]{2})?)?'
+
+# Placeholder for the locale in ``ckan.root_path``
+_LOCALE_PLACEHOLDER = '/{{LANG}}'
+
+# Number of log lines that are sent to a worker process at once
+CHUNK_SIZE = 10000
+
+# Regular expressions for the user agents whose requests are ignored and
+# for the path of the dataset search. Set in each worker process by
+# ``_init_worker``.
+_user_agents = None
+_path_pattern = None
+
+
+def get_path_pattern(root_path=None):
+    '''
+    Get the regular expression for the path of the dataset search.
+
+    ``root_path`` is the path under which CKAN is deployed, in the format
+    of ``ckan.root_path`` (for example ``/data/{{LANG}}``). If it doesn't
+    contain the locale placeholder then an optional locale is allowed
+    after it.
+    '''
+    root_path = (root_path or '').rstrip('/')
+    if _LOCALE_PLACEHOLDER in root_path:
+        prefix = _LOCALE_PATTERN.join(
+            re.escape(part) for part in root_path.split(_LOCALE_PLACEHOLDER))
+    else:
+        prefix = re.escape(root_path) + _LOCALE_PATTERN
+    return re.compile('^' + prefix + r'/dataset/?$')
+
+
+def open_log(filename):
+    '''
+    Open a log file for reading.
+
+    Files ending in ``.gz`` or ``.bz2`` are decompressed on the fly.
+    '''
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def extract_query(line, user_agents=None, path_pattern=None):
+    '''
+    Extract the search query from a log line.
+
+    Returns the value of the ``q`` parameter of a successful dataset
+    search or ``None`` if the line doesn't contain a search. Requests
+    whose user agent matches the regular expression ``user_agents``
+    are ignored. ``path_pattern`` is the regular expression for the path
+    of the dataset search and defaults to ``get_path_pattern()``.
+    '''
+    if b'q=' not in line:
+        return None
+    match = _LINE_PATTERN.search(line)
+    if not match or match.group('status') != b'200':
+        return None
+    user_agent = match.group('user_agent')
+    if user_agents is not None and user_agent and user_agents.search(
+            user_agent.decode('utf-8', 'replace')):
+        return None
+    url = urlparse.urlsplit(match.group('url'))
+    path_pattern = path_pattern or get_path_pattern()
+    if not path_pattern.match(url.path.decode('utf-8', 'replace')):
+        return None
+    values = urlparse.parse_qs(url.query).get(b'q')
+    if not values:
+        return None
+    q = values[-1].decode('utf-8', 'replace')
+    if q.strip() in ('', ':', '*:*'):
+        return None
+    return q
+
+
+def _init_worker(user_agents, root_path):
+    global _user_agents, _path_pattern
+    _user_agents = re.compile(user_agents, re.I) if user_agents else None
+    _path_pattern = get_path_pattern(root_path)
+
+
+def count_queries(lines):
+    '''
+    Count the terms and co-occurrences of the searches in log lines.
+
+    Returns a tuple ``(num_queries, terms, cooccurrences)`` where
+    ``terms`` and ``cooccurrences`` are ``collections.Counter``
+    instances in the format used by ``Backend.upsert``.
+    '''
+    num_queries = 0
+    terms = collections.Counter()
+    cooccurrences = collections.Counter()
+    for line in lines:
+        q = extract_query(line, _user_agents, _path_pattern)
+        if q is None:
+            continue
+        words = SearchQuery(q).words
+        if not words:
+            continue
+        num_queries += 1
+        query_terms, query_cooccurrences = count_words(words)
+        terms.update(query_terms)
+        cooccurrences.update(query_cooccurrences)
+    return num_queries, terms, cooccurrences
+
+
+def _chunks(filenames):
+    '''
+    Read the lines of log files in chunks of ``CHUNK_SIZE``.
+    '''
+    for filename in filenames:
+        log.debug('Reading {}'.format(filename))
+        with open_log(filename) as f:
+            while True:
+                chunk = list(itertools.islice(f, CHUNK_SIZE))
+                if not chunk:
+                    break
+                yield chunk
+
+
+class ReplayResult(object):
+    '''
+    Aggregated counts from replaying access logs.
+    '''
+    def __init__(self):
+        self.num_lines = 0
+        self.num_queries = 0
+        self.terms = collections.Counter()
+        self.cooccurrences = collections.Counter()
+
+    def records(self):
+        '''
+        The aggregated counts in the format of ``Backend.bulk_upsert``.
+        '''
+        for word, count in self.terms.iteritems():
+            yield (word, None, count)
+        for (word1, word2), count in self.cooccurrences.iteritems():
+            yield (word1, word2, count)
+
+
+def replay(filenames, processes=None, user_agents=None, root_path=None):
+    '''
+    Extract and count the searches in access logs.
+
+    ``filenames`` is a list of log files, ``processes`` is the number of
+    worker processes (defaults to the number of CPUs) and
+    ``user_agents`` is an optional regular expression for user agents
+    whose requests are ignored. ``root_path`` is the path under which
+    CKAN is deployed (see ``get_path_pattern``) and defaults to
+    ``ckan.root_path``.
+
+    Returns a ``ReplayResult``.
+    '''
+    result = ReplayResult()
+    processes = processes or multiprocessing.cpu_count()
+    if root_path is None:
+        root_path = config.get('ckan.root_path')
+
+    # Limits the number of chunks that have been read but not processed
+    # yet, since the pool would otherwise read the logs as fast as it can.
+    pending = threading.BoundedSemaphore(2 * processes)
+
+    def counted_chunks():
+        for chunk in _chunks(filenames):
+            pending.acquire()
+            result.num_lines += len(chunk)
+            yield chunk
+
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (user_agents, root_path))
+    try:
+        for num_queries, terms, cooccurrences in pool.imap_unordered(
+                count_queries, counted_chunks()):
+            pending.release()
+            result.num_queries += num_queries
+            result.terms.update(terms)
+            result.cooccurrences.update(cooccurrences)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return result
@@ -0,0 +1,129 @@
+# encoding: utf-8
+
+'''
+Sampling of search queries for storage.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import math
+import random
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+
+from .. import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+class Sampler(object):
+    '''
+    Decides which search queries are stored.
+
+    Each query is stored with probability ``rate``. To compensate, the
+    counts of a stored query are scaled by the inverse of the rate, so
+    that the stored statistics are unbiased estimates of the real ones.
+
+    If ``adaptive`` is true then the rate is lowered automatically while
+    storage is overloaded, that is while more than ``max_pending``
+    queries wait to be written or while the last write took longer than
+    ``max_write_duration`` seconds (see ``writer.QueryWriter``). The
+    rate is then halved at most every ``ADJUST_INTERVAL`` seconds, down
+    to ``min_rate``. Once storage has recovered the rate is doubled
+    again until it reaches ``rate``.
+    '''
+    ADJUST_INTERVAL = 1
+
+    def __init__(self, rate=1, adaptive=False, max_pending=1000,
+                 max_write_duration=1, min_rate=0.01):
+        if not 0 < rate <= 1:
+            raise ValueError('Sampling rate must be in (0, 1].')
+        self.rate = rate
+        self.adaptive = adaptive
+        self.max_pending = max_pending
+        self.max_write_duration = max_write_duration
+        self.min_rate = min(min_rate, rate)
+        self._lock = threading.Lock()
+        self._adjusted_at = 0
+
+        #: The sampling rate that is currently used
+        self.effective_rate = rate
+
+    def adjust(self, writer):
+        '''
+        Adjust the effective rate to the load of a query writer.
+        '''
+        if not self.adaptive:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._adjusted_at < self.ADJUST_INTERVAL:
+                return
+            self._adjusted_at = now
+            overloaded = (writer.pending > self.max_pending or
+                          writer.last_write_duration > self.max_write_duration)
+            if overloaded:
+                rate = max(self.min_rate, self.effective_rate / 2)
+            else:
+                rate = min(self.rate, self.effective_rate * 2)
+            if rate != self.effective_rate:
+                log.info('Changing sampling rate for search queries from '
+                         '{:g} to {:g}'.format(self.effective_rate, rate))
+                self.effective_rate = rate
+
+    def sample(self):
+        '''
+        Decide whether a query is stored.
+
+        Returns the weight with which the query is to be stored or 0 if
+        the query is not to be stored. The weight is the inverse of the
+        effective rate, rounded probabilistically to an integer so that
+        its expected value is unchanged.
+        '''
+        rate = self.effective_rate
+        if rate < 1 and random.random() >= rate:
+            return 0
+        weight = 1 / rate
+        fraction, whole = math.modf(weight)
+        return int(whole) + (1 if random.random() < fraction else 0)
+
+
+_sampler = None
+_sampler_options = None
+
+
+def get_sampler():
+    '''
+    Get the sampler for search queries.
+
+    The sampler is re-created if its configuration changes.
+    '''
+    global _sampler, _sampler_options
+    options = dict(
+        rate=float(get_config('search_suggestions.sample_rate', 1)),
+        adaptive=toolkit.asbool(get_config(
+                 'search_suggestions.adaptive_sampling', False)),
+        max_pending=int(get_config(
+                    'search_suggestions.adaptive_sampling.max_pending', 1000)),
+        max_write_duration=float(get_config(
+                           'search_suggestions.adaptive_sampling.'
+                           'max_write_duration', 1)),
+        min_rate=float(get_config(
+                 'search_suggestions.adaptive_sampling.min_rate', 0.01)),
+    )
+    if _sampler is None or _sampler_options != options:
+        _sampler = Sampler(**options)
+        _sampler_options = options
+    return _sampler
+
+
+def get_effective_sample_rate():
+    '''
+    Get the sampling rate that is currently used for search queries.
+    '''
+    return get_sampler().effective_rate
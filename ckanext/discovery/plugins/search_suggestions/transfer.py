@@ -0,0 +1,155 @@
+# encoding: utf-8
+
+'''
+Export and import of search statistics.
+
+The statistics are exchanged as a stream of records. Each record is a
+tuple ``(word1, word2, count)``; for terms ``word2`` is ``None``, for
+co-occurrences it is the second word of the pair.
+
+Two file formats are supported:
+
+* ``ndjson``: One JSON object per line, either ``{"term": ..., "count":
+  ...}`` or ``{"term1": ..., "term2": ..., "count": ...}``.
+
+* ``csv``: A header line ``term1,term2,count`` followed by one line per
+  record. For terms the ``term2`` column is empty.
+
+Records are read and written one at a time, so memory usage does not
+depend on the amount of data.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import csv
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+FORMATS = ['ndjson', 'csv']
+
+_CSV_HEADER = [b'term1', b'term2', b'count']
+
+
+def guess_format(filename):
+    '''
+    Guess the format of a file from its name.
+
+    Returns ``csv`` for files ending with ``.csv`` and ``ndjson``
+    otherwise.
+    '''
+    return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+
+def iter_records(backend):
+    '''
+    Iterate over the statistics stored in a backend.
+
+    Yields all terms first, followed by all co-occurrences.
+    '''
+    for term in backend.iter_terms():
+        yield (term.term, None, term.count)
+    for word1, word2, count in backend.iter_cooccurrences():
+        yield (word1, word2, count)
+
+
+def write_records(records, f, format):
+    '''
+    Write records to a binary file.
+
+    Returns the number of records written.
+    '''
+    num = 0
+    if format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(_CSV_HEADER)
+        for word1, word2, count in records:
+            writer.writerow([word1.encode('utf-8'),
+                             (word2 or '').encode('utf-8'), count])
+            num += 1
+    elif format == 'ndjson':
+        for word1, word2, count in records:
+            if word2 is None:
+                obj = {'term': word1, 'count': count}
+            else:
+                obj = {'term1': word1, 'term2': word2, 'count': count}
+            f.write(json.dumps(obj, sort_keys=True) + b'\n')
+            num += 1
+    else:
+        raise ValueError('Unknown format "{}"'.format(format))
+    return num
+
+
+def _parse(rows):
+    '''
+    Validate and normalize parsed records.
+    '''
+    for line_number, (word1, word2, count) in rows:
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid count in line {}'.format(line_number))
+        if not word1:
+            raise ValueError('Missing term in line {}'.format(line_number))
+        if word2:
+            if word1 == word2:
+                continue
+            word1, word2 = sorted([word1, word2])
+        else:
+            word2 = None
+        yield (word1, word2, count)
+
+
+def read_records(f, format):
+    '''
+    Read records from a binary file.
+
+    Yields ``(word1, word2, count)`` tuples. Pairs of words are sorted.
+    Raises ``ValueError`` if the file is malformed.
+    '''
+    if format == 'csv':
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header != _CSV_HEADER:
+            raise ValueError('Invalid CSV header, expected "{}"'.format(
+                             ','.join(_CSV_HEADER)))
+        rows = ((i, [v.decode('utf-8') for v in row[:2]] + row[2:])
+                for i, row in enumerate(reader, 2) if row)
+    elif format == 'ndjson':
+        def rows():
+            for i, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                    yield i, (obj.get('term') or obj.get('term1'),
+                              obj.get('term2'), obj.get('count'))
+                except (ValueError, AttributeError):
+                    raise ValueError('Invalid JSON in line {}'.format(i))
+        rows = rows()
+    else:
+        raise ValueError('Unknown format "{}"'.format(format))
+    return _parse(rows)
+
+
+def export_statistics(backend, f, format):
+    '''
+    Export the statistics of a backend to a binary file.
+
+    Returns the number of exported records.
+    '''
+    return write_records(iter_records(backend), f, format)
+
+
+def import_statistics(backend, f, format):
+    '''
+    Import statistics from a binary file into a backend.
+
+    The imported counts are added to those that are already stored.
+
+    Returns the number of imported records.
+    '''
+    return backend.bulk_upsert(read_records(f, format))
@@ -0,0 +1,149 @@
+# encoding: utf-8
+
+'''
+Batched storage of search queries.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from .backends import count_words, get_backend
+from .. import get_config
+from ...metrics import get_registry
+
+
+log = logging.getLogger(__name__)
+
+_flush_duration = get_registry().histogram(
+    'discovery_query_writer_flush_duration_seconds',
+    'Duration of writing collected search queries to the backend')
+
+
+class QueryWriter(object):
+    '''
+    Collects search queries and writes them to the backend in batches.
+
+    The term and co-occurrence counts of the collected queries are
+    aggregated in memory. They are written to the backend once
+    ``batch_size`` queries have been collected or when the oldest
+    collected query is ``max_delay`` seconds old, whichever comes first.
+    A ``batch_size`` of 1 writes each query immediately.
+    '''
+    def __init__(self, batch_size=1, max_delay=10):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._timer = None
+        self._reset()
+
+        #: Duration of the last write in seconds
+        self.last_write_duration = 0
+
+    def _reset(self):
+        self._terms = collections.Counter()
+        self._cooccurrences = collections.Counter()
+
+        #: Number of collected queries that have not been written yet
+        self.pending = 0
+
+    def add(self, words, weight=1):
+        '''
+        Add the words of a search query.
+
+        The term and co-occurrence counts of the query are multiplied by
+        ``weight``.
+        '''
+        terms, cooccurrences = count_words(words)
+        if weight != 1:
+            terms = {w: c * weight for w, c in terms.iteritems()}
+            cooccurrences = {p: c * weight for p, c
+                             in cooccurrences.iteritems()}
+        with self._lock:
+            self._terms.update(terms)
+            self._cooccurrences.update(cooccurrences)
+            self.pending += 1
+            flush = self.pending >= self.batch_size
+            if not flush:
+                self._start_timer()
+        if flush:
+            self.flush()
+
+    def _start_timer(self):
+        # Must be called with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.max_delay,
+                                          self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            log.exception('An exception occurred while storing search queries')
+            # Retry later
+            with self._lock:
+                self._start_timer()
+
+    def flush(self):
+        '''
+        Write all collected queries to the backend.
+
+        If writing fails then the queries are kept so that they are
+        written with the next batch, and the exception is re-raised.
+        '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return
+            terms = dict(self._terms)
+            cooccurrences = dict(self._cooccurrences)
+            num = self.pending
+            self._reset()
+        log.debug('Writing %d search queries', num)
+        start = time.time()
+        try:
+            get_backend().upsert(terms, cooccurrences)
+        except Exception:
+            with self._lock:
+                self._terms.update(terms)
+                self._cooccurrences.update(cooccurrences)
+                self.pending += num
+            raise
+        self.last_write_duration = time.time() - start
+        _flush_duration.observe(self.last_write_duration)
+
+
+_writer = None
+
+
+def get_writer():
+    '''
+    Get the query writer.
+
+    The writer is re-created if its configuration changes. Queries that
+    are still pending in the old writer are written first.
+    '''
+    global _writer
+    batch_size = int(get_config('search_suggestions.batch_size', 1))
+    max_delay = float(get_config('search_suggestions.batch_max_delay', 10))
+    if (_writer is None or _writer.batch_size != batch_size
+            or _writer.max_delay != max_delay):
+        if _writer is not None:
+            _writer.flush()
+        _writer = QueryWriter(batch_size, max_delay)
+    return _writer
+
+
+@atexit.register
+def _flush_writer():
+    if _writer is not None:
+        _writer.flush()
@@ -3,56 +3,313 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import collections
 import logging
-import json
+import threading
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
-from ckan.lib.search.common import make_connection
-from ckan.common import config
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from . import local, precompute
+from .solr import (get_datasets, get_fields, more_like_this,
+                   more_like_this_batch, parse_docs)
+from .. import get_config
+from ...cache import TTLCache
+from ...metrics import get_registry
+from ...prefetch import is_current_page, prefetchable
+from ...profiling import profiled
+from ...solr import SolrUnavailable
+from ...tracing import traced
 
 
 log = logging.getLogger(__name__)
 
 
-def get_similar_datasets(id, max_num=5):
+class SimilarDatasetsCache(object):
+    '''
+    Cache for similar datasets.
+
+    Each entry contains the similar datasets of one dataset with one set
+    of fields (see ``get_fields``), computed for the largest number of
+    results requested so far, so that requests for fewer results are
+    served from the same entry. The cache also tracks in which entries
+    each dataset is listed, so that these entries can be invalidated when
+    that dataset changes (see ``invalidate``).
+    '''
+    def __init__(self, max_size=1000, ttl=300):
+        self.entries = TTLCache(max_size, ttl)
+        self._lock = threading.Lock()
+        self._listed_in = collections.defaultdict(set)
+
+    @property
+    def max_size(self):
+        return self.entries.max_size
+
+    @property
+    def ttl(self):
+        return self.entries.ttl
+
+    def get(self, id, max_num, fields=None):
+        '''
+        Get the cached similar datasets of a dataset.
+
+        ``fields`` is the tuple of fields of the cached dataset dicts or
+        None for full dataset dicts.
+
+        Returns None if the dataset is not cached or if its entry
+        contains less than ``max_num`` datasets while more may exist.
+        '''
+        entry = self.entries.get((id, fields))
+        if entry is None:
+            return None
+        num, datasets = entry
+        if max_num > num and len(datasets) == num:
+            return None
+        return datasets[:max_num]
+
+    def set(self, id, num, datasets, fields=None):
+        '''
+        Cache the similar datasets of a dataset.
+
+        ``num`` is the maximum number of datasets that was requested.
+        ``fields`` is the same as for ``get``.
+        '''
+        key = (id, fields)
+        self.entries.set(key, (num, datasets))
+        with self._lock:
+            # An entry is also "listed" under its own dataset, so that
+            # all variants of it are found by ``invalidate``
+            self._listed_in[id].add(key)
+            for dataset in datasets:
+                self._listed_in[dataset['id']].add(key)
+            if len(self._listed_in) > 10 * self.max_size:
+                self._prune()
+
+    def _prune(self):
+        # Forget entries that have been evicted from the cache
+        cached = set(self.entries.keys())
+        for id, listed_in in list(self._listed_in.iteritems()):
+            listed_in &= cached
+            if not listed_in:
+                del self._listed_in[id]
+
+    def invalidate(self, id):
+        '''
+        Invalidate the entries affected by a change of a dataset.
+
+        These are the entries of the dataset itself and the entries that
+        list the dataset as similar.
+        '''
+        with self._lock:
+            keys = self._listed_in.pop(id, set())
+        for key in keys:
+            self.entries.invalidate(key)
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        self.entries.clear()
+        with self._lock:
+            self._listed_in.clear()
+
+
+_cache = None
+
+
+def _get_cache():
+    '''
+    Get the cache for similar datasets.
+    '''
+    global _cache
+    max_size = int(get_config('similar_datasets.cache_size', 1000))
+    ttl = float(get_config('similar_datasets.cache_ttl', 300))
+    if _cache is None or _cache.max_size != max_size or _cache.ttl != ttl:
+        _cache = SimilarDatasetsCache(max_size, ttl)
+    return _cache
+
+
+def _cache_requests():
+    if _cache is None:
+        return {}
+    return {'hit': _cache.entries.hits, 'miss': _cache.entries.misses}
+
+
+get_registry().counter_function(
+    'discovery_similar_datasets_cache_requests_total',
+    'Lookups in the cache of similar datasets', _cache_requests, ['result'])
+
+
+@prefetchable('similar_datasets', default=[])
+@traced('similar_datasets')
+@profiled('similar_datasets')
+def get_similar_datasets(id, max_num=5, full=False):
     '''
     Get similar datasets for a dataset.
 
+    Results are cached, see ``SimilarDatasetsCache``. On the dataset page
+    the call is prefetched, see ``ckanext.discovery.prefetch``.
+
     :param string id: ID of the target dataset. This must be the actual
         ID, passing the name is not supported.
 
     :param int max_num: Maximum number of datasets to return.
 
+    :param bool full: If false (the default) then the dataset dicts only
+        contain the fields configured via
+        ``ckanext.discovery.similar_datasets.fields`` (see
+        ``get_fields``). If true then the full dataset dicts are
+        returned, which is considerably more expensive for datasets
+        with many resources or extras.
+
     :return: A list of similar dataset dicts sorted by decreasing score.
+        The list is empty if Solr is not available (see
+        ``ckanext.discovery.solr``).
+    '''
+    fields = None if full else get_fields()
+    cache = _get_cache()
+    datasets = cache.get(id, max_num, fields)
+    if datasets is not None:
+        return datasets
+    # Fetch at least as many datasets as are shown by default, so that
+    # the entry can serve all usual snippet sizes
+    num = max(max_num, int(get_config('similar_datasets.max_num', 5)))
+    try:
+        datasets = _query_similar_datasets(id, num, fields)
+    except SolrUnavailable as e:
+        # Leave out the list instead of breaking the page
+        log.warning('Could not get similar datasets of %s: %s', id, e)
+        return []
+    cache.set(id, num, datasets, fields)
+    return datasets[:max_num]
+
+
+@traced('similar_datasets_batch')
+def get_similar_datasets_batch(ids, max_num=5, full=False):
     '''
-    solr = make_connection()
-    query = 'id:"{}"'.format(id)
-    fields_to_compare = 'text'
-    fields_to_return = 'id validated_data_dict score'
-    site_id = config.get('ckan.site_id')
-    filter_query = '''
-        +site_id:"{}"
-        +dataset_type:dataset
-        +state:active
-        +capacity:public
-        '''.format(site_id)
-    results = solr.more_like_this(q=query,
-                                  mltfl=fields_to_compare,
-                                  fl=fields_to_return,
-                                  fq=filter_query,
-                                  rows=max_num)
-    log.debug('Similar datasets for {}:'.format(id))
-    print('Similar datasets for {}:'.format(id))
-    for doc in results.docs:
-        log.debug('  {id} (score {score})'.format(**doc))
-        print('  {id} (score {score})'.format(**doc))
-    return [json.loads(doc['validated_data_dict']) for doc in results.docs]
+    Get similar datasets for several datasets.
+
+    Like ``get_similar_datasets``, but the similar datasets of all
+    datasets that are not cached are retrieved using a single Solr query
+    (see ``solr.more_like_this_batch``). Useful for lists of datasets,
+    for example search results. Precomputed similar datasets are not
+    used. If the local similarity engine is enabled (see ``local``) then
+    the dataset dicts of all similar datasets are retrieved using a
+    single Solr query.
+
+    :param list ids: IDs of the target datasets. These must be the actual
+        IDs, passing names is not supported.
+
+    :param int max_num: Maximum number of datasets to return per target
+        dataset.
+
+    :param bool full: See ``get_similar_datasets``.
+
+    :return: A dict that maps each ID in ``ids`` to a list of similar
+        dataset dicts sorted by decreasing score. The lists are empty if
+        Solr is not available.
+    '''
+    fields = None if full else get_fields()
+    cache = _get_cache()
+    result = {}
+    missing = []
+    for id in ids:
+        datasets = cache.get(id, max_num, fields)
+        if datasets is None:
+            missing.append(id)
+        else:
+            result[id] = datasets
+    if missing:
+        num = max(max_num, int(get_config('similar_datasets.max_num', 5)))
+        try:
+            if local.is_enabled():
+                similar = _query_local(missing, num, fields)
+            else:
+                docs = more_like_this_batch(missing, num, fields)
+                similar = {id: parse_docs(id_docs, fields)
+                           for id, id_docs in docs.iteritems()}
+        except SolrUnavailable as e:
+            log.warning('Could not get similar datasets of %d datasets: %s',
+                        len(missing), e)
+            similar = {}
+        for id, datasets in similar.iteritems():
+            cache.set(id, num, datasets, fields)
+            result[id] = datasets[:max_num]
+    return {id: result.get(id, []) for id in ids}
+
+
+def _query_similar_datasets(id, max_num, fields=None):
+    '''
+    Get similar datasets without using the cache.
+
+    ``fields`` is the tuple of fields of the returned dataset dicts or
+    None for full dataset dicts.
+
+    If the local similarity engine is enabled then it is used (see
+    ``local``). Otherwise, if precomputed similar datasets are enabled
+    and available then they are used. Otherwise Solr's MoreLikeThis
+    handler is queried and, if precomputation is enabled, the result is
+    stored for later requests.
+    '''
+    if local.is_enabled():
+        return _query_local([id], max_num, fields)[id]
+    enabled = precompute.is_enabled()
+    if enabled:
+        try:
+            precomputed = precompute.get_similar_ids(id)
+        except SQLAlchemyError:
+            log.exception('Could not read precomputed similar datasets')
+            precomputed = None
+        if precomputed is not None:
+            num, similar = precomputed
+            # If fewer datasets than requested were found then there are
+            # no more similar datasets
+            if max_num <= num or len(similar) < num:
+                return get_datasets([s for s, _ in similar[:max_num]],
+                                    fields)
+    docs = more_like_this(id, max_num, fields)
+    if enabled:
+        similar = [(doc['id'], doc['score']) for doc in docs]
+        try:
+            precompute.store([(id, max_num, similar)])
+        except IntegrityError:
+            # A concurrent request has stored them already
+            pass
+        except SQLAlchemyError:
+            log.exception('Could not store similar datasets')
+    return parse_docs(docs, fields)
+
+
+def _query_local(ids, max_num, fields=None):
+    '''
+    Get similar datasets from the local similarity engine.
+
+    Returns a dict that maps each ID in ``ids`` to a list of similar
+    dataset dicts. The dataset dicts of all similar datasets are
+    retrieved from Solr using a single query.
+    '''
+    similar = {}
+    for id in ids:
+        try:
+            similar[id] = [s for s, _ in local.get_similar_ids(id, max_num)]
+        except SQLAlchemyError:
+            log.exception('Could not read the signature of dataset %s', id)
+            similar[id] = []
+    all_ids = list({s for similar_ids in similar.itervalues()
+                    for s in similar_ids})
+    datasets = {dataset['id']: dataset
+                for dataset in get_datasets(all_ids, fields)}
+    return {id: [datasets[s] for s in similar_ids if s in datasets]
+            for id, similar_ids in similar.iteritems()}
 
 
 class SimilarDatasetsPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
 
     #
     # IConfigurer
@@ -60,6 +317,49 @@ class SimilarDatasetsPlugin(plugins.SingletonPlugin):
 
     def update_config(self, config_):
         toolkit.add_template_directory(config_, 'templates')
+        toolkit.add_resource(b'fanstatic', b'discovery_similar_datasets')
+
+    #
+    # IPackageController
+    #
+
+    def after_update(self, context, pkg_dict):
+        self._invalidate(pkg_dict['id'])
+
+    def after_delete(self, context, pkg_dict):
+        self._invalidate(pkg_dict['id'])
+        if local.is_enabled():
+            try:
+                local.delete_signature(pkg_dict['id'])
+            except SQLAlchemyError:
+                log.exception('Could not delete dataset signature')
+
+    def before_view(self, pkg_dict):
+        # Query the similar datasets for the sidebar while the rest of the
+        # page is rendered
+        if (is_current_page('package', 'read') and not toolkit.asbool(
+                get_config('similar_datasets.async', False))):
+            max_num = int(get_config('similar_datasets.max_num', 5))
+            get_similar_datasets.prefetch(pkg_dict['id'], max_num=max_num)
+        return pkg_dict
+
+    def before_index(self, pkg_dict):
+        if local.is_enabled():
+            try:
+                local.update(pkg_dict)
+            except SQLAlchemyError:
+                # Don't let the indexing of the dataset fail
+                log.exception('Could not update dataset signature')
+        return pkg_dict
+
+    def _invalidate(self, id):
+        _get_cache().invalidate(id)
+        if precompute.is_enabled():
+            try:
+                precompute.invalidate(id)
+            except SQLAlchemyError:
+                # Don't let the update of the dataset fail
+                log.exception('Could not invalidate similar datasets')
 
     #
     # ITemplateHelpers
@@ -68,5 +368,29 @@ class SimilarDatasetsPlugin(plugins.SingletonPlugin):
     def get_helpers(self):
         return {
             'discovery_similar_datasets': get_similar_datasets,
+            'discovery_similar_datasets_batch': get_similar_datasets_batch,
         }
 
+
+    #
+    # IActions
+    #
+
+    def get_actions(self):
+        from .action import (similar_datasets_action,
+                             similar_datasets_batch_action)
+        return {
+            'discovery_similar_datasets': similar_datasets_action,
+            'discovery_similar_datasets_batch': similar_datasets_batch_action,
+        }
+
+    #
+    # IAuthFunctions
+    #
+
+    def get_auth_functions(self):
+        from .action import similar_datasets_auth, similar_datasets_batch_auth
+        return {
+            'discovery_similar_datasets': similar_datasets_auth,
+            'discovery_similar_datasets_batch': similar_datasets_batch_auth,
+        }
@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+from ckan.logic import validate
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.navl.validators import ignore_missing, not_empty
+from ckan.logic.converters import convert_to_list_if_string
+from ckan.logic.validators import list_of_strings, natural_number_validator
+
+from . import get_similar_datasets, get_similar_datasets_batch
+from .. import get_config
+
+
+log = logging.getLogger(__name__)
+
+# Maximum length of the descriptions in the results
+MAX_NOTES_LENGTH = 200
+
+# Maximum number of datasets in a call of discovery_similar_datasets_batch
+MAX_BATCH_SIZE = 100
+
+
+def similar_datasets_schema():
+    return {
+        'id': [not_empty, unicode],
+        'max_num': [ignore_missing, natural_number_validator],
+    }
+
+
+def similar_datasets_batch_schema():
+    return {
+        'ids': [not_empty, convert_to_list_if_string, list_of_strings],
+        'max_num': [ignore_missing, natural_number_validator],
+    }
+
+
+def _get_max_num(data_dict):
+    '''
+    Get the maximum number of results per dataset for an action call.
+
+    Raises ``ValidationError`` if the requested number exceeds
+    ``ckanext.discovery.similar_datasets.max_num_limit``.
+    '''
+    default = int(get_config('similar_datasets.max_num', 5))
+    max_num = data_dict.get('max_num')
+    if max_num is None:
+        return default
+    limit = max(default, int(get_config('similar_datasets.max_num_limit',
+                                        20)))
+    if int(max_num) > limit:
+        raise toolkit.ValidationError({'max_num': [
+            'Must not be larger than {}'.format(limit)]})
+    return int(max_num)
+
+
+def _get_package(context, id):
+    pkg = context['model'].Package.get(id)
+    if pkg is None:
+        raise toolkit.ObjectNotFound('Dataset "{}" not found'.format(id))
+    return pkg
+
+
+def _compact(dataset):
+    '''
+    Reduce a dataset dict to the keys returned by the actions.
+    '''
+    return {
+        'id': dataset['id'],
+        'name': dataset.get('name'),
+        'title': dataset.get('title') or dataset.get('name'),
+        'notes': toolkit.h.truncate(dataset.get('notes') or '',
+                                    MAX_NOTES_LENGTH),
+    }
+
+
+@toolkit.auth_allow_anonymous_access
+def similar_datasets_auth(context, data_dict):
+    # Everybody who can see a dataset can see its similar datasets
+    try:
+        toolkit.check_access('package_show', context, {'id': data_dict['id']})
+    except toolkit.NotAuthorized:
+        return {'success': False,
+                'msg': 'Not authorized to read dataset {}'.format(
+                       data_dict['id'])}
+    return {'success': True}
+
+
+@toolkit.side_effect_free
+@validate(similar_datasets_schema)
+def similar_datasets_action(context, data_dict):
+    '''
+    List the datasets that are similar to a dataset.
+
+    Takes the ID or name of a dataset (``id``) and optionally the maximum
+    number of results (``max_num``). The latter defaults to the value of
+    the config option ``ckanext.discovery.similar_datasets.max_num`` or 5
+    if that is not set. Larger values than the config option
+    ``ckanext.discovery.similar_datasets.max_num_limit`` (defaults to 20)
+    are rejected.
+
+    Returns a list of dictionaries, sorted decreasingly by similarity.
+    To keep the response small, each dictionary only contains the keys
+    ``id``, ``name``, ``title`` and ``notes`` of a dataset. The latter is
+    truncated to 200 characters.
+    '''
+    max_num = _get_max_num(data_dict)
+    toolkit.check_access('discovery_similar_datasets', context, data_dict)
+    pkg = _get_package(context, data_dict['id'])
+    return [_compact(dataset)
+            for dataset in get_similar_datasets(pkg.id, max_num=max_num)]
+
+
+@toolkit.auth_allow_anonymous_access
+def similar_datasets_batch_auth(context, data_dict):
+    # Everybody who can see all of the datasets can see their similar
+    # datasets
+    for id in data_dict['ids']:
+        result = similar_datasets_auth(context, {'id': id})
+        if not result['success']:
+            return result
+    return {'success': True}
+
+
+@toolkit.side_effect_free
+@validate(similar_datasets_batch_schema)
+def similar_datasets_batch_action(context, data_dict):
+    '''
+    List the similar datasets of several datasets.
+
+    Takes a list of dataset IDs or names (``ids``, at most 100) and
+    optionally the maximum number of results per dataset (``max_num``,
+    see ``discovery_similar_datasets``). The similar datasets of all
+    datasets are retrieved using a single Solr query.
+
+    Returns a dictionary that maps each of the given IDs or names to a
+    list of similar datasets in the format of
+    ``discovery_similar_datasets``.
+    '''
+    ids = data_dict['ids']
+    if len(ids) > MAX_BATCH_SIZE:
+        raise toolkit.ValidationError({'ids': [
+            'At most {} datasets are allowed'.format(MAX_BATCH_SIZE)]})
+    max_num = _get_max_num(data_dict)
+    toolkit.check_access('discovery_similar_datasets_batch', context,
+                         data_dict)
+    pkg_ids = {id: _get_package(context, id).id for id in ids}
+    similar = get_similar_datasets_batch(list(set(pkg_ids.values())),
+                                         max_num=max_num)
+    return {id: [_compact(dataset) for dataset in similar[pkg_id]]
+            for id, pkg_id in pkg_ids.iteritems()}
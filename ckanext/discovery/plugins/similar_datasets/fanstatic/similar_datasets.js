@@ -0,0 +1,36 @@
+'use strict';
+
+$(function () {
+
+  // Load the lists of similar datasets that have been rendered as empty
+  // placeholders (see the similar_datasets.html snippet). The section stays
+  // hidden if there are no similar datasets or if the request fails.
+  $('.similar-datasets[data-dataset-id]').each(function () {
+    var section = $(this);
+    var url = ckan.SITE_ROOT + '/api/3/action/discovery_similar_datasets';
+    var params = {
+      id: section.attr('data-dataset-id'),
+      max_num: section.attr('data-max-num')
+    };
+    var datasetUrl = section.attr('data-dataset-url');
+    $.getJSON(url, params)
+      .done(function (data) {
+        var datasets = data['result'];
+        if (!datasets.length) {
+          return;
+        }
+        var list = section.find('ul');
+        $.each(datasets, function (i, dataset) {
+          var link = $('<a>')
+            .attr('href', datasetUrl.replace('DATASET_NAME', dataset.name))
+            .attr('title', dataset.notes)
+            .text(dataset.title);
+          list.append($('<li class="nav-item">').append(link));
+        });
+        section.show();
+      });
+  });
+
+})
+
+/* vim: set shiftwidth=2 tabstop=2 softtabstop=2: */
@@ -0,0 +1,423 @@
+# encoding: utf-8
+
+'''
+Local similarity engine.
+
+An alternative to Solr's MoreLikeThis handler which neither requires term
+vectors in the Solr index nor a custom request handler. It is enabled by
+setting ``ckanext.discovery.similar_datasets.engine`` to ``local``.
+
+Whenever a public dataset is indexed, a MinHash signature of the words
+in its title, description, tags and resources is computed and stored in
+the database (see ``update``). The similarity of two signatures estimates
+the Jaccard similarity of the datasets' sets of words.
+
+``build_index`` writes the stored signatures into a compact index file
+that uses locality-sensitive hashing (LSH): each signature is split into
+``NUM_BANDS`` bands and datasets that agree in at least one band are
+candidates for being similar. Each CKAN process memory-maps the file
+(see ``get_index``) and re-opens it once it has been rebuilt. Datasets
+that have been added since the last build can find similar datasets but
+are not listed as similar until the index is rebuilt.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import array
+import datetime
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from ckan.common import config
+from sqlalchemy import select
+
+from .model import DatasetSignature
+from .. import get_config
+from ...model import get_engine, run_read, transaction
+from ...solr import is_public
+from ...tracing import span
+
+
+log = logging.getLogger(__name__)
+
+_signatures = DatasetSignature.__table__
+
+# Number of hash values per signature
+NUM_HASHES = 64
+
+# Number of LSH bands. Datasets whose Jaccard similarity is above roughly
+# (1 / NUM_BANDS) ** (NUM_BANDS / NUM_HASHES) are likely to be candidates.
+NUM_BANDS = 32
+
+# Maximum number of candidates that are taken from a single LSH bucket.
+# Limits the query time for buckets of very common words.
+MAX_BUCKET_SIZE = 100
+
+# Fields of the search index dict whose words are compared
+TEXT_FIELDS = ('title', 'notes', 'tags', 'res_name', 'res_description')
+
+# Shorter words are ignored, like in the default MoreLikeThis configuration
+MIN_WORD_LENGTH = 3
+
+# Frequent words that carry no meaning
+STOP_WORDS = frozenset('''
+    and are but for from has have its not that the this was were which with
+    als auch aus bei das dem den der des die ein eine einem einen einer eines
+    für ist mit nach oder sich sind über und von vom zum zur
+'''.split())
+
+_ROWS_PER_BAND = NUM_HASHES // NUM_BANDS
+_BAND_SIZE = _ROWS_PER_BAND * 4
+_SIGNATURE = struct.Struct(b'<{}I'.format(NUM_HASHES))
+_WORD_HASH = struct.Struct(b'<Q')
+
+_MAGIC = b'DSIM'
+_VERSION = 1
+_HEADER = struct.Struct(b'<4sIIIIId')
+_ENTRY = struct.Struct(b'<II')
+
+# Array type code for unsigned 32 bit integers
+_UINT32 = b'I' if array.array(b'I').itemsize == 4 else b'L'
+
+_word_regex = re.compile(r'\w+', re.UNICODE)
+
+
+def _probe_order(bin):
+    # A fixed pseudo-random order of all bins, used for filling ``bin``
+    # if it is empty
+    return sorted(xrange(NUM_HASHES), key=lambda other: hashlib.md5(
+        '{}:{}'.format(bin, other).encode('utf-8')).digest())
+
+
+_PROBES = [_probe_order(bin) for bin in xrange(NUM_HASHES)]
+
+
+def is_enabled():
+    '''
+    Whether the local similarity engine is used.
+    '''
+    return get_config('similar_datasets.engine', 'solr') == 'local'
+
+
+def get_index_path():
+    '''
+    The path of the index file.
+    '''
+    return get_config('similar_datasets.index_path', os.path.join(
+        tempfile.gettempdir(), 'ckanext-discovery-similarity.idx'))
+
+
+def tokenize(text):
+    '''
+    Get the set of significant, lower-case words in a text.
+    '''
+    return {word for word in _word_regex.findall(text.lower())
+            if len(word) >= MIN_WORD_LENGTH and word not in STOP_WORDS}
+
+
+def get_words(pkg_dict):
+    '''
+    Get the set of words of a dataset from its search index dict.
+    '''
+    words = set()
+    for field in TEXT_FIELDS:
+        value = pkg_dict.get(field)
+        if not value:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(v for v in value if v)
+        words |= tokenize(value)
+    return words
+
+
+def compute_signature(words):
+    '''
+    Compute the MinHash signature of a set of words.
+
+    Uses one-permutation hashing: each word is hashed once and assigned
+    to one of ``NUM_HASHES`` bins, each bin keeps the minimum. Empty bins
+    are filled from another non-empty bin that is chosen using a fixed,
+    bin-specific probing order, which keeps the estimates accurate for
+    datasets with few words. Returns the signature as a
+    byte string or None if ``words`` is empty.
+    '''
+    if not words:
+        return None
+    mins = [None] * NUM_HASHES
+    for word in words:
+        h = _WORD_HASH.unpack_from(
+            hashlib.md5(word.encode('utf-8')).digest())[0]
+        bin, value = h % NUM_HASHES, (h // NUM_HASHES) & 0xffffffff
+        if mins[bin] is None or value < mins[bin]:
+            mins[bin] = value
+    values = []
+    for bin in xrange(NUM_HASHES):
+        value = mins[bin]
+        if value is None:
+            value = next(mins[other] for other in _PROBES[bin]
+                         if mins[other] is not None)
+        values.append(value)
+    return _SIGNATURE.pack(*values)
+
+
+def similarity(signature1, signature2):
+    '''
+    Estimate the Jaccard similarity of two signatures.
+    '''
+    return _similarity(_SIGNATURE.unpack(signature1),
+                       _SIGNATURE.unpack(signature2))
+
+
+def _similarity(values1, values2):
+    return sum(1 for v1, v2 in zip(values1, values2) if v1 == v2) / NUM_HASHES
+
+
+def _band_hashes(signature):
+    return [zlib.crc32(signature[i:i + _BAND_SIZE]) & 0xffffffff
+            for i in xrange(0, len(signature), _BAND_SIZE)]
+
+
+def build_index(signatures, path):
+    '''
+    Write an index file.
+
+    ``signatures`` is an iterable of ``(id, signature)`` tuples. The file
+    is written to a temporary file first and then moved to ``path``, so
+    that processes that are using the old file are not affected.
+
+    Returns the number of datasets in the index.
+    '''
+    ids = []
+    data = bytearray()
+    hashes = [array.array(_UINT32) for _ in xrange(NUM_BANDS)]
+    for id, signature in signatures:
+        ids.append(id.encode('utf-8'))
+        data.extend(signature)
+        for band, h in enumerate(_band_hashes(signature)):
+            hashes[band].append(h)
+    count = len(ids)
+    id_length = max(len(id) for id in ids) if ids else 1
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, NUM_HASHES, NUM_BANDS,
+                                 id_length, count, time.time()))
+            for id in ids:
+                f.write(id.ljust(id_length, b'\0'))
+            f.write(data)
+            for band_hashes in hashes:
+                # Entries of (hash, row), sorted by hash
+                entries = array.array(_UINT32)
+                for row in sorted(xrange(count),
+                                  key=band_hashes.__getitem__):
+                    entries.append(band_hashes[row])
+                    entries.append(row)
+                if sys.byteorder == 'big':
+                    entries.byteswap()
+                f.write(entries.tostring())
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return count
+
+
+class LocalIndex(object):
+    '''
+    A memory-mapped index file (see ``build_index``).
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, num_hashes, num_bands, self._id_length, self.count,
+         self.built_at) = _HEADER.unpack_from(self._mmap)
+        if (magic != _MAGIC or version != _VERSION
+                or num_hashes != NUM_HASHES or num_bands != NUM_BANDS):
+            raise ValueError('"{}" is not a compatible index file'.format(
+                             path))
+        self._ids_offset = _HEADER.size
+        self._signatures_offset = (self._ids_offset
+                                   + self.count * self._id_length)
+        self._bands_offset = (self._signatures_offset
+                              + self.count * _SIGNATURE.size)
+
+    def __len__(self):
+        return self.count
+
+    def get_id(self, row):
+        start = self._ids_offset + row * self._id_length
+        id = self._mmap[start:start + self._id_length].rstrip(b'\0')
+        return id.decode('utf-8')
+
+    def get_values(self, row):
+        return _SIGNATURE.unpack_from(
+            self._mmap, self._signatures_offset + row * _SIGNATURE.size)
+
+    def _iter_bucket(self, band, h):
+        base = self._bands_offset + band * self.count * _ENTRY.size
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _ENTRY.unpack_from(self._mmap, base + mid * _ENTRY.size)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in xrange(lo, min(lo + MAX_BUCKET_SIZE, self.count)):
+            entry_hash, row = _ENTRY.unpack_from(self._mmap,
+                                                 base + i * _ENTRY.size)
+            if entry_hash != h:
+                break
+            yield row
+
+    def query(self, signature, max_num, exclude=None):
+        '''
+        Find the datasets with the most similar signatures.
+
+        Returns a list of at most ``max_num`` ``(id, score)`` tuples
+        sorted by decreasing score. The dataset with the ID ``exclude``
+        is skipped.
+        '''
+        candidates = set()
+        for band, h in enumerate(_band_hashes(signature)):
+            candidates.update(self._iter_bucket(band, h))
+        values = _SIGNATURE.unpack(signature)
+        scored = []
+        for row in candidates:
+            id = self.get_id(row)
+            if id != exclude:
+                scored.append((_similarity(values, self.get_values(row)), id))
+        return [(id, score) for score, id in heapq.nlargest(max_num, scored)]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    '''
+    Get the index.
+
+    The index file is re-opened if it has been rebuilt. Returns None if
+    the index file does not exist.
+    '''
+    global _index
+    path = get_index_path()
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _index_lock:
+        if _index is None or _index.path != path or _index.mtime != mtime:
+            log.debug('Opening similarity index "%s"', path)
+            _index = LocalIndex(path)
+        return _index
+
+
+def load_signature(id):
+    '''
+    Load the stored signature of a dataset.
+
+    Returns None if no signature is stored for the dataset.
+    '''
+    query = select([_signatures.c.signature]).where(
+        _signatures.c.dataset_id == id)
+    signature = run_read(lambda session: session.execute(query).scalar())
+    if signature is None:
+        return None
+    return bytes(signature)
+
+
+def store_signature(id, signature):
+    '''
+    Store the signature of a dataset, replacing any previous one.
+    '''
+    with transaction() as conn:
+        conn.execute(_signatures.delete().where(
+                     _signatures.c.dataset_id == id))
+        conn.execute(_signatures.insert(), {
+            'dataset_id': id,
+            'signature': signature,
+            'updated_at': datetime.datetime.utcnow(),
+        })
+
+
+def delete_signature(id):
+    '''
+    Delete the stored signature of a dataset.
+    '''
+    with transaction() as conn:
+        conn.execute(_signatures.delete().where(
+                     _signatures.c.dataset_id == id))
+
+
+def iter_signatures(batch_size=1000):
+    '''
+    Iterate over all stored signatures.
+
+    Yields ``(id, signature)`` tuples.
+    '''
+    query = select([_signatures.c.dataset_id, _signatures.c.signature]) \
+        .order_by(_signatures.c.dataset_id)
+    with get_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row.dataset_id, bytes(row.signature)
+
+
+def update(pkg_dict):
+    '''
+    Update the stored signature of a dataset.
+
+    ``pkg_dict`` is the dataset's search index dict. Signatures are only
+    stored for public datasets that contain at least one word.
+    '''
+    signature = None
+    # CKAN only adds the site ID after calling ``before_index``
+    doc = dict(pkg_dict, site_id=config.get('ckan.site_id'))
+    if is_public(doc):
+        signature = compute_signature(get_words(pkg_dict))
+    if signature is None:
+        delete_signature(pkg_dict['id'])
+    else:
+        store_signature(pkg_dict['id'], signature)
+
+
+def get_similar_ids(id, max_num):
+    '''
+    Find the most similar datasets of a dataset.
+
+    Returns a list of at most ``max_num`` ``(id, score)`` tuples sorted by
+    decreasing score. The list is empty if no signature is stored for
+    the dataset or if the index has not been built yet.
+    '''
+    with span('local_query'):
+        signature = load_signature(id)
+        if signature is None:
+            return []
+        index = get_index()
+        if index is None:
+            log.warning('The similarity index "%s" does not exist. Use the '
+                        'paster command "similar_datasets build-index" to '
+                        'build it.', get_index_path())
+            return []
+        return index.query(signature, max_num, exclude=id)
@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+from sqlalchemy import Column, ForeignKey, types
+from sqlalchemy.ext.declarative import declarative_base
+
+from ...model import get_engine, Object
+
+
+log = logging.getLogger(__name__)
+
+Base = declarative_base(cls=Object)
+
+
+class SimilarityComputation(Base):
+    '''
+    The precomputed similar datasets of a single dataset.
+
+    ``num`` is the maximum number of similar datasets that was requested
+    from Solr. The similar datasets themselves are stored as
+    ``SimilarDataset`` instances.
+    '''
+    __tablename__ = 'discovery_similarity_computation'
+    dataset_id = Column(types.UnicodeText, primary_key=True, nullable=False)
+    num = Column(types.Integer, nullable=False)
+    computed_at = Column(types.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        r = '<{} "{}">'.format(self.__class__.__name__, self.dataset_id)
+        return r.encode('utf-8')
+
+
+class SimilarDataset(Base):
+    '''
+    A precomputed similar dataset.
+
+    ``rank`` is the position of the similar dataset in the list of the
+    similar datasets of the target dataset, starting at 0.
+    '''
+    __tablename__ = 'discovery_similar_dataset'
+    dataset_id = Column(types.UnicodeText,
+                        ForeignKey(SimilarityComputation.dataset_id,
+                                   ondelete='CASCADE', onupdate='CASCADE'),
+                        primary_key=True, nullable=False)
+    rank = Column(types.Integer, primary_key=True, nullable=False)
+    similar_id = Column(types.UnicodeText, nullable=False, index=True)
+    score = Column(types.Float, nullable=False)
+
+    def __repr__(self):
+        r = '<{} "{}", "{}">'.format(self.__class__.__name__,
+                                     self.dataset_id, self.similar_id)
+        return r.encode('utf-8')
+
+
+class DatasetSignature(Base):
+    '''
+    The MinHash signature of a dataset for the local similarity engine.
+
+    See ``ckanext.discovery.plugins.similar_datasets.local``.
+    '''
+    __tablename__ = 'discovery_dataset_signature'
+    dataset_id = Column(types.UnicodeText, primary_key=True, nullable=False)
+    signature = Column(types.LargeBinary, nullable=False)
+    updated_at = Column(types.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        r = '<{} "{}">'.format(self.__class__.__name__, self.dataset_id)
+        return r.encode('utf-8')
+
+
+def create_tables():
+    '''
+    Create the necessary database tables.
+    '''
+    log.debug('Creating database tables')
+    Base.metadata.create_all(get_engine())
@@ -0,0 +1,112 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import inspect
+import sys
+import time
+
+from ckan.lib.cli import CkanCommand
+
+# Do not import modules for CKAN or ckanext-discovery here (unless you know
+# what you're doing), since their loggers won't work if imported before the
+# CKAN configuration has been loaded.
+
+
+def _error(msg):
+    sys.exit('ERROR: ' + msg)
+
+
+class SimilarDatasetsCommand(CkanCommand):
+    """
+    Utilities for the similar_datasets plugin.
+
+    Sub-commands:
+
+        init:
+            Create the database tables for precomputed similar datasets
+            and for the local similarity engine.
+
+        precompute [--num=N] [--workers=W]:
+            Compute the N (defaults to
+            ckanext.discovery.similar_datasets.max_num) most similar
+            datasets of all public datasets and store them in the
+            database. At most W (default: 4) queries are sent to Solr
+            concurrently. Requires
+            ckanext.discovery.similar_datasets.precomputed to be enabled.
+
+        build-index:
+            Build the index file of the local similarity engine from the
+            signatures of all public datasets. The signatures are updated
+            whenever a dataset is indexed, so use "search-index rebuild"
+            to create them initially. Requires
+            ckanext.discovery.similar_datasets.engine to be "local".
+
+    """
+    max_args = None
+    min_args = 0
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def __init__(self, name):
+        super(SimilarDatasetsCommand, self).__init__(name)
+        self.parser.add_option('-n', '--num', type='int', default=None,
+                               help='Number of similar datasets to store')
+        self.parser.add_option('-w', '--workers', type='int', default=4,
+                               help='Number of concurrent Solr queries')
+
+    def command(self):
+        if not self.args:
+            _error('Missing command name. Try --help.')
+        self._load_config()
+        cmd = self.args[0]
+        try:
+            method = getattr(self, 'cmd_' + cmd.replace('-', '_'))
+        except AttributeError:
+            _error('Unknown command "{}". Try --help.'.format(cmd))
+        spec = inspect.getargspec(method)
+        if not spec.varargs and len(self.args) > len(spec.args):
+            _error('Too many arguments for command "{}". Try --help.'.format(
+                   cmd))
+        method(*self.args[1:])
+
+    def cmd_init(self):
+        from .model import create_tables
+        print('Creating database tables...')
+        create_tables()
+        print('Done.')
+
+    def cmd_precompute(self):
+        from .. import get_config
+        from .precompute import is_enabled, precompute
+        if not is_enabled():
+            _error('Precomputed similar datasets are not enabled. Set '
+                   'ckanext.discovery.similar_datasets.precomputed to true.')
+        num = self.options.num
+        if num is None:
+            num = int(get_config('similar_datasets.max_num', 5))
+        if self.options.workers < 1:
+            _error('Number of workers must be positive.')
+
+        def progress(total):
+            print('\rProcessed {} datasets'.format(total), end='')
+            sys.stdout.flush()
+
+        start = time.time()
+        total = precompute(num, self.options.workers, progress)
+        print('\rProcessed {} datasets in {:.0f} seconds.'.format(
+              total, time.time() - start))
+
+    def cmd_build_index(self):
+        from .local import build_index, get_index_path, is_enabled, \
+            iter_signatures
+        if not is_enabled():
+            _error('The local similarity engine is not enabled. Set '
+                   'ckanext.discovery.similar_datasets.engine to "local".')
+        path = get_index_path()
+        print('Building index "{}"...'.format(path))
+        start = time.time()
+        count = build_index(iter_signatures(), path)
+        print('Indexed {} datasets in {:.0f} seconds.'.format(
+              count, time.time() - start))
@@ -0,0 +1,216 @@
+# encoding: utf-8
+
+'''
+Precomputed similar datasets.
+
+Instead of querying Solr's MoreLikeThis handler for every dataset page
+view, the similar datasets of all datasets can be computed in advance
+(see ``precompute``) and stored in the database. Entries of changed
+datasets are invalidated (see ``invalidate``) and are recomputed the
+next time they are requested. Invalidation covers the changed dataset
+and the datasets that list it as similar, but a new or changed dataset
+only shows up in the lists of other datasets once those have been
+recomputed.
+
+Precomputation is enabled via
+``ckanext.discovery.similar_datasets.precomputed``. Since the addition of
+a dataset can change the similar datasets of any other dataset, stored
+entries are only used for ``ckanext.discovery.similar_datasets.max_age``
+seconds.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+
+import ckan.plugins.toolkit as toolkit
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from .model import SimilarityComputation, SimilarDataset
+from .solr import iter_dataset_ids, more_like_this_batch
+from .. import get_config
+from ...model import run_read, transaction
+
+
+log = logging.getLogger(__name__)
+
+_computations = SimilarityComputation.__table__
+_similar = SimilarDataset.__table__
+
+# Number of datasets whose similar datasets are computed and stored
+# together by a worker of ``precompute``
+BATCH_SIZE = 100
+
+# Maximum number of attempts for storing a batch. Storing has to be retried
+# if a concurrent transaction has stored one of the same datasets.
+MAX_STORE_ATTEMPTS = 3
+
+
+def is_enabled():
+    '''
+    Whether precomputed similar datasets are used.
+    '''
+    return toolkit.asbool(get_config('similar_datasets.precomputed', False))
+
+
+def get_max_age():
+    '''
+    The maximum age of stored similar datasets in seconds.
+    '''
+    return float(get_config('similar_datasets.max_age', 24 * 60 * 60))
+
+
+def get_similar_ids(id):
+    '''
+    Get the precomputed similar datasets of a dataset.
+
+    Returns a tuple ``(num, similar)`` where ``num`` is the maximum
+    number of similar datasets that was requested when they were
+    computed and ``similar`` is a list of ``(id, score)`` tuples sorted
+    by decreasing score. Returns None if no similar datasets have been
+    computed for the dataset or if they are older than the maximum age
+    (see ``get_max_age``).
+    '''
+    min_computed_at = (datetime.datetime.utcnow()
+                       - datetime.timedelta(seconds=get_max_age()))
+    query = select([_computations.c.num, _similar.c.similar_id,
+                    _similar.c.score]) \
+        .select_from(_computations.outerjoin(
+                     _similar,
+                     _similar.c.dataset_id == _computations.c.dataset_id)) \
+        .where(_computations.c.dataset_id == id) \
+        .where(_computations.c.computed_at >= min_computed_at) \
+        .order_by(_similar.c.rank)
+    rows = run_read(lambda session: session.execute(query).fetchall())
+    if not rows:
+        return None
+    similar = [(row.similar_id, row.score) for row in rows
+               if row.similar_id is not None]
+    return rows[0].num, similar
+
+
+def store(computations):
+    '''
+    Store similar datasets.
+
+    ``computations`` is a list of ``(id, num, similar)`` tuples, see
+    ``get_similar_ids``. Previously stored similar datasets of the same
+    datasets are replaced.
+    '''
+    if not computations:
+        return
+    ids = [id for id, _, _ in computations]
+    now = datetime.datetime.utcnow()
+    computation_rows = []
+    similar_rows = []
+    for id, num, similar in computations:
+        computation_rows.append({'dataset_id': id, 'num': num,
+                                 'computed_at': now})
+        similar_rows.extend({'dataset_id': id, 'rank': rank,
+                             'similar_id': similar_id, 'score': score}
+                            for rank, (similar_id, score)
+                            in enumerate(similar))
+    with transaction() as conn:
+        conn.execute(_similar.delete().where(_similar.c.dataset_id.in_(ids)))
+        conn.execute(_computations.delete().where(
+                     _computations.c.dataset_id.in_(ids)))
+        conn.execute(_computations.insert(), computation_rows)
+        if similar_rows:
+            conn.execute(_similar.insert(), similar_rows)
+
+
+def invalidate(id):
+    '''
+    Invalidate the precomputed similar datasets affected by a change.
+
+    Deletes the similar datasets of the dataset with the given ID and of
+    all datasets that list it as similar.
+    '''
+    with transaction() as conn:
+        referrers = conn.execute(select([_similar.c.dataset_id]).where(
+                                 _similar.c.similar_id == id))
+        ids = [id] + [row.dataset_id for row in referrers]
+        conn.execute(_similar.delete().where(_similar.c.dataset_id.in_(ids)))
+        conn.execute(_computations.delete().where(
+                     _computations.c.dataset_id.in_(ids)))
+    log.debug('Invalidated the similar datasets of %d datasets', len(ids))
+
+
+def delete_older_than(timestamp):
+    '''
+    Delete similar datasets that have been computed before a time.
+
+    ``timestamp`` is a ``datetime.datetime`` in UTC. Returns the number
+    of datasets whose similar datasets were deleted.
+    '''
+    outdated = select([_computations.c.dataset_id]).where(
+        _computations.c.computed_at < timestamp)
+    with transaction() as conn:
+        conn.execute(_similar.delete().where(
+                     _similar.c.dataset_id.in_(outdated)))
+        result = conn.execute(_computations.delete().where(
+                              _computations.c.computed_at < timestamp))
+        return result.rowcount
+
+
+def _compute_batch(args):
+    ids, num = args
+    similar = more_like_this_batch(ids, num)
+    computations = [(id, num, [(doc['id'], doc['score'])
+                               for doc in similar[id]])
+                    for id in ids]
+    for attempt in range(MAX_STORE_ATTEMPTS):
+        try:
+            store(computations)
+            break
+        except IntegrityError:
+            if attempt == MAX_STORE_ATTEMPTS - 1:
+                raise
+            log.debug('Concurrent update while storing similar datasets, '
+                      'retrying')
+    return len(ids)
+
+
+def precompute(num, workers=4, progress=None):
+    '''
+    Compute and store the similar datasets of all datasets.
+
+    ``num`` is the maximum number of similar datasets per dataset.
+    ``workers`` is the maximum number of concurrent MoreLikeThis queries.
+    The datasets are processed in batches of ``BATCH_SIZE``. The similar
+    datasets of each batch are retrieved using a single Solr query (see
+    ``more_like_this_batch``) and are stored in a single transaction.
+
+    ``progress`` is an optional callable that is called with the number
+    of processed datasets after each batch.
+
+    Once all datasets have been processed, the similar datasets of
+    datasets that no longer exist (or are no longer public) are deleted.
+
+    Returns the number of processed datasets.
+    '''
+    start = datetime.datetime.utcnow()
+    total = 0
+    pool = ThreadPool(workers)
+    try:
+        batches = ((ids, num) for ids in iter_dataset_ids(BATCH_SIZE))
+        for count in pool.imap_unordered(_compute_batch, batches):
+            total += count
+            if progress:
+                progress(total)
+    except BaseException:
+        # Don't wait for the remaining batches
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    num_deleted = delete_older_than(start)
+    log.debug('Deleted the similar datasets of %d outdated datasets',
+              num_deleted)
+    return total
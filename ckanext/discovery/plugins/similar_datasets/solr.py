@@ -0,0 +1,213 @@
+# encoding: utf-8
+
+'''
+Solr queries for similar datasets.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+
+from ckan.common import config
+
+from .. import get_config
+from ...metrics import get_registry
+from ...solr import filter_query, is_public, PUBLIC_FIELDS, query
+from ...tracing import span
+
+
+log = logging.getLogger(__name__)
+
+_solr_duration = get_registry().histogram(
+    'discovery_similar_datasets_solr_duration_seconds',
+    'Duration of Solr queries for similar datasets')
+_solr_errors = get_registry().counter(
+    'discovery_similar_datasets_solr_errors_total',
+    'Failed Solr queries for similar datasets')
+
+# Prefix of the config options for the parameters of the MoreLikeThis
+# search component (see ``more_like_this_batch``)
+MLT_PARAMS_PREFIX = 'ckanext.discovery.similar_datasets.mlt.'
+
+# Default parameters of the MoreLikeThis search component. These are the
+# same as the defaults of the MoreLikeThis handler in the test setup.
+MLT_DEFAULTS = {
+    'mintf': 1,
+    'mindf': 1,
+    'minwl': 3,
+}
+
+# The MoreLikeThis search component ignores filter queries, so its results
+# are filtered afterwards. To get enough results despite that, this factor
+# times the requested number of similar documents is fetched.
+MLT_OVERFETCH = 2
+
+# Dataset fields that are returned by default. These are the ones used by
+# the templates and the ``discovery_similar_datasets`` action.
+DEFAULT_FIELDS = 'name title notes'
+
+
+def get_fields():
+    '''
+    Get the dataset fields that are returned by default.
+
+    The fields are read from the config option
+    ``ckanext.discovery.similar_datasets.fields`` and must be stored in
+    Solr. Returns a tuple of field names, which always includes ``id``.
+    '''
+    fields = get_config('similar_datasets.fields', DEFAULT_FIELDS).split()
+    return tuple(['id'] + [f for f in fields if f != 'id'])
+
+
+def _field_list(fields):
+    '''
+    Solr field list for retrieving dataset dicts (see ``parse_docs``).
+    '''
+    if fields is None:
+        return 'id validated_data_dict'
+    return ' '.join(['id'] + [f for f in fields if f != 'id'])
+
+
+def parse_docs(docs, fields=None):
+    '''
+    Convert Solr documents into dataset dicts.
+
+    If ``fields`` is None then the full dataset dicts are parsed from the
+    documents' ``validated_data_dict``. Otherwise the dataset dicts
+    contain the given fields, missing values are set to None.
+    '''
+    with span('parse'):
+        if fields is None:
+            return [json.loads(doc['validated_data_dict']) for doc in docs]
+        return [{field: doc.get(field) for field in fields} for doc in docs]
+
+
+def more_like_this(id, max_num, fields=()):
+    '''
+    Find similar datasets using Solr's MoreLikeThis handler.
+
+    Returns a list of Solr documents sorted by decreasing score. Each
+    document contains the ``id`` and ``score`` of a dataset and the
+    values of the given ``fields``. If ``fields`` is None then the
+    documents contain the data for full dataset dicts instead (see
+    ``parse_docs``).
+    '''
+    fields_to_compare = 'text'
+    try:
+        with _solr_duration.time(), span('more_like_this'):
+            results = query('more_like_this',
+                            q='id:"{}"'.format(id),
+                            mltfl=fields_to_compare,
+                            fl=_field_list(fields) + ' score',
+                            fq=filter_query(),
+                            rows=max_num)
+    except Exception:
+        _solr_errors.inc()
+        raise
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Similar datasets for %s: %s', id,
+                  ', '.join('{id} ({score})'.format(**doc)
+                            for doc in results.docs))
+    return results.docs
+
+
+def get_mlt_params():
+    '''
+    Get the parameters of the MoreLikeThis search component.
+
+    The defaults from ``MLT_DEFAULTS`` can be overridden via config
+    options with the prefix ``MLT_PARAMS_PREFIX``. Returns a dict of Solr
+    parameters.
+    '''
+    params = dict(MLT_DEFAULTS)
+    for key, value in config.iteritems():
+        if key.startswith(MLT_PARAMS_PREFIX):
+            params[key[len(MLT_PARAMS_PREFIX):]] = value
+    return {'mlt.' + key: value for key, value in params.iteritems()}
+
+
+def more_like_this_batch(ids, max_num, fields=()):
+    '''
+    Find similar datasets for several datasets in a single Solr query.
+
+    Uses Solr's MoreLikeThis search component instead of the handler
+    used by ``more_like_this``, so that the cost is one query regardless
+    of the number of datasets. Its parameters can be configured, see
+    ``get_mlt_params``.
+
+    Returns a dict that maps each ID in ``ids`` to a list of Solr
+    documents as returned by ``more_like_this``. The lists of datasets
+    that do not exist or that are not public are empty.
+    '''
+    if not ids:
+        return {}
+    fl = ' '.join((_field_list(fields), 'score', 'index_id') +
+                  PUBLIC_FIELDS)
+    params = get_mlt_params()
+    params.update({
+        'fq': filter_query(),
+        'fl': fl,
+        'rows': len(ids),
+        'mlt': 'true',
+        'mlt.fl': 'text',
+        'mlt.count': max_num * MLT_OVERFETCH,
+    })
+    q = ' OR '.join('id:"{}"'.format(id) for id in ids)
+    try:
+        with _solr_duration.time(), span('more_like_this_batch'):
+            results = query('search', q, **params)
+    except Exception:
+        _solr_errors.inc()
+        raise
+    # The MoreLikeThis results are keyed by Solr's unique key, which is
+    # ``index_id`` instead of the dataset ID
+    index_ids = {doc['id']: doc['index_id'] for doc in results.docs}
+    similar = {}
+    for id in ids:
+        mlt = results.more_like_this.get(index_ids.get(id), {})
+        docs = mlt.get('docs', [])
+        similar[id] = [doc for doc in docs if is_public(doc)][:max_num]
+    return similar
+
+
+def get_datasets(ids, fields=None):
+    '''
+    Get the dataset dicts of datasets from Solr.
+
+    Datasets that do not exist or that are not public (see
+    ``ckanext.discovery.solr.filter_query``) are skipped. Returns a list
+    of dataset dicts in the order of ``ids``. ``fields`` is passed on to
+    ``parse_docs``.
+    '''
+    if not ids:
+        return []
+    q = ' OR '.join('id:"{}"'.format(id) for id in ids)
+    try:
+        with _solr_duration.time(), span('datasets'):
+            results = query('search', q, fq=filter_query(),
+                            fl=_field_list(fields), rows=len(ids))
+    except Exception:
+        _solr_errors.inc()
+        raise
+    datasets = {dataset['id']: dataset
+                for dataset in parse_docs(results.docs, fields)}
+    return [datasets[id] for id in ids if id in datasets]
+
+
+def iter_dataset_ids(batch_size=100):
+    '''
+    Iterate over the IDs of all public datasets.
+
+    Yields lists of at most ``batch_size`` IDs.
+    '''
+    start = 0
+    while True:
+        results = query('search', '*:*', fq=filter_query(), fl='id',
+                        sort='id asc', start=start, rows=batch_size)
+        ids = [doc['id'] for doc in results.docs]
+        if not ids:
+            return
+        yield ids
+        start += len(ids)
@@ -9,42 +9,170 @@ import logging
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
-from ckan.common import config
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import tag_counts
+from .. import get_config
+from ...cache import TTLCache
+from ...metrics import get_registry
+from ...prefetch import is_current_page, prefetchable
+from ...solr import filter_query, query, SolrUnavailable
+from ...tracing import span, traced
 
 
 log = logging.getLogger(__name__)
 
+_facet_duration = get_registry().histogram(
+    'discovery_tag_cloud_facet_duration_seconds',
+    'Duration of the facet queries for the tag cloud')
 
-def bin_tags(num_tags=20, num_bins=5):
+# Cache key of the tag counts. The binned tags are cached using keys of
+# the form ``(num_tags, num_bins)``.
+_COUNTS_KEY = 'counts'
+
+_cache = None
+
+
+def _get_cache():
     '''
-    Distribute tags into bins according to their frequency.
+    Get the cache for the tag cloud.
+
+    The cache contains the tag counts for the largest number of tags
+    requested so far and the binned tags for each combination of
+    parameters of ``bin_tags``. It is cleared whenever a dataset is
+    created, updated or deleted in this process. Changes made by other
+    processes show up once the entries expire after
+    ``ckanext.discovery.tag_cloud.cache_ttl`` seconds.
+    '''
+    global _cache
+    ttl = float(get_config('tag_cloud.cache_ttl', 300))
+    if _cache is None or _cache.ttl != ttl:
+        _cache = TTLCache(max_size=100, ttl=ttl)
+    return _cache
+
+
+def _cache_requests():
+    if _cache is None:
+        return {}
+    return {'hit': _cache.hits, 'miss': _cache.misses}
+
 
-    Returns a dict with top ``num_tags`` tags, assigned to ``num_bins``
-    bins based on their frequency. Each tag is mapped to a value between
-    ``1`` and ``num_bins`` (inclusively).
+get_registry().counter_function(
+    'discovery_tag_cloud_cache_requests_total',
+    'Lookups in the cache of the tag cloud', _cache_requests, ['result'])
+
+
+def _get_tag_counts(num_tags):
     '''
-    data_dict = {
-        'facet.field': ['tags'],
+    Get the number of public datasets for the most frequent tags.
+
+    Returns a list of ``(tag, count)`` tuples for the ``num_tags`` most
+    frequent tags, sorted by decreasing count. If stored tag counts are
+    enabled then they are used (see ``tag_counts``). Otherwise only the
+    facet counts are requested from Solr, no datasets.
+    '''
+    if tag_counts.is_enabled():
+        with span('stored_counts'):
+            return tag_counts.get_tag_counts(num_tags)
+    params = {
+        'fq': filter_query(),
+        'rows': 0,  # Only the facet counts are needed
+        'facet': 'true',
+        'facet.field': 'tags',
         'facet.limit': num_tags,
+        'facet.mincount': 1,
     }
-    result = toolkit.get_action('package_search')({}, data_dict)
+    with _facet_duration.time(), span('facet_query'):
+        results = query('search', '*:*', **params)
+    # Solr returns a flat list of alternating values and counts
+    counts = results.facets['facet_fields']['tags']
+    return zip(counts[::2], counts[1::2])
+
+
+def _get_cached_tag_counts(num_tags):
+    '''
+    Like ``_get_tag_counts`` but cached.
+
+    The counts are fetched for at least as many tags as are shown by
+    default, so that snippets with fewer tags are served from the same
+    cache entry.
+    '''
+    cache = _get_cache()
+    entry = cache.get(_COUNTS_KEY)
+    if entry is not None:
+        num, counts = entry
+        # If fewer tags than requested were found then there are no more
+        if num_tags <= num or len(counts) < num:
+            return counts[:num_tags]
+    num = max(num_tags, int(get_config('tag_cloud.num_tags', 20)))
+    counts = _get_tag_counts(num)
+    cache.set(_COUNTS_KEY, (num, counts))
+    return counts[:num_tags]
+
+
+@prefetchable('tag_cloud', default={})
+@traced('tag_cloud')
+def bin_tags(num_tags=20, num_bins=5):
+    '''
+    Distribute tags into bins according to their frequency.
+
+    Returns a dict with top ``num_tags`` tags of the public datasets,
+    assigned to ``num_bins`` bins based on their frequency. Each tag is
+    mapped to a value between ``1`` and ``num_bins`` (inclusively).
+
+    Results are cached, see ``_get_cache``. Returns an empty dict if Solr
+    is not available (see ``ckanext.discovery.solr``). On the pages
+    listed in ``ckanext.discovery.tag_cloud.prefetch`` the call is
+    prefetched, see ``ckanext.discovery.prefetch``.
+    '''
+    cache = _get_cache()
+    bins = cache.get((num_tags, num_bins))
+    if bins is not None:
+        return dict(bins)
+    try:
+        counts = _get_cached_tag_counts(num_tags)
+    except SolrUnavailable as e:
+        # Leave out the tag cloud instead of breaking the page
+        log.warning('Could not get tag counts: %s', e)
+        return {}
+    except SQLAlchemyError:
+        log.exception('Could not read stored tag counts')
+        return {}
 
     tags_by_count = collections.defaultdict(list)
-    for tag, count in result['facets']['tags'].iteritems():
+    for tag, count in counts:
         tags_by_count[count].append(tag)
     tags_by_count = sorted(tags_by_count.iteritems(), key=lambda t: t[0])
-    log.debug('tags_by_count: {}'.format(tags_by_count))
+    log.debug('tags_by_count: %s', tags_by_count)
 
     bins = {}
     for i, (count, tags) in enumerate(tags_by_count):
         bin = int(math.floor(num_bins * i / len(tags_by_count))) + 1
         for tag in tags:
             bins[tag] = bin
-    return bins
+    cache.set((num_tags, num_bins), bins)
+    return dict(bins)
+
+
+def _prefetch():
+    '''
+    Prefetch the tag cloud if it is shown on the current page.
+
+    The pages are configured via ``ckanext.discovery.tag_cloud.prefetch``
+    as a space-separated list of ``controller.action`` names.
+    '''
+    pages = get_config('tag_cloud.prefetch', 'home.index').split()
+    for page in pages:
+        controller, _, action = page.partition('.')
+        if is_current_page(controller, action):
+            # Same arguments as in the ``tag_cloud.html`` snippet
+            bin_tags.prefetch(int(get_config('tag_cloud.num_tags', 20)))
+            return
 
 
 class TagCloudPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
 
     #
@@ -56,6 +184,39 @@ class TagCloudPlugin(plugins.SingletonPlugin):
         # See https://github.com/ckan/ckan/issues/3397 for `b` prefixes
         toolkit.add_resource(b'fanstatic', b'discovery_tag_cloud')
 
+    #
+    # IPackageController
+    #
+
+    # The search on the front page and the dataset page are the first
+    # occasions to start the query for the tag cloud
+
+    def before_search(self, search_params):
+        _prefetch()
+        return search_params
+
+    def before_view(self, pkg_dict):
+        _prefetch()
+        return pkg_dict
+
+    def after_create(self, context, pkg_dict):
+        self._update(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._update(pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        self._update(pkg_dict)
+
+    def _update(self, pkg_dict):
+        if tag_counts.is_enabled():
+            try:
+                tag_counts.sync(pkg_dict.get('id') or pkg_dict['name'])
+            except SQLAlchemyError:
+                # Don't let the update of the dataset fail
+                log.exception('Could not update tag counts')
+        _get_cache().clear()
+
     #
     # ITemplateHelpers
     #
@@ -0,0 +1,54 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+from sqlalchemy import Column, types
+from sqlalchemy.ext.declarative import declarative_base
+
+from ...model import get_engine, Object
+
+
+log = logging.getLogger(__name__)
+
+Base = declarative_base(cls=Object)
+
+
+class DatasetTag(Base):
+    '''
+    A tag of an active, public dataset.
+
+    Used to determine which tag counts change when a dataset is updated.
+    '''
+    __tablename__ = 'discovery_dataset_tag'
+    dataset_id = Column(types.UnicodeText, primary_key=True, nullable=False)
+    tag = Column(types.UnicodeText, primary_key=True, nullable=False)
+
+    def __repr__(self):
+        r = '<{} "{}", "{}">'.format(self.__class__.__name__,
+                                     self.dataset_id, self.tag)
+        return r.encode('utf-8')
+
+
+class TagCount(Base):
+    '''
+    The number of active, public datasets that have a tag.
+    '''
+    __tablename__ = 'discovery_tag_count'
+    tag = Column(types.UnicodeText, primary_key=True, nullable=False)
+    count = Column(types.Integer, nullable=False, index=True)
+
+    def __repr__(self):
+        r = '<{} "{}" {}>'.format(self.__class__.__name__, self.tag,
+                                  self.count)
+        return r.encode('utf-8')
+
+
+def create_tables():
+    '''
+    Create the necessary database tables.
+    '''
+    log.debug('Creating database tables')
+    Base.metadata.create_all(get_engine())
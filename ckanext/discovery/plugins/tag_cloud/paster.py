@@ -0,0 +1,70 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import inspect
+import sys
+import time
+
+from ckan.lib.cli import CkanCommand
+
+# Do not import modules for CKAN or ckanext-discovery here (unless you know
+# what you're doing), since their loggers won't work if imported before the
+# CKAN configuration has been loaded.
+
+
+def _error(msg):
+    sys.exit('ERROR: ' + msg)
+
+
+class TagCloudCommand(CkanCommand):
+    """
+    Utilities for the tag_cloud plugin.
+
+    Sub-commands:
+
+        init:
+            Create the database tables for stored tag counts.
+
+        rebuild:
+            Recompute the stored tag counts from the datasets in CKAN's
+            database. Requires ckanext.discovery.tag_cloud.source to be
+            "database".
+
+    """
+    max_args = None
+    min_args = 0
+    usage = __doc__
+    summary = __doc__.strip().split('\n')[0]
+
+    def command(self):
+        if not self.args:
+            _error('Missing command name. Try --help.')
+        self._load_config()
+        cmd = self.args[0]
+        try:
+            method = getattr(self, 'cmd_' + cmd.replace('-', '_'))
+        except AttributeError:
+            _error('Unknown command "{}". Try --help.'.format(cmd))
+        spec = inspect.getargspec(method)
+        if not spec.varargs and len(self.args) > len(spec.args):
+            _error('Too many arguments for command "{}". Try --help.'.format(
+                   cmd))
+        method(*self.args[1:])
+
+    def cmd_init(self):
+        from .model import create_tables
+        print('Creating database tables...')
+        create_tables()
+        print('Done.')
+
+    def cmd_rebuild(self):
+        from .tag_counts import is_enabled, rebuild
+        if not is_enabled():
+            _error('Stored tag counts are not enabled. Set '
+                   'ckanext.discovery.tag_cloud.source to "database".')
+        start = time.time()
+        num = rebuild()
+        print('Counted {} tags in {:.0f} seconds.'.format(
+              num, time.time() - start))
@@ -0,0 +1,204 @@
+# encoding: utf-8
+
+'''
+Tag counts stored in the database.
+
+Instead of computing the tag counts for every tag cloud via a Solr facet
+query, the number of active, public datasets per tag can be stored in the
+database (see ``TagCount``). The counts are kept up to date when datasets
+are created, updated or deleted (see ``sync``). Operations that bypass
+CKAN's hooks (for example purging datasets or bulk updates of several
+datasets) are only reflected after the counts have been rebuilt (see
+``rebuild``).
+
+``sync`` is called from CKAN's ``after_*`` hooks, i.e. before CKAN commits
+its own transaction, and it reads the dataset from CKAN's (uncommitted)
+session. The stored counts, however, are committed immediately on the
+extension's own engine. If CKAN's transaction is rolled back afterwards,
+the stored counts are off until they are rebuilt.
+
+The stored counts are used if ``ckanext.discovery.tag_cloud.source`` is
+set to ``database``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+
+from ckan import model
+from sqlalchemy import and_, func, select
+from sqlalchemy.exc import IntegrityError
+
+from .model import DatasetTag, TagCount
+from .. import get_config
+from ...model import run_read, transaction
+
+
+log = logging.getLogger(__name__)
+
+_tags = DatasetTag.__table__
+_counts = TagCount.__table__
+
+# Maximum number of attempts for updating the tags of a dataset. Updating
+# has to be retried if a concurrent transaction has added the same tag.
+MAX_UPDATE_ATTEMPTS = 3
+
+# Number of rows that are inserted at once by ``rebuild``
+BATCH_SIZE = 1000
+
+
+def is_enabled():
+    '''
+    Whether the stored tag counts are used.
+    '''
+    return get_config('tag_cloud.source', 'solr') == 'database'
+
+
+def get_tag_counts(num_tags):
+    '''
+    Get the stored number of datasets for the most frequent tags.
+
+    Returns a list of ``(tag, count)`` tuples for the ``num_tags`` most
+    frequent tags, sorted by decreasing count.
+    '''
+    query = select([_counts.c.tag, _counts.c.count]) \
+        .order_by(_counts.c.count.desc(), _counts.c.tag) \
+        .limit(num_tags)
+    rows = run_read(lambda session: session.execute(query).fetchall())
+    return [(row.tag, row.count) for row in rows]
+
+
+def get_counted_tags(pkg):
+    '''
+    Get the tags of a dataset that are counted.
+
+    ``pkg`` is a ``ckan.model.Package`` or None. Returns the set of the
+    names of the free tags (i.e. not those from vocabularies) of the
+    dataset if it is active and public, and an empty set otherwise. This
+    matches the tags used by the Solr facet query.
+    '''
+    if (pkg is None or pkg.state != model.State.ACTIVE or pkg.private
+            or pkg.type != 'dataset'):
+        return set()
+    return {tag.name for tag in pkg.get_tags()}
+
+
+def _delete_tags(conn, id, tags):
+    '''
+    Delete tags of a dataset from the ``DatasetTag`` table.
+
+    Returns the list of the tags that were deleted.
+    '''
+    if conn.dialect.name == 'postgresql':
+        query = _tags.delete().where(and_(_tags.c.dataset_id == id,
+                                          _tags.c.tag.in_(tags))) \
+            .returning(_tags.c.tag)
+        return sorted(row.tag for row in conn.execute(query))
+    # Other databases may not support RETURNING, so the tags are deleted
+    # one by one
+    deleted = []
+    for tag in tags:
+        result = conn.execute(_tags.delete().where(and_(
+                              _tags.c.dataset_id == id,
+                              _tags.c.tag == tag)))
+        if result.rowcount:
+            deleted.append(tag)
+    return deleted
+
+
+def _update(id, tags):
+    with transaction() as conn:
+        old_tags = {row.tag for row in conn.execute(
+                    select([_tags.c.tag]).where(_tags.c.dataset_id == id))}
+        removed = sorted(old_tags - tags)
+        added = sorted(tags - old_tags)
+        if removed:
+            # A concurrent transaction may have removed the same rows in
+            # the meantime, so only the tags that were actually deleted
+            # here are decremented.
+            removed = _delete_tags(conn, id, removed)
+        if removed:
+            conn.execute(_counts.update()
+                         .where(_counts.c.tag.in_(removed))
+                         .values(count=_counts.c.count - 1))
+            conn.execute(_counts.delete().where(and_(
+                         _counts.c.tag.in_(removed),
+                         _counts.c.count <= 0)))
+        if added:
+            conn.execute(_tags.insert(), [{'dataset_id': id, 'tag': tag}
+                                          for tag in added])
+            result = conn.execute(_counts.update()
+                                  .where(_counts.c.tag.in_(added))
+                                  .values(count=_counts.c.count + 1))
+            if result.rowcount < len(added):
+                existing = {row.tag for row in conn.execute(
+                            select([_counts.c.tag])
+                            .where(_counts.c.tag.in_(added)))}
+                conn.execute(_counts.insert(), [{'tag': tag, 'count': 1}
+                                                for tag in added
+                                                if tag not in existing])
+    return bool(removed or added)
+
+
+def sync(id):
+    '''
+    Update the stored tag counts after a dataset has changed.
+
+    ``id`` is the ID or name of the dataset. Returns True if the tag
+    counts have changed.
+    '''
+    pkg = model.Package.get(id)
+    if pkg is not None:
+        id = pkg.id
+    tags = get_counted_tags(pkg)
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        try:
+            return _update(id, tags)
+        except IntegrityError:
+            if attempt == MAX_UPDATE_ATTEMPTS - 1:
+                raise
+            log.debug('Concurrent update of tag counts, retrying')
+
+
+def _iter_dataset_tags():
+    '''
+    Iterate over the counted tags of all datasets.
+
+    Yields ``(dataset_id, tag)`` tuples.
+    '''
+    query = model.Session.query(model.Package.id, model.Tag.name) \
+        .join(model.PackageTag,
+              model.PackageTag.package_id == model.Package.id) \
+        .join(model.Tag, model.Tag.id == model.PackageTag.tag_id) \
+        .filter(model.Package.state == model.State.ACTIVE,
+                model.Package.private.is_(False),
+                model.Package.type == 'dataset',
+                model.PackageTag.state == model.State.ACTIVE,
+                model.Tag.vocabulary_id.is_(None))
+    return query.yield_per(BATCH_SIZE)
+
+
+def rebuild():
+    '''
+    Recompute the stored tag counts from CKAN's database.
+
+    Returns the number of distinct tags.
+    '''
+    with transaction() as conn:
+        conn.execute(_counts.delete())
+        conn.execute(_tags.delete())
+        batch = []
+        for dataset_id, tag in _iter_dataset_tags():
+            batch.append({'dataset_id': dataset_id, 'tag': tag})
+            if len(batch) >= BATCH_SIZE:
+                conn.execute(_tags.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(_tags.insert(), batch)
+        conn.execute(_counts.insert().from_select(
+                     ['tag', 'count'],
+                     select([_tags.c.tag, func.count()])
+                     .group_by(_tags.c.tag)))
+        return conn.execute(select([func.count()])
+                            .select_from(_counts)).scalar()
@@ -0,0 +1,292 @@
+# encoding: utf-8
+
+'''
+Parallel prefetching of Solr-backed widgets.
+
+Template helpers like ``discovery_similar_datasets`` and
+``discovery_bin_tags`` query Solr while a page is rendered, one after
+another. Functions decorated with ``prefetchable`` can instead be started
+early, for example from an ``IPackageController`` hook, using their
+``prefetch`` attribute::
+
+    get_similar_datasets.prefetch(id, max_num=5)
+
+The call is executed on a small thread pool that is shared by all
+requests of the process. When the template later calls the function with
+the same arguments during the same request, it waits for the prefetched
+result instead of querying Solr again. A page with several widgets
+therefore waits for the slowest of their queries instead of for the sum
+of them.
+
+The number of threads is set via ``ckanext.discovery.prefetch.workers``
+(defaults to 4, 0 disables prefetching). Waiting for a result is limited
+to ``ckanext.discovery.prefetch.timeout`` seconds (defaults to
+``ckanext.discovery.solr.timeout``), afterwards the function's default
+result is used and the prefetch is cancelled if it has not started yet.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import functools
+import inspect
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import ckan.plugins.toolkit as toolkit
+
+from .metrics import get_registry
+from .plugins import get_config
+from .solr import get_timeout
+
+
+log = logging.getLogger(__name__)
+
+_prefetches = get_registry().counter(
+    'discovery_prefetch_total',
+    'Prefetched widget results by outcome', ['name', 'result'])
+
+# Key in the WSGI environment under which the prefetches of a request
+# are stored
+_ENVIRON_KEY = 'ckanext.discovery.prefetch'
+
+
+class PrefetchTimeout(Exception):
+    '''
+    Raised when waiting for a prefetched result takes too long.
+    '''
+    pass
+
+
+class Prefetch(object):
+    '''
+    A function call that is executed in the background.
+
+    Similar to ``concurrent.futures.Future``: ``result`` waits for the
+    call to finish, ``cancel`` prevents it from being started.
+    '''
+    def __init__(self, func, args, kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+
+    def run(self):
+        '''
+        Execute the call unless it has been cancelled.
+        '''
+        with self._lock:
+            if self._cancelled:
+                return
+            self._started = True
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            log.debug('Prefetch of %s failed', self._func, exc_info=True)
+            self._exception = e
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        '''
+        Cancel the call if it has not been started yet.
+
+        Returns True if the call was cancelled.
+        '''
+        with self._lock:
+            if not self._started:
+                self._cancelled = True
+            return self._cancelled
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the call to finish and return its result.
+
+        Exceptions raised by the call are re-raised. Raises
+        ``PrefetchTimeout`` if the call has not finished after ``timeout``
+        seconds.
+        '''
+        if not self._done.wait(timeout):
+            raise PrefetchTimeout()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_pool_workers = None
+
+
+def get_workers():
+    '''
+    The number of threads used for prefetching.
+    '''
+    return int(get_config('prefetch.workers', 4))
+
+
+def get_prefetch_timeout():
+    '''
+    The maximum time in seconds that is spent waiting for a prefetch.
+    '''
+    return float(get_config('prefetch.timeout', get_timeout()))
+
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_workers
+    workers = get_workers()
+    with _lock:
+        # Threads don't survive forking, so worker processes of a
+        # pre-forking server need their own pool
+        if (_pool is None or _pool_pid != os.getpid()
+                or _pool_workers != workers):
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.close()
+            _pool = ThreadPool(workers)
+            _pool_pid = os.getpid()
+            _pool_workers = workers
+        return _pool
+
+
+def shutdown():
+    '''
+    Stop the thread pool.
+
+    Prefetches that have not been started are not executed.
+    '''
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+
+
+def _get_prefetches():
+    '''
+    Get the dict of the prefetches of the current request.
+
+    Returns None outside of a web request.
+    '''
+    try:
+        environ = toolkit.request.environ
+    except (AttributeError, TypeError):
+        return None
+    return environ.setdefault(_ENVIRON_KEY, {})
+
+
+def _unwrap(func):
+    '''
+    Get the original function of a decorated function.
+
+    Follows the ``__wrapped__`` attributes set by decorators like
+    ``tracing.traced``.
+    '''
+    while hasattr(func, '__wrapped__'):
+        func = func.__wrapped__
+    return func
+
+
+def _make_key(name, func, args, kwargs):
+    '''
+    Create the key of a call.
+
+    Calls that pass the same arguments positionally or by keyword, or
+    that rely on default values, get the same key. Returns None if the
+    arguments are not hashable.
+    '''
+    call_args = inspect.getcallargs(_unwrap(func), *args, **kwargs)
+    key = (name, tuple(sorted(call_args.iteritems())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def prefetchable(name, default=None):
+    '''
+    Decorator for functions that can be prefetched.
+
+    ``name`` identifies the function in metrics and logs. ``default`` is
+    returned when waiting for a prefetched result times out.
+
+    The decorator must be applied on top of other decorators like
+    ``tracing.traced`` and ``profiling.profiled``, so that prefetched
+    calls are traced and profiled on the thread that executes them.
+    Calls are matched with prefetches using the signature of the original
+    function, hence these decorators must set ``__wrapped__``.
+
+    The decorated function gets an additional ``prefetch`` attribute, a
+    function that takes the same arguments and starts the call in the
+    background. Returns True if a prefetch was started. Outside of web
+    requests, if prefetching is disabled or if the call is already being
+    prefetched nothing is started.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            prefetches = _get_prefetches()
+            if prefetches:
+                key = _make_key(name, func, args, kwargs)
+                prefetch = prefetches.pop(key, None) if key else None
+                if prefetch is not None:
+                    try:
+                        result = prefetch.result(get_prefetch_timeout())
+                    except PrefetchTimeout:
+                        prefetch.cancel()
+                        _prefetches.inc(name=name, result='timeout')
+                        log.warning('Timeout while waiting for prefetched '
+                                    '%s', name)
+                        return default
+                    _prefetches.inc(name=name, result='hit')
+                    return result
+            return func(*args, **kwargs)
+
+        def prefetch(*args, **kwargs):
+            if get_workers() <= 0:
+                return False
+            prefetches = _get_prefetches()
+            if prefetches is None:
+                return False
+            key = _make_key(name, func, args, kwargs)
+            if key is None or key in prefetches:
+                return False
+            prefetch = Prefetch(func, args, kwargs)
+            prefetches[key] = prefetch
+            _get_pool().apply_async(prefetch.run)
+            _prefetches.inc(name=name, result='started')
+            return True
+
+        wrapped.prefetch = prefetch
+        return wrapped
+    return decorator
+
+
+def is_current_page(controller, action):
+    '''
+    Whether the current request is handled by a controller action.
+
+    Useful for starting prefetches only on the pages that display the
+    corresponding widget. Returns False outside of web requests.
+    '''
+    try:
+        c = toolkit.c
+        return c.controller == controller and c.action == action
+    except (AttributeError, TypeError):
+        return False
@@ -0,0 +1,177 @@
+# encoding: utf-8
+
+'''
+Opt-in profiling of requests.
+
+Requests can be profiled using ``cProfile`` (see ``profile``), either
+explicitly (for example via the ``profile`` parameter of
+``discovery_search_suggest``) or randomly with the probability
+``ckanext.discovery.profiling.sample_rate``.
+
+Each capture is written to the directory
+``ckanext.discovery.profiling.directory`` as a ``.prof`` file, which can
+be read using ``pstats``, together with a ``.json`` file that contains
+the name of the request, its duration and additional metadata like the
+search query. Only the ``ckanext.discovery.profiling.max_files`` most
+recent captures are kept.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from .plugins import get_config
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_sample_rate():
+    '''
+    The probability with which a request is profiled.
+    '''
+    return float(get_config('profiling.sample_rate', 0))
+
+
+def get_directory():
+    '''
+    The directory to which profiles are written.
+    '''
+    return get_config('profiling.directory', os.path.join(
+                      tempfile.gettempdir(), 'ckanext-discovery-profiles'))
+
+
+def get_max_files():
+    '''
+    The maximum number of captures that are kept in the directory.
+
+    0 means that all captures are kept.
+    '''
+    return int(get_config('profiling.max_files', 100))
+
+
+def _prune(directory, max_files):
+    '''
+    Delete the oldest captures in a directory.
+
+    Keeps the ``max_files`` most recently modified captures.
+    '''
+    captures = []
+    for filename in os.listdir(directory):
+        if filename.endswith('.prof'):
+            path = os.path.join(directory, filename)
+            try:
+                captures.append((os.path.getmtime(path), path))
+            except OSError:
+                # Deleted by another process in the meantime
+                pass
+    captures.sort(reverse=True)
+    for _, path in captures[max_files:]:
+        for filename in (path, path[:-len('.prof')] + '.json'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+def _save(profiler, name, start, duration, forced, metadata):
+    directory = get_directory()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    timestamp = datetime.datetime.fromtimestamp(start)
+    basename = os.path.join(directory, '{}-{:%Y%m%d-%H%M%S-%f}-{}'.format(
+                            name, timestamp, os.getpid()))
+    profiler.dump_stats(basename + '.prof')
+    with open(basename + '.json', 'wb') as f:
+        json.dump({
+            'name': name,
+            'timestamp': start,
+            'duration': duration,
+            'pid': os.getpid(),
+            'forced': forced,
+            'metadata': metadata,
+        }, f, indent=2)
+    log.info('Saved profile of %s (%.1fms) to %s.prof', name,
+             duration * 1000, basename)
+    max_files = get_max_files()
+    if max_files > 0:
+        _prune(directory, max_files)
+    return basename + '.prof'
+
+
+class Capture(object):
+    '''
+    Result of ``profile``.
+    '''
+    def __init__(self):
+        #: File name of the ``.prof`` file once the profile has been saved
+        self.filename = None
+
+
+def _is_sampled():
+    rate = get_sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+@contextlib.contextmanager
+def profile(name, force=False, **metadata):
+    '''
+    Context manager for profiling a request.
+
+    The request is profiled if ``force`` is true or, otherwise, with the
+    configured sampling rate. Keyword arguments are stored in the
+    metadata of the capture. Profiles cannot be nested: while a profile
+    is active in the current thread no other profile is started.
+
+    Returns a ``Capture`` whose ``filename`` is set once the context
+    manager has been left, or None if the request is not profiled.
+    '''
+    if getattr(_local, 'active', False) or not (force or _is_sampled()):
+        yield None
+        return
+    capture = Capture()
+    profiler = cProfile.Profile()
+    _local.active = True
+    start = time.time()
+    profiler.enable()
+    try:
+        yield capture
+    finally:
+        profiler.disable()
+        duration = time.time() - start
+        _local.active = False
+        try:
+            capture.filename = _save(profiler, name, start, duration,
+                                     bool(force), metadata)
+        except (IOError, OSError) as e:
+            log.warning('Could not save profile of %s: %s', name, e)
+
+
+def profiled(name):
+    '''
+    Decorator for profiling a sampled fraction of calls of a function.
+
+    See ``profile``.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            with profile(name):
+                return f(*args, **kwargs)
+        # As in Python 3, see ``prefetch.prefetchable``
+        wrapped.__wrapped__ = f
+        return wrapped
+    return decorator
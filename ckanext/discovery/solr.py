@@ -0,0 +1,269 @@
+# encoding: utf-8
+
+'''
+Shared Solr client for the discovery plugins.
+
+All Solr queries of the plugins are sent via ``query``, which
+
+* reuses Solr connections (and their persistent HTTP connections)
+  across requests instead of creating a new one for every query,
+
+* limits the duration of each query
+  (``ckanext.discovery.solr.timeout``), and
+
+* stops sending queries for ``ckanext.discovery.solr.cool_down``
+  seconds after ``ckanext.discovery.solr.max_failures`` consecutive
+  queries have failed (see ``CircuitBreaker``).
+
+Failed and skipped queries raise ``SolrUnavailable``, so that
+Solr-backed widgets can be left out instead of blocking or breaking the
+page.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import threading
+import time
+
+from ckan.common import config
+from ckan.lib.search.common import make_connection
+import pysolr
+
+from .metrics import get_registry
+from .plugins import get_config
+
+
+log = logging.getLogger(__name__)
+
+_requests = get_registry().counter(
+    'discovery_solr_requests_total',
+    'Solr queries by outcome', ['method', 'result'])
+_duration = get_registry().histogram(
+    'discovery_solr_duration_seconds',
+    'Duration of Solr queries', ['method'])
+
+
+class SolrUnavailable(Exception):
+    '''
+    Raised when a Solr query fails or is skipped by the circuit breaker.
+    '''
+    pass
+
+
+class Results(pysolr.Results):
+    '''
+    Solr search results.
+
+    In addition to ``pysolr.Results`` this provides the response of the
+    MoreLikeThis search component (``mlt=true``) as ``more_like_this``,
+    a dict that maps the ID of each result to the response for its
+    similar documents.
+    '''
+    def __init__(self, decoded):
+        super(Results, self).__init__(decoded)
+        self.more_like_this = decoded.get('moreLikeThis', {})
+
+
+class CircuitBreaker(object):
+    '''
+    Suspends Solr queries after repeated failures.
+
+    After ``max_failures`` consecutive failures the circuit is opened and
+    no queries are allowed for ``cool_down`` seconds. Afterwards the
+    circuit is half-open: a single trial query is allowed. If it succeeds
+    then the circuit is closed again, otherwise it is re-opened for
+    another ``cool_down`` seconds.
+
+    A ``max_failures`` of 0 disables the circuit breaker.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, max_failures=5, cool_down=30):
+        self.max_failures = max_failures
+        self.cool_down = cool_down
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.time() - self._opened_at < self.cool_down:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        '''
+        Whether a query may be sent.
+        '''
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.OPEN or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        '''
+        Record a successful query.
+        '''
+        with self._lock:
+            if self._opened_at is not None:
+                log.info('Solr is available again, resuming queries')
+            self.failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        '''
+        Record a failed query.
+        '''
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.max_failures and self.failures >= self.max_failures:
+                log.warning('%d consecutive Solr queries have failed, '
+                            'suspending queries for %s seconds',
+                            self.failures, self.cool_down)
+                self._opened_at = time.time()
+
+
+_lock = threading.Lock()
+_clients = {}
+_circuit_breaker = None
+
+
+def get_timeout():
+    '''
+    The default timeout of Solr queries in seconds.
+    '''
+    return float(get_config('solr.timeout', 10))
+
+
+def get_client(timeout):
+    '''
+    Get a Solr connection with the given timeout in seconds.
+
+    Connections are shared between threads and requests, so that their
+    persistent HTTP connections are reused.
+    '''
+    with _lock:
+        try:
+            return _clients[timeout]
+        except KeyError:
+            client = _clients[timeout] = make_connection()
+            client.timeout = timeout
+            client.results_cls = Results
+            return client
+
+
+def get_circuit_breaker():
+    '''
+    Get the circuit breaker for Solr queries.
+    '''
+    global _circuit_breaker
+    max_failures = int(get_config('solr.max_failures', 5))
+    cool_down = float(get_config('solr.cool_down', 30))
+    with _lock:
+        if (_circuit_breaker is None
+                or _circuit_breaker.max_failures != max_failures
+                or _circuit_breaker.cool_down != cool_down):
+            _circuit_breaker = CircuitBreaker(max_failures, cool_down)
+        return _circuit_breaker
+
+
+def reset():
+    '''
+    Drop all connections and close the circuit.
+    '''
+    global _circuit_breaker
+    with _lock:
+        _clients.clear()
+        _circuit_breaker = None
+
+
+def _circuit_state():
+    state = get_circuit_breaker().state
+    return {s: int(s == state) for s in (CircuitBreaker.CLOSED,
+                                         CircuitBreaker.OPEN,
+                                         CircuitBreaker.HALF_OPEN)}
+
+
+get_registry().gauge(
+    'discovery_solr_circuit_state',
+    'State of the circuit breaker for Solr queries', _circuit_state,
+    ['state'])
+get_registry().gauge(
+    'discovery_solr_consecutive_failures',
+    'Number of consecutive failed Solr queries',
+    lambda: get_circuit_breaker().failures)
+
+
+def filter_query():
+    '''
+    Solr filter query for the active, public datasets of this instance.
+    '''
+    return '''
+        +site_id:"{}"
+        +dataset_type:dataset
+        +state:active
+        +capacity:public
+        '''.format(config.get('ckan.site_id'))
+
+
+# Fields required by ``is_public``
+PUBLIC_FIELDS = ('site_id', 'dataset_type', 'state', 'capacity')
+
+
+def is_public(doc):
+    '''
+    Whether a Solr document matches ``filter_query``.
+
+    Useful for results that are not subject to filter queries, for
+    example those of the MoreLikeThis search component. The document
+    must contain the fields in ``PUBLIC_FIELDS``.
+    '''
+    return (doc.get('site_id') == config.get('ckan.site_id')
+            and doc.get('dataset_type') == 'dataset'
+            and doc.get('state') == 'active'
+            and doc.get('capacity') == 'public')
+
+
+def query(method, *args, **kwargs):
+    '''
+    Send a query to Solr.
+
+    ``method`` is the name of a method of ``pysolr.Solr`` (for example
+    ``search`` or ``more_like_this``), the remaining arguments are passed
+    on to it. The optional keyword argument ``timeout`` is the maximum
+    duration of the query in seconds and defaults to ``get_timeout()``.
+
+    Returns the return value of the method. Raises ``SolrUnavailable``
+    if the query fails or if queries are currently suspended by the
+    circuit breaker.
+    '''
+    timeout = kwargs.pop('timeout', None) or get_timeout()
+    circuit_breaker = get_circuit_breaker()
+    if not circuit_breaker.allow():
+        _requests.inc(method=method, result='skipped')
+        raise SolrUnavailable('Solr queries are suspended after repeated '
+                              'failures')
+    client = get_client(timeout)
+    try:
+        with _duration.time(method=method):
+            result = getattr(client, method)(*args, **kwargs)
+    except Exception as e:
+        circuit_breaker.record_failure()
+        _requests.inc(method=method, result='error')
+        raise SolrUnavailable('Solr query failed: {}'.format(e))
+    circuit_breaker.record_success()
+    _requests.inc(method=method, result='success')
+    return result
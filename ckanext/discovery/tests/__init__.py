@@ -16,6 +16,8 @@ from ckan.model.meta import Session
 from ckan.tests.helpers import call_action
 from ckan.logic import NotAuthorized
 
+from ..instrumentation import measure
+
 
 try:
     from ckan.tests.helpers import changed_config
@@ -298,3 +300,18 @@ def purge_datasets():
     for pkg in Session.query(Package):
         call_action('dataset_purge', id=pkg.id)
 
+
+@contextlib.contextmanager
+def assert_max_statements(num):
+    '''
+    Context manager that asserts an upper bound on SQL statements.
+
+    Fails if the code in the context manager executes more than ``num``
+    statements via the extension's database connections. Returns the
+    ``StatementStats`` of the measurement.
+    '''
+    with measure() as stats:
+        yield stats
+    if stats.statements > num:
+        raise AssertionError(('{} SQL statements were executed but at most {} '
+                              'were expected').format(stats.statements, num))
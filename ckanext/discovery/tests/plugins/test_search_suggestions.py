@@ -7,20 +7,29 @@ Tests for ``ckanext.discovery.plugins.search_suggestions``.
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import gzip
+import io
+import re
+import tempfile
+import time
+
 import mock
-from nose.tools import assert_in, assert_not_in, raises, eq_, ok_
+from nose.tools import (assert_in, assert_not_in, assert_raises, raises, eq_,
+                        ok_)
 from routes import url_for
 
-from ckan.model.meta import Session
 import ckan.plugins.toolkit as toolkit
 import ckan.tests.helpers as helpers
 from ckan.plugins import implements, SingletonPlugin
 
-from ...plugins.search_suggestions.model import (
-    create_tables,
-    SearchTerm,
-    CoOccurrence,
+from ...deadline import DeadlineExceeded
+from ...plugins.search_suggestions import action
+from ...plugins.search_suggestions.admission import (
+    AdmissionFilter,
+    get_admission_filter,
+    get_client,
 )
+from ...plugins.search_suggestions.backends import get_backend
 from ...plugins.search_suggestions import (
     SearchQuery,
     preprocess_search_term,
@@ -28,7 +37,17 @@ from ...plugins.search_suggestions import (
     log as search_suggestions_log,
 )
 from ...plugins.search_suggestions.interfaces import ISearchTermPreprocessor
+from ...plugins.search_suggestions.replay import (extract_query,
+                                                  get_path_pattern, replay)
+from ...plugins.search_suggestions.sampling import (
+    get_effective_sample_rate,
+    get_sampler,
+    Sampler,
+)
+from ...plugins.search_suggestions.transfer import guess_format, read_records
+from ...plugins.search_suggestions.writer import get_writer, QueryWriter
 from .. import (
+    assert_max_statements,
     changed_config,
     assert_anonymous_access,
     with_plugin,
@@ -38,6 +57,10 @@ from .. import (
 )
 
 
+TIME_BUDGET = 'ckanext.discovery.search_suggestions.time_budget'
+TRUSTED_PROXIES = 'ckanext.discovery.search_suggestions.trusted_proxies'
+
+
 def search_history(s=''):
     '''
     Set the search history.
@@ -48,8 +71,7 @@ def search_history(s=''):
     simply split at whitespace. Otherwise the usual query splitting and
     term-postprocessing is used.
     '''
-    SearchTerm.query().delete()
-    Session.commit()
+    get_backend().clear()
     for string in s.splitlines():
         SearchQuery(string).store()
 
@@ -58,11 +80,27 @@ def assert_empty_search_history():
     '''
     Assert that the search history is empty.
     '''
-    terms = [t.term for t in SearchTerm.query()]
+    terms = [t.term for t in get_backend().iter_terms()]
     eq_(len(terms), 0, ('Search history should be empty but contains the ' +
         'terms {}').format(terms))
 
 
+def term_count(word):
+    '''
+    Get the stored count of a search term.
+    '''
+    terms = get_backend().get_terms([word])
+    return terms[0].count if terms else 0
+
+
+def cooccurrence_count(word1, word2):
+    '''
+    Get the stored co-occurrence count of two search terms.
+    '''
+    word1, word2 = sorted([word1, word2])
+    return get_backend().get_cooccurrence_count(word1, word2)
+
+
 def suggest(q):
     '''
     Shortcut for discovery_search_suggest.
@@ -208,6 +246,76 @@ class TestDiscoverySearchSuggest(helpers.FunctionalTestBase):
         assert_suggestions('cat mo!', ['cat mouse'])
 
 
+class TestTimeBudget(helpers.FunctionalTestBase):
+    '''
+    Tests for the time budget of discovery_search_suggest.
+    '''
+    def setup(self):
+        super(TestTimeBudget, self).setup()
+        action._get_cache().clear()
+        action.degraded_responses.clear()
+        search_history('''
+            cat dog
+            cat dog
+            caterpillar
+        ''')
+
+    def suggest(self, q, stage):
+        '''
+        Get suggestions while exceeding the time budget in a stage.
+        '''
+        with changed_config(TIME_BUDGET, 1000):
+            with mock.patch.object(action, stage,
+                                   side_effect=DeadlineExceeded()):
+                return [d['value'] for d in suggest(q)]
+
+    def test_no_degradation_within_budget(self):
+        with changed_config(TIME_BUDGET, 10000):
+            assert_suggestions('ca', ['cat dog', 'cat', 'caterpillar'])
+        eq_(sum(action.degraded_responses.values()), 0)
+
+    def test_autocomplete_fallback(self):
+        eq_(self.suggest('ca', '_extend'), ['cat', 'caterpillar'])
+        eq_(action.degraded_responses['autocomplete'], 1)
+
+    def test_empty_fallback(self):
+        eq_(self.suggest('ca', '_autocomplete'), [])
+        eq_(action.degraded_responses['empty'], 1)
+
+    def test_cache_fallback(self):
+        suggest('ca')
+        eq_(self.suggest('CA', '_autocomplete'),
+            ['cat dog', 'cat', 'caterpillar'])
+        eq_(self.suggest('ca', '_extend'), ['cat dog', 'cat', 'caterpillar'])
+        eq_(action.degraded_responses['cache'], 2)
+
+
+class TestStatementCounts(helpers.FunctionalTestBase):
+    '''
+    Upper bounds for the number of SQL statements of suggestions.
+    '''
+    def setup(self):
+        super(TestStatementCounts, self).setup()
+        search_history('''
+            cat dog
+            cat fox
+            dog fox
+            cat dog fox
+        ''')
+
+    def test_score(self):
+        terms = get_backend().get_terms(['cat', 'dog', 'fox'])
+        with assert_max_statements(1):
+            action._get_score(terms)
+
+    def test_suggest(self):
+        # 1 for the context terms, 1 for the auto-completions, 1 for each
+        # of their scores, 2 per context and auto-completion term for the
+        # extension candidates and 1 for each of their scores.
+        with assert_max_statements(8):
+            assert_suggestions('cat d', ['cat dog', 'cat dog fox'])
+
+
 class TestSearchQuery(object):
     '''
     Tests for ``SearchQuery``.
@@ -290,22 +398,220 @@ class TestSearchQuery(object):
         SearchQuery('wolf dog fox').store()
         SearchQuery('chicken').store()
         SearchQuery('dog cat chicken').store()
-        eq_(SearchTerm.get_or_create(term='dog').count, 3)
-        eq_(SearchTerm.get_or_create(term='cat').count, 2)
-        eq_(SearchTerm.get_or_create(term='wolf').count, 1)
-        eq_(SearchTerm.get_or_create(term='fox').count, 1)
-        eq_(SearchTerm.get_or_create(term='chicken').count, 2)
-        eq_(CoOccurrence.for_words('dog', 'cat').count, 2)
-        eq_(CoOccurrence.for_words('wolf', 'dog').count, 1)
-        eq_(CoOccurrence.for_words('wolf', 'fox').count, 1)
-        eq_(CoOccurrence.for_words('dog', 'fox').count, 1)
-        eq_(CoOccurrence.for_words('dog', 'chicken').count, 1)
-        eq_(CoOccurrence.for_words('cat', 'chicken').count, 1)
-        eq_(CoOccurrence.for_words('cat', 'chicken').count, 1)
-        eq_(CoOccurrence.for_words('wolf', 'chicken').count, 0)
-        eq_(CoOccurrence.for_words('fox', 'chicken').count, 0)
-        eq_(CoOccurrence.for_words('fox', 'cat').count, 0)
-        eq_(CoOccurrence.for_words('wolf', 'cat').count, 0)
+        eq_(term_count('dog'), 3)
+        eq_(term_count('cat'), 2)
+        eq_(term_count('wolf'), 1)
+        eq_(term_count('fox'), 1)
+        eq_(term_count('chicken'), 2)
+        eq_(cooccurrence_count('dog', 'cat'), 2)
+        eq_(cooccurrence_count('wolf', 'dog'), 1)
+        eq_(cooccurrence_count('wolf', 'fox'), 1)
+        eq_(cooccurrence_count('dog', 'fox'), 1)
+        eq_(cooccurrence_count('dog', 'chicken'), 1)
+        eq_(cooccurrence_count('cat', 'chicken'), 1)
+        eq_(cooccurrence_count('cat', 'chicken'), 1)
+        eq_(cooccurrence_count('wolf', 'chicken'), 0)
+        eq_(cooccurrence_count('fox', 'chicken'), 0)
+        eq_(cooccurrence_count('fox', 'cat'), 0)
+        eq_(cooccurrence_count('wolf', 'cat'), 0)
+
+
+class TestQueryWriter(object):
+    '''
+    Tests for ``QueryWriter``.
+    '''
+    def setup(self):
+        search_history()
+
+    def test_batch_size(self):
+        '''
+        Queries are written once the batch is full.
+        '''
+        writer = QueryWriter(batch_size=3, max_delay=60)
+        writer.add(['dog', 'cat'])
+        writer.add(['dog'])
+        eq_(writer.pending, 2)
+        assert_empty_search_history()
+        writer.add(['dog', 'fox'])
+        eq_(writer.pending, 0)
+        eq_(term_count('dog'), 3)
+        eq_(term_count('cat'), 1)
+        eq_(cooccurrence_count('dog', 'cat'), 1)
+        eq_(cooccurrence_count('dog', 'fox'), 1)
+
+    def test_max_delay(self):
+        '''
+        Queries are written after the maximum delay.
+        '''
+        writer = QueryWriter(batch_size=100, max_delay=0.1)
+        writer.add(['dog'])
+        assert_empty_search_history()
+        time.sleep(0.5)
+        eq_(writer.pending, 0)
+        eq_(term_count('dog'), 1)
+
+    def test_flush(self):
+        '''
+        Pending queries can be written explicitly.
+        '''
+        writer = QueryWriter(batch_size=100, max_delay=60)
+        writer.add(['dog'])
+        writer.flush()
+        eq_(term_count('dog'), 1)
+        writer.flush()
+        eq_(term_count('dog'), 1)
+
+    def test_failed_write(self):
+        '''
+        Queries are kept if writing them fails.
+        '''
+        writer = QueryWriter(batch_size=100, max_delay=60)
+        writer.add(['dog', 'cat'])
+        with mock.patch('ckanext.discovery.plugins.search_suggestions.'
+                        + 'writer.get_backend') as get_backend:
+            get_backend.return_value.upsert.side_effect = ValueError()
+            assert_raises(ValueError, writer.flush)
+        eq_(writer.pending, 1)
+        writer.add(['dog'])
+        writer.flush()
+        eq_(writer.pending, 0)
+        eq_(term_count('dog'), 2)
+        eq_(term_count('cat'), 1)
+        eq_(cooccurrence_count('dog', 'cat'), 1)
+
+    def test_configuration(self):
+        '''
+        The writer is configured via the CKAN configuration.
+        '''
+        with changed_config('ckanext.discovery.search_suggestions.batch_size',
+                            '2'):
+            writer = get_writer()
+            eq_(writer.batch_size, 2)
+            SearchQuery('dog').store()
+            assert_empty_search_history()
+        # Pending queries are written when the configuration changes
+        eq_(get_writer().batch_size, 1)
+        eq_(term_count('dog'), 1)
+
+
+class TestSampler(object):
+    '''
+    Tests for ``Sampler``.
+    '''
+    def test_full_rate(self):
+        sampler = Sampler()
+        for _ in range(100):
+            eq_(sampler.sample(), 1)
+
+    def test_scaled_counts(self):
+        '''
+        The stored counts are unbiased estimates of the real counts.
+        '''
+        sampler = Sampler(rate=0.3)
+        weights = [sampler.sample() for _ in range(10000)]
+        ok_(set(weights).issubset({0, 3, 4}))
+        ok_(9000 < sum(weights) < 11000, sum(weights))
+
+    def test_adaptive_rate(self):
+        '''
+        The rate is lowered while storage is overloaded.
+        '''
+        sampler = Sampler(rate=0.5, adaptive=True, max_pending=10,
+                          max_write_duration=1, min_rate=0.1)
+        sampler.ADJUST_INTERVAL = 0
+        writer = QueryWriter()
+        writer.pending = 11
+        sampler.adjust(writer)
+        eq_(sampler.effective_rate, 0.25)
+        writer.pending = 0
+        writer.last_write_duration = 2
+        sampler.adjust(writer)
+        sampler.adjust(writer)
+        eq_(sampler.effective_rate, 0.1)
+        writer.last_write_duration = 0
+        for _ in range(5):
+            sampler.adjust(writer)
+        eq_(sampler.effective_rate, 0.5)
+
+    def test_not_adaptive(self):
+        sampler = Sampler(rate=0.5)
+        writer = QueryWriter()
+        writer.pending = 100000
+        sampler.adjust(writer)
+        eq_(sampler.effective_rate, 0.5)
+
+    def test_configuration(self):
+        with changed_config('ckanext.discovery.search_suggestions.sample_rate',
+                            '0.2'):
+            eq_(get_sampler().rate, 0.2)
+            eq_(get_effective_sample_rate(), 0.2)
+        eq_(get_sampler().rate, 1)
+
+    def test_weighted_storage(self):
+        search_history()
+        writer = QueryWriter()
+        writer.add(['dog', 'cat'], weight=3)
+        eq_(term_count('dog'), 3)
+        eq_(cooccurrence_count('dog', 'cat'), 3)
+
+
+class TestAdmissionFilter(object):
+    '''
+    Tests for ``AdmissionFilter``.
+    '''
+    def test_duplicates(self):
+        f = AdmissionFilter()
+        ok_(f.admit('a', ['dog', 'cat']))
+        ok_(not f.admit('a', ['cat', 'dog']))
+        ok_(f.admit('b', ['cat', 'dog']))
+        ok_(f.admit('a', ['cat']))
+        eq_(f.rejected['duplicate'], 1)
+
+    def test_duplicate_expiry(self):
+        f = AdmissionFilter(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            ok_(f.admit('a', ['dog']))
+        with mock.patch('time.time', return_value=111):
+            ok_(f.admit('a', ['dog']))
+
+    def test_user_agent(self):
+        f = AdmissionFilter()
+        ok_(not f.admit('a', ['dog'], 'Mozilla/5.0 (compatible; bingbot/2.0)'))
+        ok_(f.admit('a', ['dog'], 'Mozilla/5.0 (X11; Linux x86_64)'))
+        f = AdmissionFilter(user_agents='')
+        ok_(f.admit('a', ['dog'], 'Googlebot'))
+
+    def test_rate_limit(self):
+        f = AdmissionFilter(rate_limit=2, rate_window=10)
+        with mock.patch('time.time', return_value=100):
+            ok_(f.admit('a', ['dog']))
+            ok_(f.admit('a', ['cat']))
+            ok_(not f.admit('a', ['fox']))
+            ok_(f.admit('b', ['fox']))
+        with mock.patch('time.time', return_value=110):
+            ok_(f.admit('a', ['fox']))
+        eq_(f.rejected['rate'], 1)
+
+    def test_get_client(self):
+        context = mock.Mock(user='alice')
+        request = mock.Mock(environ={'REMOTE_ADDR': '10.0.0.1'})
+        eq_(get_client(context, request), 'user:alice')
+        context.user = None
+        eq_(get_client(context, request), 'ip:10.0.0.1')
+        # The header is ignored unless the request comes from a trusted
+        # proxy
+        request.environ['HTTP_X_FORWARDED_FOR'] = '10.0.0.2, 10.0.0.3'
+        eq_(get_client(context, request), 'ip:10.0.0.1')
+        with changed_config(TRUSTED_PROXIES, '10.0.0.1 10.0.0.3'):
+            eq_(get_client(context, request), 'ip:10.0.0.2')
+            # Addresses added by the client are not used
+            request.environ['HTTP_X_FORWARDED_FOR'] = ('1.2.3.4, 10.0.0.2, '
+                                                       + '10.0.0.3')
+            eq_(get_client(context, request), 'ip:10.0.0.2')
+            request.environ['HTTP_X_FORWARDED_FOR'] = '10.0.0.3'
+            eq_(get_client(context, request), 'ip:10.0.0.3')
+            request.environ['HTTP_X_FORWARDED_FOR'] = ''
+            eq_(get_client(context, request), 'ip:10.0.0.1')
 
 
 class MockSearchTermPreprocessor(SingletonPlugin):
@@ -350,10 +656,10 @@ class TestReprocess(object):
         search_history('stopword bad-word replace other')
         with temporarily_enabled_plugin(MockSearchTermPreprocessor):
             reprocess()
-        terms = set(t.term for t in SearchTerm.query())
+        terms = set(t.term for t in get_backend().iter_terms())
         eq_(terms, {'äb-cz23f', 'other'})
-        cooccs = set((c.term1.term, c.term2.term)
-                     for c in CoOccurrence.query())
+        cooccs = set((word1, word2) for word1, word2, _
+                     in get_backend().iter_cooccurrences())
         eq_(cooccs, {('other', 'äb-cz23f')})
 
 
@@ -370,18 +676,26 @@ class TestQueryStorage(helpers.FunctionalTestBase):
     '''
     Test automatic search query storage.
     '''
-    def web_request(self, controller, action, **kwargs):
+    def setup(self):
+        super(TestQueryStorage, self).setup()
+        get_admission_filter().clear()
+
+    def web_request(self, controller, action, headers=None, environ=None,
+                    **kwargs):
         '''
         Perform a web-request.
 
         All keyword arguments are passed as URL-parameters to the given
-        controller action.
+        controller action. ``headers`` is an optional dict of additional
+        HTTP headers, ``environ`` an optional dict of additional WSGI
+        environment variables.
 
         Returns the response.
         '''
         app = self._get_test_app()
         url = url_for(controller=controller, action=action)
-        return app.get(url, params=kwargs)
+        return app.get(url, params=kwargs, headers=headers,
+                       extra_environ=environ)
 
     def test_text_search(self):
         '''
@@ -390,12 +704,12 @@ class TestQueryStorage(helpers.FunctionalTestBase):
         search_history()
         self.web_request('package', 'search', q='dog fox')
         self.web_request('package', 'search', q='dog cat')
-        eq_(SearchTerm.get_or_create(term='dog').count, 2)
-        eq_(SearchTerm.get_or_create(term='cat').count, 1)
-        eq_(SearchTerm.get_or_create(term='fox').count, 1)
-        eq_(CoOccurrence.for_words('dog', 'cat').count, 1)
-        eq_(CoOccurrence.for_words('dog', 'fox').count, 1)
-        eq_(CoOccurrence.for_words('fox', 'cat').count, 0)
+        eq_(term_count('dog'), 2)
+        eq_(term_count('cat'), 1)
+        eq_(term_count('fox'), 1)
+        eq_(cooccurrence_count('dog', 'cat'), 1)
+        eq_(cooccurrence_count('dog', 'fox'), 1)
+        eq_(cooccurrence_count('fox', 'cat'), 0)
 
     def test_search_by_tag(self):
         '''
@@ -453,6 +767,48 @@ class TestQueryStorage(helpers.FunctionalTestBase):
         self.web_request('package', 'search', q='dog fox')
         assert_empty_search_history()
 
+    @helpers.change_config('ckanext.discovery.search_suggestions.sample_rate',
+                           '0.5')
+    def test_sampled_storage(self):
+        '''
+        Only sampled queries are stored, with scaled counts.
+        '''
+        search_history()
+        with mock.patch('random.random', return_value=0.9):
+            self.web_request('package', 'search', q='dog fox')
+        assert_empty_search_history()
+        with mock.patch('random.random', return_value=0.1):
+            self.web_request('package', 'search', q='dog cat')
+        eq_(term_count('dog'), 2)
+        eq_(cooccurrence_count('dog', 'cat'), 2)
+
+    def test_duplicate_queries(self):
+        '''
+        Repeated searches by the same client are stored only once.
+        '''
+        search_history()
+        self.web_request('package', 'search', q='dog fox')
+        self.web_request('package', 'search', q='fox dog', tags='animals')
+        self.web_request('package', 'search', q='dog fox', page=2)
+        eq_(term_count('dog'), 1)
+        self.web_request('package', 'search', q='dog fox',
+                         environ={'REMOTE_ADDR': '10.0.0.1'})
+        eq_(term_count('dog'), 2)
+        # Without a trusted proxy X-Forwarded-For is ignored
+        self.web_request('package', 'search', q='dog fox',
+                         environ={'REMOTE_ADDR': '10.0.0.1'},
+                         headers={'X-Forwarded-For': '10.0.0.2'})
+        eq_(term_count('dog'), 2)
+
+    def test_bot_queries(self):
+        '''
+        Searches by crawlers are not stored.
+        '''
+        search_history()
+        self.web_request('package', 'search', q='dog fox', headers={
+                         'User-Agent': 'Mozilla/5.0 (compatible; Googlebot/2.1)'})
+        assert_empty_search_history()
+
     def test_error_handling(self):
         '''
         Errors during search term storage are logged and don't cause the
@@ -467,6 +823,86 @@ class TestQueryStorage(helpers.FunctionalTestBase):
         logs.assert_log('error', 'An exception occurred while storing a search query')
 
 
+class TestTransfer(object):
+    '''
+    Tests for ``transfer``.
+    '''
+    def test_read_records(self):
+        f = io.BytesIO(b'{"term": "cat", "count": 2}\n\n'
+                       b'{"term1": "fox", "term2": "cat", "count": 1}\n')
+        eq_(list(read_records(f, 'ndjson')), [('cat', None, 2),
+            ('cat', 'fox', 1)])
+        f = io.BytesIO(b'term1,term2,count\ncat,,2\nfox,cat,1\n')
+        eq_(list(read_records(f, 'csv')), [('cat', None, 2),
+            ('cat', 'fox', 1)])
+
+    @raises(ValueError)
+    def test_invalid_count(self):
+        list(read_records(io.BytesIO(b'{"term": "cat"}\n'), 'ndjson'))
+
+    def test_guess_format(self):
+        eq_(guess_format('stats.CSV'), 'csv')
+        eq_(guess_format('stats.ndjson'), 'ndjson')
+        eq_(guess_format('-'), 'ndjson')
+
+
+LOG_LINES = [
+    b'1.2.3.4 - - [10/Oct/2016:13:55:36 +0200] "GET /dataset?q=Cat+dog '
+    b'HTTP/1.1" 200 2326 "-" "Mozilla/5.0"\n',
+    b'1.2.3.4 - - [10/Oct/2016:13:55:37 +0200] "GET /de/dataset?q=cat&tags=x '
+    b'HTTP/1.1" 200 2326\n',
+    b'1.2.3.4 - - [10/Oct/2016:13:55:38 +0200] "GET /dataset?q=fox '
+    b'HTTP/1.1" 200 2326 "-" "Googlebot/2.1"\n',
+    b'1.2.3.4 - - [10/Oct/2016:13:55:39 +0200] "GET /dataset?q=wolf '
+    b'HTTP/1.1" 404 2326\n',
+    b'1.2.3.4 - - [10/Oct/2016:13:55:40 +0200] "GET /dataset/foo?q=wolf '
+    b'HTTP/1.1" 200 2326\n',
+    b'1.2.3.4 - - [10/Oct/2016:13:55:41 +0200] "GET /dataset?q=*:* '
+    b'HTTP/1.1" 200 2326\n',
+    b'not a log line\n',
+]
+
+
+class TestReplay(object):
+    '''
+    Tests for ``replay``.
+    '''
+    def test_extract_query(self):
+        user_agents = re.compile('bot', re.I)
+        queries = [extract_query(line, user_agents) for line in LOG_LINES]
+        eq_(queries, ['Cat dog', 'cat', None, None, None, None, None])
+
+    def test_root_path(self):
+        lines = [line.replace(b'GET /', b'GET /data/') for line in LOG_LINES]
+        for root_path in ['/data', '/data/', '/data/{{LANG}}']:
+            pattern = get_path_pattern(root_path)
+            queries = [extract_query(line, path_pattern=pattern)
+                       for line in lines]
+            eq_(queries[:2], ['Cat dog', 'cat'])
+            # Paths without the prefix are ignored
+            eq_(extract_query(LOG_LINES[0], path_pattern=pattern), None)
+        eq_(extract_query(lines[0]), None)
+
+    def test_replay_root_path(self):
+        with tempfile.NamedTemporaryFile(suffix='.log') as f:
+            f.writelines(line.replace(b'GET /', b'GET /data/')
+                         for line in LOG_LINES)
+            f.flush()
+            result = replay([f.name], processes=1, root_path='/data')
+        eq_(result.num_queries, 3)
+
+    def test_replay(self):
+        with tempfile.NamedTemporaryFile(suffix='.gz') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.writelines(LOG_LINES)
+            f.flush()
+            result = replay([f.name, f.name], processes=2, user_agents='bot')
+        eq_(result.num_lines, 14)
+        eq_(result.num_queries, 4)
+        eq_(sorted(result.records()), [('cat', None, 4), ('cat', 'dog', 2),
+            ('dog', None, 2)])
+
+
 class TestPaster(object):
     '''
     Test paster CLI commands.
@@ -482,10 +918,57 @@ class TestPaster(object):
         paster('search_suggestions', 'reprocess')
         reprocess.assert_called()
 
-    @mock.patch('ckanext.discovery.plugins.search_suggestions.model.create_tables')
-    def test_init(self, create_tables):
+    @mock.patch('ckanext.discovery.plugins.search_suggestions.backends.get_backend')
+    def test_init(self, get_backend):
         paster('search_suggestions', 'init')
-        create_tables.assert_called()
+        get_backend.return_value.create_tables.assert_called()
+
+    def test_prune(self):
+        search_history('''
+            cat dog
+            cat wolf
+        ''')
+        stdout = paster('search_suggestions', 'prune', '2')[1]
+        assert_in('Deleted 2 search terms', stdout)
+        stdout = paster('search_suggestions', 'list')[1]
+        eq_(stdout.strip().splitlines(), ['cat'])
+
+    def test_export_import(self):
+        for format in ['ndjson', 'csv']:
+            search_history('''
+                cat dog
+                cat
+            ''')
+            f = tempfile.NamedTemporaryFile(suffix='.' + format)
+            with f:
+                stdout = paster('search_suggestions', 'export', f.name)[1]
+                assert_in('Exported 3 records', stdout)
+                search_history('dog')
+                stdout = paster('search_suggestions', 'import', f.name)[1]
+                assert_in('Imported 3 records', stdout)
+            eq_(term_count('cat'), 2)
+            eq_(term_count('dog'), 2)
+            eq_(cooccurrence_count('cat', 'dog'), 1)
+
+    def test_replay(self):
+        search_history('cat')
+        with tempfile.NamedTemporaryFile(suffix='.log') as f:
+            f.writelines(LOG_LINES)
+            f.flush()
+            stdout = paster('search_suggestions', 'replay', f.name)[1]
+        assert_in('Found 2 searches in 7 lines', stdout)
+        eq_(term_count('cat'), 3)
+        eq_(term_count('dog'), 1)
+        eq_(cooccurrence_count('cat', 'dog'), 1)
+
+    def test_import_invalid_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(b'foo,bar\n')
+            f.flush()
+            code, _, stderr = paster('search_suggestions', 'import', f.name,
+                                     fail_on_error=False)
+        eq_(code, 1)
+        assert_in('Invalid CSV header', stderr)
 
 
 class TestUI(helpers.FunctionalTestBase):
@@ -517,17 +1000,17 @@ class TestUI(helpers.FunctionalTestBase):
 
 class TestCreateTables(helpers.FunctionalTestBase):
     '''
-    Test ``model.create_tables``.
+    Test ``Backend.create_tables``.
     '''
     def test_existing_entries_are_kept(self):
         search_history('''
             dog fox
             dog cat
         ''')
-        create_tables()
-        eq_(SearchTerm.get_or_create(term='dog').count, 2)
-        eq_(SearchTerm.get_or_create(term='fox').count, 1)
-        eq_(SearchTerm.get_or_create(term='cat').count, 1)
-        eq_(CoOccurrence.for_words('dog', 'fox').count, 1)
-        eq_(CoOccurrence.for_words('dog', 'cat').count, 1)
+        get_backend().create_tables()
+        eq_(term_count('dog'), 2)
+        eq_(term_count('fox'), 1)
+        eq_(term_count('cat'), 1)
+        eq_(cooccurrence_count('dog', 'fox'), 1)
+        eq_(cooccurrence_count('dog', 'cat'), 1)
 
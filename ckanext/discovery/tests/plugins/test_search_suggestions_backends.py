@@ -0,0 +1,348 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.plugins.search_suggestions.backends``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import fakeredis
+import mock
+from nose.tools import assert_raises, eq_, ok_, raises
+import redis
+
+import ckan.model
+from ckan.model.meta import Session
+
+from ...plugins.search_suggestions.backends import (
+    count_words,
+    get_backend,
+    reprocess_counts,
+    Term,
+)
+from ...plugins.search_suggestions.backends.memory import MemoryBackend
+from ...plugins.search_suggestions.backends.postgresql import \
+    PostgreSQLBackend
+from ...plugins.search_suggestions.backends.redis import RedisBackend
+from ...plugins.search_suggestions.backends.sqlite import SQLiteBackend
+from .. import assert_max_statements, changed_config
+
+
+KEY = 'ckanext.discovery.search_suggestions.backend'
+
+
+class TestGetBackend(object):
+    '''
+    Tests for ``get_backend``.
+    '''
+    def test_default(self):
+        with changed_config(KEY, None):
+            ok_(isinstance(get_backend(), PostgreSQLBackend))
+
+    def test_selection(self):
+        cases = [
+            ['postgresql', PostgreSQLBackend],
+            ['sqlite', SQLiteBackend],
+            ['memory', MemoryBackend],
+            ['redis', RedisBackend],
+        ]
+        for name, cls in cases:
+            with changed_config(KEY, name):
+                ok_(isinstance(get_backend(), cls))
+
+    def test_instance_is_reused(self):
+        with changed_config(KEY, 'memory'):
+            ok_(get_backend() is get_backend())
+
+    def test_redis_source(self):
+        with changed_config(KEY.replace('backend', 'redis.source'), 'sqlite'):
+            ok_(isinstance(RedisBackend.from_config().source, SQLiteBackend))
+
+    @raises(ValueError)
+    def test_unknown_backend(self):
+        with changed_config(KEY, 'does-not-exist'):
+            get_backend()
+
+
+class TestCountWords(object):
+    '''
+    Tests for ``count_words``.
+    '''
+    def test_count_words(self):
+        terms, cooccs = count_words(['fox', 'dog', 'cat', 'dog'])
+        eq_(terms, {'cat': 1, 'dog': 1, 'fox': 1})
+        eq_(cooccs, {('cat', 'dog'): 1, ('cat', 'fox'): 1, ('dog', 'fox'): 1})
+
+
+class TestReprocessCounts(object):
+    '''
+    Tests for ``reprocess_counts``.
+    '''
+    def test_reprocess_counts(self):
+        mapping = {'cat': 'kitten', 'dog': 'dog', 'fox': 'dog', 'wolf': None}
+        terms = [Term('cat', 1), Term('dog', 2), Term('fox', 3),
+                 Term('wolf', 4)]
+        cooccs = [('cat', 'dog', 1), ('cat', 'fox', 2), ('dog', 'fox', 3),
+                  ('cat', 'wolf', 4)]
+        terms, cooccs = reprocess_counts(mapping.get, terms, cooccs)
+        eq_(terms, {'kitten': 1, 'dog': 5})
+        eq_(cooccs, {('dog', 'kitten'): 3})
+
+
+class BackendTests(object):
+    '''
+    Tests that are run for each backend.
+    '''
+    def make_backend(self):
+        raise NotImplementedError()
+
+    def setup(self):
+        self.backend = self.make_backend()
+        self.backend.create_tables()
+        self.backend.clear()
+
+    def store(self, *queries):
+        for query in queries:
+            self.backend.store_words(query.split())
+
+    def test_store_words(self):
+        self.store('dog cat', 'wolf dog fox', 'chicken', 'dog cat chicken')
+        terms = sorted(self.backend.iter_terms())
+        eq_(terms, [Term('cat', 2), Term('chicken', 2), Term('dog', 3),
+                    Term('fox', 1), Term('wolf', 1)])
+        eq_(self.backend.get_cooccurrence_count('cat', 'dog'), 2)
+        eq_(self.backend.get_cooccurrence_count('dog', 'wolf'), 1)
+        eq_(self.backend.get_cooccurrence_count('cat', 'wolf'), 0)
+        eq_(self.backend.get_cooccurrence_count('cat', 'unknown'), 0)
+        eq_(sorted(self.backend.iter_cooccurrences()), [
+            ('cat', 'chicken', 1),
+            ('cat', 'dog', 2),
+            ('chicken', 'dog', 1),
+            ('dog', 'fox', 1),
+            ('dog', 'wolf', 1),
+            ('fox', 'wolf', 1),
+        ])
+
+    def test_upsert(self):
+        self.backend.upsert({'cat': 3, 'dog': 2}, {('cat', 'dog'): 2,
+                            ('cat', 'fox'): 1})
+        self.backend.upsert({'cat': 1}, {('cat', 'dog'): 1})
+        eq_(sorted(self.backend.iter_terms()), [Term('cat', 4), Term('dog', 2),
+            Term('fox', 0)])
+        eq_(self.backend.get_cooccurrence_count('cat', 'dog'), 3)
+        eq_(self.backend.get_cooccurrence_count('cat', 'fox'), 1)
+
+    def test_bulk_upsert(self):
+        self.store('cat dog')
+        records = [('cat', None, 2), ('fox', None, 1), ('cat', 'dog', 3),
+                   ('cat', 'fox', 1), ('dog', 'wolf', 2), ('cat', None, 1)]
+        eq_(self.backend.bulk_upsert(iter(records), batch_size=2), 6)
+        eq_(sorted(self.backend.iter_terms()), [Term('cat', 4), Term('dog', 1),
+            Term('fox', 1), Term('wolf', 0)])
+        eq_(sorted(self.backend.iter_cooccurrences()), [('cat', 'dog', 4),
+            ('cat', 'fox', 1), ('dog', 'wolf', 2)])
+        eq_(self.backend.get_terms_by_prefix('wo'), [Term('wolf', 0)])
+
+    def test_clear(self):
+        self.store('dog cat')
+        self.backend.clear()
+        eq_(list(self.backend.iter_terms()), [])
+        eq_(list(self.backend.iter_cooccurrences()), [])
+
+    def test_get_terms(self):
+        self.store('dog cat', 'dog')
+        eq_(sorted(self.backend.get_terms(['dog', 'cat', 'fox'])),
+            [Term('cat', 1), Term('dog', 2)])
+        eq_(self.backend.get_terms([]), [])
+
+    def test_get_terms_by_prefix(self):
+        self.store('cat', 'catfish', 'caterpillar', 'dog', 'bobcat',
+                   'cat-flap', 'cät')
+        terms = self.backend.get_terms_by_prefix('cat')
+        eq_(sorted(t.term for t in terms), ['cat', 'cat-flap', 'caterpillar',
+            'catfish'])
+        terms = self.backend.get_terms_by_prefix('cate')
+        eq_(terms, [Term('caterpillar', 1)])
+        eq_(self.backend.get_terms_by_prefix('x'), [])
+
+    def test_get_cooccurring_terms(self):
+        self.store('cat dog', 'cat dog', 'cat fox', 'cat wolf', 'cat wolf',
+                   'cat wolf', 'dog fox')
+        terms = self.backend.get_cooccurring_terms('cat', 10)
+        eq_(terms, [Term('fox', 2), Term('dog', 3), Term('wolf', 3)])
+        terms = self.backend.get_cooccurring_terms('cat', 2)
+        eq_(terms, [Term('fox', 2), Term('dog', 3)])
+        eq_(self.backend.get_cooccurring_terms('unknown', 10), [])
+
+    def test_get_cooccurrence_counts(self):
+        self.store('cat dog', 'cat dog', 'dog fox')
+        pairs = [('cat', 'dog'), ('dog', 'fox'), ('cat', 'fox'),
+                 ('cat', 'unknown')]
+        eq_(self.backend.get_cooccurrence_counts(iter(pairs)),
+            {('cat', 'dog'): 2, ('dog', 'fox'): 1, ('cat', 'fox'): 0,
+             ('cat', 'unknown'): 0})
+        eq_(self.backend.get_cooccurrence_counts([]), {})
+
+    def test_read_statement_counts(self):
+        self.store('cat dog', 'cat fox', 'dog fox', 'cat wolf')
+        with assert_max_statements(1):
+            self.backend.get_cooccurrence_counts([('cat', 'dog'),
+                                                  ('cat', 'fox'),
+                                                  ('dog', 'fox')])
+        with assert_max_statements(2):
+            self.backend.get_cooccurring_terms('cat', 10)
+
+    def test_reprocess(self):
+        self.store('stopword other replace', 'other replaced')
+        mapping = {'stopword': False, 'replace': 'replaced'}
+        self.backend.reprocess(lambda w: mapping.get(w, w))
+        eq_(sorted(self.backend.iter_terms()), [Term('other', 2),
+            Term('replaced', 2)])
+        eq_(list(self.backend.iter_cooccurrences()),
+            [('other', 'replaced', 2)])
+
+    def test_reprocess_merges_terms(self):
+        '''
+        Terms that are renamed to an existing term are merged into it.
+        '''
+        self.store('Datasets csv', 'dataset csv', 'Datasets dataset')
+        self.backend.reprocess(lambda w: {'Datasets': 'dataset'}.get(w, w))
+        eq_(sorted(self.backend.iter_terms()), [Term('csv', 2),
+            Term('dataset', 4)])
+        eq_(list(self.backend.iter_cooccurrences()),
+            [('csv', 'dataset', 2)])
+
+    def test_prune(self):
+        self.store('cat dog', 'cat fox', 'cat', 'dog')
+        eq_(self.backend.prune(2), 1)
+        eq_(sorted(self.backend.iter_terms()), [Term('cat', 3),
+            Term('dog', 2)])
+        eq_(list(self.backend.iter_cooccurrences()), [('cat', 'dog', 1)])
+        eq_(self.backend.get_terms_by_prefix('f'), [])
+
+
+class TestMemoryBackend(BackendTests):
+    def make_backend(self):
+        return MemoryBackend()
+
+
+class TestSQLiteBackend(BackendTests):
+    def make_backend(self):
+        return SQLiteBackend(':memory:')
+
+    @mock.patch('ckanext.discovery.plugins.search_suggestions.backends.'
+                + 'sqlite._FETCH_BATCH_SIZE', 2)
+    def test_iteration_in_batches(self):
+        self.store('cat dog fox')
+        self.store('cat wolf')
+        eq_(list(self.backend.iter_terms()), [
+            Term('cat', 2), Term('dog', 1), Term('fox', 1), Term('wolf', 1)])
+        eq_(sorted(self.backend.iter_cooccurrences()), [
+            ('cat', 'dog', 1), ('cat', 'fox', 1), ('cat', 'wolf', 1),
+            ('dog', 'fox', 1)])
+
+
+class TestPostgreSQLBackend(BackendTests):
+    def make_backend(self):
+        return PostgreSQLBackend()
+
+    def test_ckan_session_is_not_committed(self):
+        '''
+        Storing queries doesn't commit pending changes in CKAN's session.
+        '''
+        Session.add(ckan.model.Tag(name='discovery-test-tag'))
+        try:
+            self.store('cat dog')
+        finally:
+            Session.rollback()
+        ok_(ckan.model.Tag.by_name('discovery-test-tag') is None)
+        eq_(self.backend.get_terms(['cat']), [Term('cat', 1)])
+
+
+class TestRedisBackend(BackendTests):
+    def make_backend(self):
+        return RedisBackend(MemoryBackend(), fakeredis.FakeStrictRedis())
+
+    def test_reads_use_mirror(self):
+        self.store('cat dog')
+        self.backend.source.clear()
+        eq_(self.backend.get_terms(['cat']), [Term('cat', 1)])
+        eq_(self.backend.get_terms_by_prefix('d'), [Term('dog', 1)])
+        eq_(self.backend.get_cooccurrence_count('cat', 'dog'), 1)
+        eq_(self.backend.get_cooccurring_terms('cat', 10), [Term('dog', 1)])
+
+    def test_sync(self):
+        self.backend.source.store_words(['cat', 'dog'])
+        eq_(self.backend.get_terms(['cat', 'dog']), [])
+        self.backend.sync()
+        eq_(sorted(self.backend.get_terms(['cat', 'dog'])),
+            [Term('cat', 1), Term('dog', 1)])
+        eq_(self.backend.get_cooccurrence_count('cat', 'dog'), 1)
+
+    def test_not_synced(self):
+        '''
+        Reads use the source until the mirror has been synced.
+        '''
+        backend = RedisBackend(MemoryBackend(), fakeredis.FakeStrictRedis())
+        backend.store_words(['cat', 'dog'])
+        eq_(backend.get_terms_by_prefix('c'), [Term('cat', 1)])
+        eq_(backend.get_cooccurrence_count('cat', 'dog'), 1)
+        backend.source.clear()
+        backend.sync()
+        eq_(backend.get_terms_by_prefix('c'), [])
+
+    def test_sync_keeps_old_mirror(self):
+        '''
+        The old mirror is used while a sync is running.
+        '''
+        self.store('cat dog')
+        self.backend.source.store_words(['cat', 'fox'])
+        during_sync = []
+
+        def iter_cooccurrences():
+            during_sync.append(self.backend.get_cooccurring_terms('cat',
+                                                                  10))
+            return iter([('cat', 'dog', 1), ('cat', 'fox', 1)])
+
+        with mock.patch.object(self.backend.source, 'iter_cooccurrences',
+                               side_effect=iter_cooccurrences):
+            self.backend.sync()
+        eq_(during_sync, [[Term('dog', 1)]])
+        eq_(self.backend.get_cooccurring_terms('cat', 10),
+            [Term('dog', 1), Term('fox', 1)])
+        # Keys of old versions are removed
+        client = self.backend.client
+        eq_(len(list(client.scan_iter(match='*neighbours:cat'))), 1)
+
+    def test_failed_sync(self):
+        '''
+        The old mirror is kept if a sync fails.
+        '''
+        self.store('cat dog')
+        keys = sorted(self.backend.client.keys())
+        with mock.patch.object(self.backend.source, 'iter_cooccurrences',
+                               side_effect=ValueError()):
+            assert_raises(ValueError, self.backend.sync)
+        eq_(self.backend.get_cooccurrence_count('cat', 'dog'), 1)
+        eq_(sorted(self.backend.client.keys()), keys)
+
+    def test_sync_removes_stale_entries(self):
+        self.store('cat dog')
+        self.backend.source.clear()
+        self.backend.sync()
+        eq_(self.backend.get_terms_by_prefix(''), [])
+        eq_(self.backend.get_cooccurring_terms('cat', 10), [])
+
+    def test_fallback_to_source(self):
+        self.store('cat dog')
+        error = redis.ConnectionError('Redis is down')
+        with mock.patch.object(self.backend, 'client') as client:
+            client.get.side_effect = error
+            client.zrangebylex.side_effect = error
+            client.pipeline.side_effect = error
+            eq_(self.backend.get_terms_by_prefix('c'), [Term('cat', 1)])
+
+            # Failed write-throughs don't prevent storage in the source
+            self.store('cat')
+        eq_(self.backend.source.get_terms(['cat']), [Term('cat', 2)])
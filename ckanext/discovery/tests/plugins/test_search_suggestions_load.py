@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+'''
+Load test for ``ckanext.discovery.plugins.search_suggestions``.
+
+The test runs the load harness from ``benchmarks.load`` against the
+configured backend. Since it takes a while it is skipped unless the
+environment variable ``DISCOVERY_LOAD_TEST`` is set.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, ok_
+
+from benchmarks.corpus import ZipfCorpus
+from benchmarks.load import run_load
+from benchmarks.search_suggestions import populate
+
+from ...plugins.search_suggestions.admission import get_admission_filter
+from ...plugins.search_suggestions.backends import get_backend
+
+
+# Parameters of the load test. Can be overridden using environment
+# variables of the same name prefixed with ``DISCOVERY_LOAD_TEST_``.
+PARAMETERS = {
+    'TERMS': 1000,
+    'USERS': 20,
+    'PROCESSES': 1,
+    'DURATION': 20,
+}
+
+
+def _get_parameter(name):
+    return int(os.environ.get('DISCOVERY_LOAD_TEST_' + name,
+                              PARAMETERS[name]))
+
+
+class TestLoad(object):
+
+    def setup(self):
+        if not os.environ.get('DISCOVERY_LOAD_TEST'):
+            raise SkipTest('Set DISCOVERY_LOAD_TEST to run the load test')
+        get_admission_filter().clear()
+
+    def teardown(self):
+        get_backend().clear()
+
+    def test_mixed_load(self):
+        num_terms = _get_parameter('TERMS')
+        corpus = ZipfCorpus(num_terms)
+        populate(get_backend(), corpus, 2 * num_terms)
+        stats, duration = run_load(corpus, _get_parameter('USERS'),
+                                   _get_parameter('DURATION'),
+                                   _get_parameter('PROCESSES'))
+        report = stats.report(duration)
+        print(json.dumps(report, indent=2, sort_keys=True))
+        for op in ['suggest', 'store']:
+            ok_(report['operations'][op]['num'] > 0,
+                'No successful "{}" operations'.format(op))
+        eq_(stats.num_errors(), 0, '{} errors occurred:\n{}'.format(
+            stats.num_errors(),
+            '\n'.join(sum(report['error_samples'].values(), []))))
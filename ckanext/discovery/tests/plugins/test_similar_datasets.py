@@ -7,21 +7,54 @@ Tests for ``ckanext.discovery.plugins.similar_datasets``.
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from nose.tools import eq_, assert_not_in, ok_
+import os.path
+import shutil
+import tempfile
+import threading
+
+import mock
+from nose.tools import eq_, assert_not_in, ok_, raises
 from routes import url_for
 from bs4 import BeautifulSoup
 
+from ckan.common import config
+from ckan.logic import NotAuthorized
+import ckan.lib.search as search
+import ckan.plugins.toolkit as toolkit
 import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 
-from ...plugins.similar_datasets import get_similar_datasets
-from .. import changed_config, purge_datasets
+from ...plugins.similar_datasets import (_get_cache, get_similar_datasets,
+                                         get_similar_datasets_batch,
+                                         SimilarDatasetsCache)
+from ...plugins.similar_datasets.local import (build_index,
+                                               compute_signature,
+                                               get_words, iter_signatures,
+                                               load_signature, LocalIndex,
+                                               similarity, tokenize)
+from ...plugins.similar_datasets.model import create_tables
+from ...plugins.similar_datasets.precompute import (get_similar_ids,
+                                                    precompute)
+from ...plugins.similar_datasets.solr import (get_fields,
+                                              more_like_this,
+                                              more_like_this_batch,
+                                              parse_docs)
+from ...solr import query, SolrUnavailable
+from .. import (assert_anonymous_access, call_action_with_auth,
+                changed_config, paster, purge_datasets)
+
+
+PRECOMPUTED = 'ckanext.discovery.similar_datasets.precomputed'
+ENGINE = 'ckanext.discovery.similar_datasets.engine'
+INDEX_PATH = 'ckanext.discovery.similar_datasets.index_path'
+MAX_NUM_LIMIT = 'ckanext.discovery.similar_datasets.max_num_limit'
 
 
 class SimilarDatasetsTestBase(helpers.FunctionalTestBase):
     def setup(self):
         # The super class method clears the DB and the search index
         super(SimilarDatasetsTestBase, self).setup()
+        _get_cache().clear()
         self.datasets = [
             factories.Dataset(title='cat dog wolf'),
             factories.Dataset(title='cat dog fox'),
@@ -107,6 +140,489 @@ class TestGetSimilarDatasets(SimilarDatasetsTestBase):
                                     owner_org=org['id'], private=True)
         self.assert_not_similar([private])
 
+    def test_solr_unavailable(self):
+        '''
+        No similar datasets are returned if Solr is not available, and
+        that result is not cached.
+        '''
+        id = self.datasets[0]['id']
+        with mock.patch('ckanext.discovery.plugins.similar_datasets.solr.'
+                        + 'query', side_effect=SolrUnavailable()):
+            eq_(get_similar_datasets(id), [])
+        ok_(get_similar_datasets(id))
+
+    def test_default_fields(self):
+        '''
+        By default only the fields needed for display are returned.
+        '''
+        for dataset in get_similar_datasets(self.datasets[0]['id']):
+            eq_(sorted(dataset.keys()), ['id', 'name', 'notes', 'title'])
+
+    def test_configured_fields(self):
+        with changed_config('ckanext.discovery.similar_datasets.fields',
+                            'name metadata_modified'):
+            similar = get_similar_datasets(self.datasets[0]['id'])
+        for dataset in similar:
+            eq_(sorted(dataset.keys()), ['id', 'metadata_modified', 'name'])
+
+    def test_full(self):
+        '''
+        Full dataset dicts can be requested.
+        '''
+        similar = get_similar_datasets(self.datasets[0]['id'], full=True)
+        slim = get_similar_datasets(self.datasets[0]['id'])
+        eq_([d['id'] for d in similar], [d['id'] for d in slim])
+        for dataset in similar:
+            ok_('resources' in dataset)
+
+
+def make_datasets(*ids):
+    return [{'id': id} for id in ids]
+
+
+class TestSimilarDatasetsCache(object):
+    '''
+    Test ``SimilarDatasetsCache``.
+    '''
+    def test_slicing(self):
+        cache = SimilarDatasetsCache()
+        ok_(cache.get('x', 2) is None)
+        cache.set('x', 3, make_datasets('a', 'b', 'c'))
+        eq_(cache.get('x', 2), make_datasets('a', 'b'))
+        eq_(cache.get('x', 3), make_datasets('a', 'b', 'c'))
+
+        # There might be more than 3 similar datasets
+        ok_(cache.get('x', 4) is None)
+
+    def test_exhaustive_entry(self):
+        cache = SimilarDatasetsCache()
+        cache.set('x', 3, make_datasets('a'))
+        eq_(cache.get('x', 10), make_datasets('a'))
+
+    def test_invalidate(self):
+        cache = SimilarDatasetsCache()
+        cache.set('x', 5, make_datasets('a', 'b'))
+        cache.set('y', 5, make_datasets('b', 'c'))
+        cache.set('z', 5, make_datasets('c'))
+        cache.invalidate('a')
+        ok_(cache.get('x', 5) is None)
+        ok_(cache.get('y', 5) is not None)
+        cache.invalidate('z')
+        ok_(cache.get('z', 5) is None)
+        ok_(cache.get('y', 5) is not None)
+        cache.invalidate('b')
+        ok_(cache.get('y', 5) is None)
+
+    def test_fields(self):
+        '''
+        Entries for different fields are separate but invalidated
+        together.
+        '''
+        cache = SimilarDatasetsCache()
+        cache.set('x', 5, make_datasets('a'), ('id',))
+        ok_(cache.get('x', 5) is None)
+        cache.set('x', 5, make_datasets('a'))
+        cache.invalidate('x')
+        ok_(cache.get('x', 5) is None)
+        ok_(cache.get('x', 5, ('id',)) is None)
+
+    def test_prune(self):
+        cache = SimilarDatasetsCache(max_size=1)
+        for i in range(20):
+            cache.set(i, 5, make_datasets(i + 100))
+        ok_(len(cache._listed_in) <= 10)
+
+
+class TestParseDocs(object):
+    '''
+    Test ``parse_docs``.
+    '''
+    def test_fields(self):
+        docs = [{'id': 'a', 'name': 'x', 'score': 1.0}]
+        eq_(parse_docs(docs, ('id', 'name', 'title')),
+            [{'id': 'a', 'name': 'x', 'title': None}])
+
+    def test_full(self):
+        docs = [{'id': 'a', 'validated_data_dict': '{"id": "a", "x": 1}'}]
+        eq_(parse_docs(docs), [{'id': 'a', 'x': 1}])
+
+
+class TestMoreLikeThisBatch(object):
+    '''
+    Test ``more_like_this_batch`` with mocked Solr results.
+    '''
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.solr.query')
+    def test_lookup_by_index_id(self, solr_query):
+        public = {
+            'site_id': config.get('ckan.site_id'),
+            'dataset_type': 'dataset',
+            'state': 'active',
+            'capacity': 'public',
+        }
+        results = mock.Mock()
+        results.docs = [{'id': 'a', 'index_id': 'hash-a'}]
+        results.more_like_this = {
+            'hash-a': {'docs': [dict(public, id='b', score=1.0),
+                                dict(public, id='c', score=0.5,
+                                     capacity='private')]},
+        }
+        solr_query.return_value = results
+        similar = more_like_this_batch(['a', 'x'], 5)
+        eq_([doc['id'] for doc in similar['a']], ['b'])
+        eq_(similar['x'], [])
+
+
+class TestCaching(SimilarDatasetsTestBase):
+    '''
+    Test caching of similar datasets.
+    '''
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.'
+                + '_query_similar_datasets')
+    def test_cached(self, query):
+        query.return_value = self.datasets[1:4]
+        id = self.datasets[0]['id']
+        eq_(get_similar_datasets(id, max_num=2), self.datasets[1:3])
+        eq_(get_similar_datasets(id, max_num=3), self.datasets[1:4])
+        eq_(get_similar_datasets(id, max_num=10), self.datasets[1:4])
+        query.assert_called_once_with(id, 5, get_fields())
+
+    def test_invalidation_on_update(self):
+        id = self.datasets[0]['id']
+        similar = get_similar_datasets(id)
+        changed = similar[0]
+        helpers.call_action('package_patch', id=changed['id'],
+                            title='dolphin')
+        similar = get_similar_datasets(id)
+        assert_not_in(changed['id'], [d['id'] for d in similar])
+
+    def test_invalidation_on_delete(self):
+        id = self.datasets[0]['id']
+        similar = get_similar_datasets(id)
+        deleted = similar[0]
+        helpers.call_action('package_delete', id=deleted['id'])
+        similar = get_similar_datasets(id)
+        assert_not_in(deleted['id'], [d['id'] for d in similar])
+
+
+class TestPrecompute(SimilarDatasetsTestBase):
+    '''
+    Test precomputed similar datasets.
+    '''
+    def setup(self):
+        super(TestPrecompute, self).setup()
+        create_tables()
+
+    def test_precompute(self):
+        id = self.datasets[0]['id']
+        with changed_config(PRECOMPUTED, 'true'):
+            eq_(precompute(3), len(self.datasets))
+            num, similar = get_similar_ids(id)
+        eq_(num, 3)
+        # Compare with the results of the MoreLikeThis handler, which is
+        # used for live queries
+        expected = [d['id'] for d in more_like_this(id, 3)]
+        eq_(len(similar), len(expected))
+        eq_(set(s for s, _ in similar), set(expected))
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.precompute.'
+                + 'more_like_this_batch', wraps=more_like_this_batch)
+    def test_single_query_per_batch(self, batch):
+        with changed_config(PRECOMPUTED, 'true'):
+            precompute(3)
+        eq_(batch.call_count, 1)
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.more_like_this')
+    def test_precomputed_are_used(self, more_like_this):
+        id = self.datasets[0]['id']
+        with changed_config(PRECOMPUTED, 'true'):
+            precompute(5)
+            similar = get_similar_datasets(id)
+        eq_(len(similar), 5)
+        more_like_this.assert_not_called()
+
+    def test_live_results_are_stored(self):
+        id = self.datasets[0]['id']
+        with changed_config(PRECOMPUTED, 'true'):
+            similar = get_similar_datasets(id, max_num=2)
+            eq_(get_similar_ids(id)[1][0][0], similar[0]['id'])
+
+    def test_invalidation(self):
+        ids = [dataset['id'] for dataset in self.datasets]
+        with changed_config(PRECOMPUTED, 'true'):
+            precompute(5)
+            helpers.call_action('package_patch', id=ids[1], title='dolphin')
+            ok_(get_similar_ids(ids[1]) is None)
+            # Dataset 0 listed dataset 1 as similar
+            ok_(get_similar_ids(ids[0]) is None)
+            ok_(get_similar_ids(ids[6]) is not None)
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.precompute.'
+                + 'is_enabled', return_value=True)
+    def test_paster(self, is_enabled):
+        # The paster command reloads the configuration from file, so the
+        # setting cannot be changed via ``changed_config``.
+        stdout = paster('similar_datasets', 'precompute', '--num=2')[1]
+        ok_('Processed {} datasets'.format(len(self.datasets)) in stdout)
+
+
+def words(n, prefix='word'):
+    return {'{}{}'.format(prefix, i) for i in range(n)}
+
+
+class TestSignatures(object):
+    '''
+    Test the signatures of the local similarity engine.
+    '''
+    def test_tokenize(self):
+        eq_(tokenize('The Cat and the DOG, by öko-Äpfeln'),
+            {'cat', 'dog', 'öko', 'äpfeln'})
+
+    def test_get_words(self):
+        eq_(get_words({'title': 'Cat', 'notes': None, 'tags': ['dog', 'fox'],
+                       'res_name': ['wolf', None], 'author': 'bear'}),
+            {'cat', 'dog', 'fox', 'wolf'})
+
+    def test_empty(self):
+        ok_(compute_signature(set()) is None)
+
+    def test_similarity(self):
+        a = compute_signature(words(100))
+        eq_(similarity(a, compute_signature(words(100))), 1)
+        # Jaccard similarity of 1/3
+        b = compute_signature(words(100) | words(100, 'other'))
+        ok_(0.1 < similarity(a, b) < 0.6)
+        c = compute_signature(words(100, 'other'))
+        ok_(similarity(a, c) < 0.1)
+
+    def test_single_word(self):
+        eq_(similarity(compute_signature({'cat'}), compute_signature({'cat'})),
+            1)
+        ok_(similarity(compute_signature({'cat'}),
+                       compute_signature({'dog'})) < 0.1)
+
+
+class TestLocalIndex(object):
+    '''
+    Test ``build_index`` and ``LocalIndex``.
+    '''
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'similarity.idx')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_query(self):
+        base = words(50)
+        signatures = {
+            'a': compute_signature(base),
+            'b': compute_signature(base | words(5, 'b')),
+            'c': compute_signature(base | words(30, 'c')),
+            'd': compute_signature(words(50, 'd')),
+        }
+        eq_(build_index(sorted(signatures.iteritems()), self.path), 4)
+        index = LocalIndex(self.path)
+        eq_(len(index), 4)
+        result = index.query(signatures['a'], 5, exclude='a')
+        eq_([id for id, _ in result], ['b', 'c'])
+        ok_(result[0][1] > result[1][1])
+        eq_([id for id, _ in index.query(signatures['a'], 1)], ['a'])
+
+    def test_empty(self):
+        eq_(build_index([], self.path), 0)
+        eq_(LocalIndex(self.path).query(compute_signature({'cat'}), 5), [])
+
+    @raises(ValueError)
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 100)
+        LocalIndex(self.path)
+
+
+class TestLocalEngine(SimilarDatasetsTestBase):
+    '''
+    Test the local similarity engine.
+    '''
+    def setup(self):
+        super(TestLocalEngine, self).setup()
+        create_tables()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'similarity.idx')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self):
+        search.rebuild()
+        build_index(iter_signatures(), self.path)
+
+    def test_signatures_are_stored(self):
+        with changed_config(ENGINE, 'local'):
+            search.rebuild()
+            for dataset in self.datasets:
+                ok_(load_signature(dataset['id']) is not None)
+            helpers.call_action('package_delete', id=self.datasets[0]['id'])
+            ok_(load_signature(self.datasets[0]['id']) is None)
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.more_like_this')
+    def test_similar_datasets(self, more_like_this):
+        id = self.datasets[0]['id']
+        with changed_config(ENGINE, 'local'), \
+                changed_config(INDEX_PATH, self.path):
+            self.build()
+            similar = get_similar_datasets(id)
+            ok_(similar)
+            assert_not_in(id, [d['id'] for d in similar])
+            assert_not_in(self.datasets[6]['id'], [d['id'] for d in similar])
+            _get_cache().clear()
+            batch = get_similar_datasets_batch([id])
+        more_like_this.assert_not_called()
+        eq_(batch[id], similar)
+
+    def test_no_index(self):
+        with changed_config(ENGINE, 'local'), \
+                changed_config(INDEX_PATH, self.path):
+            search.rebuild()
+            eq_(get_similar_datasets(self.datasets[0]['id']), [])
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.local.'
+                + 'is_enabled', return_value=True)
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.local.'
+                + 'get_index_path')
+    def test_paster(self, get_index_path, is_enabled):
+        get_index_path.return_value = self.path
+        with changed_config(ENGINE, 'local'):
+            search.rebuild()
+        stdout = paster('similar_datasets', 'build-index')[1]
+        ok_('Indexed {} datasets'.format(len(self.datasets)) in stdout)
+        ok_(os.path.isfile(self.path))
+
+
+class TestAction(SimilarDatasetsTestBase):
+    '''
+    Test the ``discovery_similar_datasets`` action.
+    '''
+    def test_result(self):
+        result = helpers.call_action('discovery_similar_datasets',
+                                     id=self.datasets[0]['id'])
+        expected = get_similar_datasets(self.datasets[0]['id'])
+        eq_([d['id'] for d in result], [d['id'] for d in expected])
+        for dataset in result:
+            eq_(sorted(dataset.keys()), ['id', 'name', 'notes', 'title'])
+
+    def test_name(self):
+        '''
+        Datasets can be identified by name.
+        '''
+        by_id = helpers.call_action('discovery_similar_datasets',
+                                    id=self.datasets[0]['id'])
+        by_name = helpers.call_action('discovery_similar_datasets',
+                                      id=self.datasets[0]['name'])
+        eq_(by_name, by_id)
+
+    def test_max_num(self):
+        result = helpers.call_action('discovery_similar_datasets',
+                                     id=self.datasets[0]['id'], max_num=2)
+        eq_(len(result), 2)
+
+    @raises(toolkit.ValidationError)
+    def test_max_num_limit(self):
+        with changed_config(MAX_NUM_LIMIT, 10):
+            helpers.call_action('discovery_similar_datasets',
+                                id=self.datasets[0]['id'], max_num=11)
+
+    @raises(toolkit.ObjectNotFound)
+    def test_not_existing_dataset(self):
+        helpers.call_action('discovery_similar_datasets',
+                            id='this-id-does-not-exist')
+
+    @raises(toolkit.ValidationError)
+    def test_no_id(self):
+        helpers.call_action('discovery_similar_datasets')
+
+    def test_anonymous_access(self):
+        assert_anonymous_access('discovery_similar_datasets',
+                                id=self.datasets[0]['id'])
+
+    @raises(NotAuthorized)
+    def test_private_dataset(self):
+        '''
+        Users who cannot read a dataset cannot get its similar datasets.
+        '''
+        org = factories.Organization()
+        private = factories.Dataset(title=self.datasets[0]['title'],
+                                    owner_org=org['id'], private=True)
+        call_action_with_auth('discovery_similar_datasets', {'user': ''},
+                              id=private['id'])
+
+
+class TestBatch(SimilarDatasetsTestBase):
+    '''
+    Test ``get_similar_datasets_batch`` and the corresponding action.
+    '''
+    def test_same_as_single(self):
+        ids = [dataset['id'] for dataset in self.datasets]
+        batch = get_similar_datasets_batch(ids)
+        _get_cache().clear()
+        for id in ids:
+            eq_(set(d['id'] for d in batch[id]),
+                set(d['id'] for d in get_similar_datasets(id)))
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.solr.query',
+                wraps=query)
+    def test_single_query(self, solr_query):
+        ids = [dataset['id'] for dataset in self.datasets]
+        get_similar_datasets_batch(ids)
+        eq_(solr_query.call_count, 1)
+        # Cached results are reused
+        get_similar_datasets_batch(ids)
+        eq_(solr_query.call_count, 1)
+
+    def test_not_public(self):
+        '''
+        Datasets that are not public are not listed.
+        '''
+        org = factories.Organization()
+        private = factories.Dataset(title=self.datasets[0]['title'],
+                                    owner_org=org['id'], private=True)
+        ids = [self.datasets[0]['id'], private['id']]
+        similar = get_similar_datasets_batch(ids, max_num=10)
+        assert_not_in(private['id'], [d['id'] for d in similar[ids[0]]])
+        eq_(similar[private['id']], [])
+
+    def test_action(self):
+        names = [dataset['name'] for dataset in self.datasets[:3]]
+        result = helpers.call_action('discovery_similar_datasets_batch',
+                                     ids=names, max_num=2)
+        eq_(sorted(result.keys()), sorted(names))
+        for name in names:
+            eq_(len(result[name]), 2)
+            for dataset in result[name]:
+                eq_(sorted(dataset.keys()), ['id', 'name', 'notes', 'title'])
+
+    def test_action_anonymous_access(self):
+        assert_anonymous_access('discovery_similar_datasets_batch',
+                                ids=[self.datasets[0]['id']])
+
+    @raises(NotAuthorized)
+    def test_action_private_dataset(self):
+        org = factories.Organization()
+        private = factories.Dataset(owner_org=org['id'], private=True)
+        call_action_with_auth('discovery_similar_datasets_batch',
+                              {'user': ''},
+                              ids=[self.datasets[0]['id'], private['id']])
+
+    @raises(toolkit.ValidationError)
+    def test_action_too_many_ids(self):
+        helpers.call_action('discovery_similar_datasets_batch',
+                            ids=[self.datasets[0]['id']] * 101)
+
+    @raises(toolkit.ValidationError)
+    def test_action_max_num_limit(self):
+        with changed_config(MAX_NUM_LIMIT, 10):
+            helpers.call_action('discovery_similar_datasets_batch',
+                                ids=[self.datasets[0]['id']], max_num=11)
+
 
 class TestUI(SimilarDatasetsTestBase):
     '''
@@ -161,3 +677,37 @@ class TestUI(SimilarDatasetsTestBase):
             with changed_config(key, max_num):
                 assert_number_of_items(max_num)
 
+    def test_prefetch(self):
+        '''
+        The similar datasets are prefetched on the dataset page.
+        '''
+        threads = []
+
+        def query_similar_datasets(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return [self.datasets[1]]
+
+        with mock.patch('ckanext.discovery.plugins.similar_datasets.'
+                        '_query_similar_datasets',
+                        side_effect=query_similar_datasets):
+            soup = self.make_soup(controller='package', action='read',
+                                  id=self.datasets[0]['id'])
+        links = soup.select('.similar-datasets li a')
+        eq_([link.text for link in links], [self.datasets[1]['title']])
+        eq_(len(threads), 1)
+        ok_(threads[0] is not threading.current_thread())
+
+    @mock.patch('ckanext.discovery.plugins.similar_datasets.'
+                '_query_similar_datasets')
+    def test_async(self, query):
+        '''
+        In asynchronous mode only a placeholder is rendered.
+        '''
+        with changed_config('ckanext.discovery.similar_datasets.async',
+                            'true'):
+            soup = self.make_soup(controller='package', action='read',
+                                  id=self.datasets[0]['id'])
+        section = soup.find('section', class_='similar-datasets')
+        eq_(section['data-dataset-id'], self.datasets[0]['id'])
+        eq_(section.ul.find_all('li'), [])
+        ok_(not query.called)
@@ -8,15 +8,23 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import re
+import threading
 
 import mock
-from nose.tools import assert_in, eq_
+from nose.tools import assert_in, eq_, ok_
 
 import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 
-from ...plugins.tag_cloud import bin_tags
-from .. import assert_regex_search, changed_config, purge_datasets
+from ...plugins.tag_cloud import _get_cache, bin_tags
+from ...plugins.tag_cloud.model import create_tables, DatasetTag
+from ...plugins.tag_cloud import tag_counts
+from ...plugins.tag_cloud.tag_counts import get_tag_counts, rebuild
+from ...solr import query, SolrUnavailable
+from .. import assert_regex_search, changed_config, paster, purge_datasets
+
+
+SOURCE = 'ckanext.discovery.tag_cloud.source'
 
 
 def set_tags(**kwargs):
@@ -29,6 +37,8 @@ def set_tags(**kwargs):
     Before new datasets are created all existing datasets are purged.
     '''
     purge_datasets()
+    # Purging datasets does not invalidate the cache
+    _get_cache().clear()
     for tag, count in kwargs.iteritems():
         for i in range(count):
             factories.Dataset(tags=[{'name': tag}])
@@ -102,6 +112,152 @@ class TestBinTags(object):
         for num_tags in [0, 1, 2, 3, 10, 30, 40]:
             eq_(len(bin_tags(num_tags=num_tags)), min(num_tags, max_num))
 
+    def test_private_datasets(self):
+        '''
+        Tags of private datasets are ignored.
+        '''
+        set_tags(cat=1)
+        org = factories.Organization()
+        factories.Dataset(tags=[{'name': 'secret'}], owner_org=org['id'],
+                          private=True)
+        assert_bins({'cat': 1})
+
+    @mock.patch('ckanext.discovery.plugins.tag_cloud.query',
+                side_effect=SolrUnavailable())
+    def test_solr_unavailable(self, query):
+        '''
+        No tags are returned if Solr is not available.
+        '''
+        eq_(bin_tags(), {})
+
+
+
+@mock.patch('ckanext.discovery.plugins.tag_cloud.query', wraps=query)
+class TestCaching(object):
+    '''
+    Test caching of the tag cloud.
+    '''
+    def setup(self):
+        set_tags(cat=2, dog=1)
+
+    def test_cached(self, solr_query):
+        eq_(bin_tags(), {'cat': 3, 'dog': 1})
+        eq_(bin_tags(), {'cat': 3, 'dog': 1})
+        eq_(solr_query.call_count, 1)
+
+    def test_fewer_tags_are_sliced(self, solr_query):
+        bin_tags(num_tags=10)
+        eq_(bin_tags(num_tags=1), {'cat': 1})
+        eq_(solr_query.call_count, 1)
+        eq_(solr_query.call_args[1]['facet.limit'], 20)
+
+    def test_more_tags(self, solr_query):
+        with changed_config('ckanext.discovery.tag_cloud.num_tags', 1):
+            eq_(bin_tags(num_tags=1), {'cat': 1})
+            eq_(bin_tags(num_tags=2), {'cat': 3, 'dog': 1})
+            eq_(solr_query.call_count, 2)
+            bin_tags(num_tags=3)
+            eq_(solr_query.call_count, 3)
+            # Fewer tags than requested were found, so there are no more
+            bin_tags(num_tags=10)
+            eq_(solr_query.call_count, 3)
+
+    def test_invalidation(self, solr_query):
+        bin_tags()
+        dataset = factories.Dataset(tags=[{'name': 'fox'}])
+        ok_('fox' in bin_tags())
+        helpers.call_action('package_patch', id=dataset['id'],
+                            tags=[{'name': 'wolf'}])
+        ok_('wolf' in bin_tags())
+        helpers.call_action('package_delete', id=dataset['id'])
+        eq_(bin_tags(), {'cat': 3, 'dog': 1})
+        eq_(solr_query.call_count, 4)
+
+    def test_solr_unavailable_is_not_cached(self, solr_query):
+        solr_query.side_effect = SolrUnavailable()
+        eq_(bin_tags(), {})
+        solr_query.side_effect = None
+        eq_(bin_tags(), {'cat': 3, 'dog': 1})
+
+
+class TestStoredCounts(object):
+    '''
+    Test tag counts stored in the database.
+    '''
+    def setup(self):
+        create_tables()
+        set_tags(cat=2, dog=1)
+        with changed_config(SOURCE, 'database'):
+            rebuild()
+
+    def test_rebuild(self):
+        eq_(get_tag_counts(10), [('cat', 2), ('dog', 1)])
+        eq_(get_tag_counts(1), [('cat', 2)])
+
+    def test_create(self):
+        with changed_config(SOURCE, 'database'):
+            factories.Dataset(tags=[{'name': 'dog'}, {'name': 'fox'}])
+        eq_(get_tag_counts(10), [('cat', 2), ('dog', 2), ('fox', 1)])
+
+    def test_update(self):
+        with changed_config(SOURCE, 'database'):
+            dataset = factories.Dataset(tags=[{'name': 'cat'}])
+            helpers.call_action('package_patch', id=dataset['id'],
+                                tags=[{'name': 'fox'}])
+        eq_(get_tag_counts(10), [('cat', 2), ('dog', 1), ('fox', 1)])
+
+    def test_delete(self):
+        with changed_config(SOURCE, 'database'):
+            dataset = factories.Dataset(tags=[{'name': 'fox'}])
+            helpers.call_action('package_delete', id=dataset['id'])
+        eq_(get_tag_counts(10), [('cat', 2), ('dog', 1)])
+
+    def test_private_datasets(self):
+        org = factories.Organization()
+        with changed_config(SOURCE, 'database'):
+            dataset = factories.Dataset(tags=[{'name': 'secret'}],
+                                        owner_org=org['id'], private=True)
+            eq_(get_tag_counts(10), [('cat', 2), ('dog', 1)])
+            helpers.call_action('package_patch', id=dataset['id'],
+                                private=False)
+            eq_(get_tag_counts(10), [('cat', 2), ('dog', 1), ('secret', 1)])
+            rebuild()
+        eq_(get_tag_counts(10), [('cat', 2), ('dog', 1), ('secret', 1)])
+
+    def test_concurrent_delete(self):
+        '''
+        Tags deleted by a concurrent update are not decremented twice.
+        '''
+        with changed_config(SOURCE, 'database'):
+            dataset = factories.Dataset(tags=[{'name': 'cat'}])
+        delete_tags = tag_counts._delete_tags
+
+        def delete_concurrently(conn, id, tags):
+            # Emulate a concurrent transaction that has already deleted
+            # the rows (and decremented the counts itself)
+            conn.execute(DatasetTag.__table__.delete()
+                         .where(DatasetTag.dataset_id == id))
+            return delete_tags(conn, id, tags)
+
+        with mock.patch.object(tag_counts, '_delete_tags',
+                               side_effect=delete_concurrently):
+            tag_counts._update(dataset['id'], set())
+        eq_(get_tag_counts(10), [('cat', 3), ('dog', 1)])
+
+    @mock.patch('ckanext.discovery.plugins.tag_cloud.query')
+    def test_bin_tags(self, solr_query):
+        with changed_config(SOURCE, 'database'):
+            eq_(bin_tags(), {'cat': 3, 'dog': 1})
+        ok_(not solr_query.called)
+
+    @mock.patch('ckanext.discovery.plugins.tag_cloud.tag_counts.'
+                + 'is_enabled', return_value=True)
+    def test_paster(self, is_enabled):
+        # The paster command reloads the configuration from file, so the
+        # setting cannot be changed via ``changed_config``.
+        stdout = paster('tag_cloud', 'rebuild')[1]
+        ok_('Counted 2 tags' in stdout)
+
 
 class TestUI(helpers.FunctionalTestBase):
     '''
@@ -147,3 +303,22 @@ class TestUI(helpers.FunctionalTestBase):
                     r'<a\s+class="level-\d"\s+href="[^"]*"\s*>', body)
                 eq_(len(tag_cloud_links), min(num_tags, max_num))
 
+
+    def test_prefetch(self):
+        '''
+        The tag counts are prefetched on the front page.
+        '''
+        set_tags(cat=1)
+        threads = []
+
+        def get_tag_counts(num_tags):
+            threads.append(threading.current_thread())
+            return [('cat', 1)]
+
+        with mock.patch('ckanext.discovery.plugins.tag_cloud._get_tag_counts',
+                        side_effect=get_tag_counts):
+            app = self._get_test_app()
+            body = app.get('/').body.decode('utf-8')
+        assert_in('>cat</a>', body)
+        eq_(len(threads), 1)
+        ok_(threads[0] is not threading.current_thread())
@@ -0,0 +1,75 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.cache``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import mock
+from nose.tools import eq_, ok_
+
+from ..cache import TTLCache
+
+
+class TestTTLCache(object):
+    '''
+    Tests for ``TTLCache``.
+    '''
+    def test_get_and_set(self):
+        cache = TTLCache()
+        ok_(cache.get('x') is None)
+        eq_(cache.get('x', 1), 1)
+        cache.set('x', 2)
+        eq_(cache.get('x'), 2)
+        ok_('x' in cache)
+
+    def test_max_size(self):
+        cache = TTLCache(max_size=2)
+        cache.set('x', 1)
+        cache.set('y', 2)
+        cache.get('x')
+        cache.set('z', 3)
+        eq_(len(cache), 2)
+        ok_('y' not in cache)
+        eq_(cache.get('x'), 1)
+        eq_(cache.get('z'), 3)
+
+    def test_ttl(self):
+        cache = TTLCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.set('x', 1)
+        with mock.patch('time.time', return_value=109):
+            eq_(cache.get('x'), 1)
+        with mock.patch('time.time', return_value=111):
+            ok_(cache.get('x') is None)
+
+    def test_keys(self):
+        cache = TTLCache()
+        cache.set('x', 1)
+        cache.set('y', 2)
+        eq_(sorted(cache.keys()), ['x', 'y'])
+        eq_(cache.hits + cache.misses, 0)
+
+    def test_invalidate_and_clear(self):
+        cache = TTLCache()
+        cache.set('x', 1)
+        cache.set('y', 2)
+        cache.invalidate('x')
+        ok_('x' not in cache)
+        eq_(cache.get('y'), 2)
+        cache.clear()
+        eq_(len(cache), 0)
+
+    def test_hits_and_misses(self):
+        cache = TTLCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.get('x')
+            cache.set('x', 1)
+            cache.get('x')
+            ok_('x' in cache)
+        with mock.patch('time.time', return_value=111):
+            cache.get('x')
+        eq_(cache.hits, 2)
+        eq_(cache.misses, 2)
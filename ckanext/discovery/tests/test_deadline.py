@@ -0,0 +1,50 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.deadline``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import mock
+from nose.tools import eq_, ok_, raises
+
+from ..deadline import Deadline, DeadlineExceeded, get_current_deadline
+
+
+class TestDeadline(object):
+    '''
+    Tests for ``Deadline``.
+    '''
+    def test_unlimited(self):
+        deadline = Deadline(0)
+        ok_(deadline.remaining() is None)
+        ok_(not deadline.expired())
+        deadline.check()
+
+    def test_expiry(self):
+        with mock.patch('time.time', return_value=100):
+            deadline = Deadline(2)
+        with mock.patch('time.time', return_value=101):
+            eq_(deadline.remaining(), 1)
+            ok_(not deadline.expired())
+        with mock.patch('time.time', return_value=102):
+            eq_(deadline.remaining(), 0)
+            ok_(deadline.expired())
+
+    @raises(DeadlineExceeded)
+    def test_check(self):
+        with mock.patch('time.time', return_value=100):
+            deadline = Deadline(1)
+        with mock.patch('time.time', return_value=200):
+            deadline.check()
+
+    def test_current_deadline(self):
+        ok_(get_current_deadline() is None)
+        with Deadline(1) as outer:
+            ok_(get_current_deadline() is outer)
+            with Deadline(2) as inner:
+                ok_(get_current_deadline() is inner)
+            ok_(get_current_deadline() is outer)
+        ok_(get_current_deadline() is None)
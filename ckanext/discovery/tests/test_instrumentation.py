@@ -0,0 +1,110 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.instrumentation``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import threading
+
+from nose.tools import eq_, ok_, raises
+from sqlalchemy import create_engine
+
+from ..instrumentation import (
+    instrument_engine,
+    instrumented,
+    log as instrumentation_log,
+    measure,
+    record_statement,
+)
+from . import assert_max_statements, recorded_logs
+
+
+class TestMeasure(object):
+    '''
+    Tests for ``measure`` and ``record_statement``.
+    '''
+    def test_measure(self):
+        with measure('test') as stats:
+            record_statement(3, 0.5)
+            record_statement(0, 0.25)
+        eq_(stats.name, 'test')
+        eq_(stats.statements, 2)
+        eq_(stats.rows, 3)
+        eq_(stats.duration, 0.75)
+
+        # Statements after the measurement are not counted
+        record_statement(1, 1)
+        eq_(stats.statements, 2)
+
+    def test_nested(self):
+        with measure() as outer:
+            record_statement(1, 0)
+            with measure() as inner:
+                record_statement(1, 0)
+        eq_(outer.statements, 2)
+        eq_(inner.statements, 1)
+
+    def test_other_threads_are_not_counted(self):
+        thread = threading.Thread(target=record_statement, args=(1, 0))
+        with measure() as stats:
+            thread.start()
+            thread.join()
+        eq_(stats.statements, 0)
+
+    def test_engine(self):
+        engine = create_engine('sqlite://')
+        instrument_engine(engine)
+        with measure() as stats:
+            engine.execute('CREATE TABLE t (x INTEGER)')
+            engine.execute('INSERT INTO t VALUES (1), (2), (3)')
+            engine.execute('UPDATE t SET x = x + 1 WHERE x > 1')
+        eq_(stats.statements, 3)
+        eq_(stats.rows, 5)
+        ok_(stats.duration > 0)
+
+
+class TestInstrumented(object):
+    '''
+    Tests for ``instrumented``.
+    '''
+    def test_summary_is_logged(self):
+        @instrumented('my_action')
+        def f(x):
+            record_statement(2, 0.001)
+            return x
+
+        with recorded_logs(instrumentation_log) as logs:
+            eq_(f(1), 1)
+        logs.assert_log('debug', r'^my_action: 1 statements, 2 rows, 1\.0ms$')
+
+    def test_exception(self):
+        @instrumented('my_action')
+        def f():
+            raise ValueError()
+
+        with recorded_logs(instrumentation_log) as logs:
+            try:
+                f()
+            except ValueError:
+                pass
+        logs.assert_log('debug', r'^my_action: 0 statements')
+
+
+class TestAssertMaxStatements(object):
+    '''
+    Tests for ``assert_max_statements``.
+    '''
+    def test_within_bound(self):
+        with assert_max_statements(2) as stats:
+            record_statement(1, 0)
+            record_statement(1, 0)
+        eq_(stats.statements, 2)
+
+    @raises(AssertionError)
+    def test_exceeded(self):
+        with assert_max_statements(1):
+            record_statement(1, 0)
+            record_statement(1, 0)
@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.metrics``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import mock
+from nose.tools import eq_, ok_, raises
+from routes import url_for
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+
+from ..metrics import get_registry, Registry
+from . import changed_config
+
+
+ENABLED = 'ckanext.discovery.metrics.enabled'
+
+
+class TestRegistry(object):
+    '''
+    Tests for ``Registry`` and the metric classes.
+    '''
+    def setup(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('c_total', 'A counter', ['kind'])
+        with changed_config(ENABLED, 'true'):
+            counter.inc(kind='a')
+            counter.inc(2, kind='a')
+            counter.inc(kind='b')
+        eq_(self.registry.collect()['c_total'], {
+            'type': 'counter',
+            'help': 'A counter',
+            'samples': [('c_total', {'kind': 'a'}, 3),
+                        ('c_total', {'kind': 'b'}, 1)],
+        })
+
+    @raises(ValueError)
+    def test_wrong_labels(self):
+        counter = self.registry.counter('c_total', 'A counter', ['kind'])
+        with changed_config(ENABLED, 'true'):
+            counter.inc(other='a')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('h', 'A histogram',
+                                            buckets=[1, 2])
+        with changed_config(ENABLED, 'true'):
+            histogram.observe(0.5)
+            histogram.observe(1.5)
+            histogram.observe(3)
+        eq_(self.registry.collect()['h']['samples'], [
+            ('h_bucket', {'le': 1}, 1),
+            ('h_bucket', {'le': 2}, 2),
+            ('h_bucket', {'le': float('inf')}, 3),
+            ('h_sum', {}, 5),
+            ('h_count', {}, 3),
+        ])
+
+    def test_histogram_time(self):
+        histogram = self.registry.histogram('h', 'A histogram')
+        with changed_config(ENABLED, 'true'):
+            with mock.patch('time.time', side_effect=[10, 10.2]):
+                with histogram.time():
+                    pass
+        samples = self.registry.collect()['h']['samples']
+        ok_(('h_bucket', {'le': 0.1}, 0) in samples)
+        ok_(('h_bucket', {'le': 0.25}, 1) in samples)
+        ok_(('h_count', {}, 1) in samples)
+
+    def test_functions(self):
+        self.registry.gauge('g', 'A gauge', lambda: 0.5)
+        self.registry.counter_function('f_total', 'A function',
+                                       lambda: {('x', 'y'): 1},
+                                       ['a', 'b'])
+        metrics = self.registry.collect()
+        eq_(metrics['g']['samples'], [('g', {}, 0.5)])
+        eq_(metrics['f_total']['type'], 'counter')
+        eq_(metrics['f_total']['samples'],
+            [('f_total', {'a': 'x', 'b': 'y'}, 1)])
+
+    def test_disabled(self):
+        counter = self.registry.counter('c_total', 'A counter')
+        histogram = self.registry.histogram('h', 'A histogram')
+        with changed_config(ENABLED, 'false'):
+            counter.inc()
+            histogram.observe(1)
+            with histogram.time():
+                pass
+        eq_(self.registry.collect()['c_total']['samples'], [])
+        eq_(self.registry.collect()['h']['samples'], [])
+
+    def test_get_or_create(self):
+        counter = self.registry.counter('c_total', 'A counter')
+        ok_(self.registry.counter('c_total', 'A counter') is counter)
+
+    @raises(ValueError)
+    def test_type_conflict(self):
+        self.registry.counter('x', 'A counter')
+        self.registry.histogram('x', 'A histogram')
+
+    def test_clear(self):
+        counter = self.registry.counter('c_total', 'A counter')
+        with changed_config(ENABLED, 'true'):
+            counter.inc()
+        self.registry.clear()
+        eq_(self.registry.collect()['c_total']['samples'], [])
+
+    def test_render(self):
+        counter = self.registry.counter('c_total', 'A counter', ['kind'])
+        histogram = self.registry.histogram('h', 'A histogram', buckets=[1])
+        with changed_config(ENABLED, 'true'):
+            counter.inc(kind='say "hi"')
+            histogram.observe(0.5)
+        eq_(self.registry.render(), '\n'.join([
+            '# HELP c_total A counter',
+            '# TYPE c_total counter',
+            'c_total{kind="say \\"hi\\""} 1',
+            '# HELP h A histogram',
+            '# TYPE h histogram',
+            'h_bucket{le="1"} 1',
+            'h_bucket{le="+Inf"} 1',
+            'h_sum 0.5',
+            'h_count 1',
+        ]) + '\n')
+
+
+class TestMetricsRoute(helpers.FunctionalTestBase):
+    '''
+    Tests for the route that exposes the metrics.
+    '''
+    def get(self, user=None, status=200):
+        app = self._get_test_app()
+        environ = {'REMOTE_USER': user['name'].encode('ascii')} if user else {}
+        return app.get(url_for('discovery_metrics'), extra_environ=environ,
+                       status=status)
+
+    def test_sysadmin(self):
+        with changed_config(ENABLED, 'true'):
+            response = self.get(factories.Sysadmin())
+        ok_(response.content_type.startswith('text/plain'))
+        ok_('# TYPE discovery_search_suggest_duration_seconds histogram'
+            in response.body)
+        ok_('discovery_query_sample_rate 1.0' in response.body)
+
+    def test_other_users(self):
+        with changed_config(ENABLED, 'true'):
+            self.get(None, status=403)
+            self.get(factories.User(), status=403)
+
+    def test_disabled(self):
+        with changed_config(ENABLED, 'false'):
+            self.get(factories.Sysadmin(), status=404)
+
+    def test_plugins_record_metrics(self):
+        get_registry().clear()
+        with changed_config(ENABLED, 'true'):
+            helpers.call_action('discovery_search_suggest', q='cat')
+        samples = get_registry().collect()[
+            'discovery_search_suggest_duration_seconds']['samples']
+        ok_(('discovery_search_suggest_duration_seconds_count', {}, 1)
+            in samples)
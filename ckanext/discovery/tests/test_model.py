@@ -0,0 +1,197 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.model``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import mock
+from nose.tools import eq_, ok_, raises
+from sqlalchemy.exc import OperationalError
+
+from ckan.common import config
+import ckan.model.meta as ckan_meta
+
+from ..deadline import Deadline, DeadlineExceeded
+from ..model import (
+    get_engine,
+    get_read_replica,
+    get_session,
+    ReadReplica,
+    run_read,
+    transaction,
+)
+from . import changed_config
+
+
+READ_URL = 'ckanext.discovery.sqlalchemy.read_url'
+
+
+def identity(session):
+    return session
+
+
+class TestPrimaryDatabase(object):
+    '''
+    Tests for the extension's own connection to the primary database.
+    '''
+    def test_separate_engine(self):
+        '''
+        The extension doesn't use CKAN's engine or session.
+        '''
+        ok_(get_engine() is not ckan_meta.engine)
+        ok_(get_session() is not ckan_meta.Session)
+        eq_(str(get_engine().url), config['sqlalchemy.url'])
+
+    def test_engine_is_reused(self):
+        '''
+        The engine is reused even if its URL is normalized differently.
+        '''
+        # SQLAlchemy sorts the query parameters
+        url = 'sqlite:///?timeout=5&check_same_thread=false'
+        with changed_config('ckanext.discovery.sqlalchemy.url', url):
+            engine = get_engine()
+            ok_(str(engine.url) != url)
+            ok_(get_engine() is engine)
+        ok_(get_engine() is not engine)
+
+    def test_transaction_commit(self):
+        '''
+        Transactions are committed independently from CKAN's session.
+        '''
+        with transaction() as conn:
+            conn.execute('CREATE TABLE discovery_test (x INTEGER)')
+        try:
+            ckan_meta.Session.rollback()
+            eq_(get_engine().execute('SELECT COUNT(*) FROM discovery_test')
+                .scalar(), 0)
+        finally:
+            with transaction() as conn:
+                conn.execute('DROP TABLE discovery_test')
+
+    def test_transaction_rollback(self):
+        '''
+        Transactions are rolled back on errors.
+        '''
+        try:
+            with transaction() as conn:
+                conn.execute('CREATE TABLE discovery_test (x INTEGER)')
+                raise ValueError()
+        except ValueError:
+            pass
+        eq_(get_engine().execute('''
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_name = 'discovery_test'
+        ''').scalar(), 0)
+
+
+class TestRunRead(object):
+    '''
+    Tests for ``run_read``.
+    '''
+    def test_no_replica(self):
+        '''
+        Without a replica the primary database is used.
+        '''
+        with changed_config(READ_URL, None):
+            ok_(get_read_replica() is None)
+            ok_(run_read(identity) is get_session())
+
+    def test_replica(self):
+        '''
+        If a replica is configured then it is used.
+        '''
+        with changed_config(READ_URL, config['sqlalchemy.url']):
+            replica = get_read_replica()
+            ok_(run_read(identity) is replica.session)
+            eq_(run_read(lambda s: s.execute('SELECT 1').scalar()), 1)
+
+    def test_statement_timeout(self):
+        '''
+        The statement timeout is set on the replica connections.
+        '''
+        replica = ReadReplica(config['sqlalchemy.url'], statement_timeout=1234)
+        try:
+            timeout = replica.session.execute(
+                'SHOW statement_timeout').scalar()
+        finally:
+            replica.session.remove()
+        eq_(timeout, '1234ms')
+
+    def test_replica_is_read_only(self):
+        '''
+        Transactions on the replica are read-only.
+        '''
+        with changed_config(READ_URL, config['sqlalchemy.url']):
+            read_only = run_read(lambda s: s.execute(
+                                 'SHOW transaction_read_only').scalar())
+        eq_(read_only, 'on')
+
+    def test_fallback_on_error(self):
+        '''
+        If reading from the replica fails then the primary is used.
+        '''
+        def read(session):
+            if session is not get_session():
+                raise OperationalError('SELECT 1', {}, Exception('Boom'))
+            return session
+
+        with changed_config(READ_URL, config['sqlalchemy.url']):
+            replica = get_read_replica()
+            ok_(run_read(read) is get_session())
+
+            # The replica is not used until the retry interval has passed
+            ok_(not replica.is_available())
+            ok_(run_read(identity) is get_session())
+            replica._unavailable_until = 0
+            ok_(run_read(identity) is replica.session)
+
+    def test_unreachable_replica(self):
+        '''
+        An unreachable replica is not used.
+        '''
+        with changed_config(READ_URL, 'postgresql://invalid:invalid@'
+                            + '127.0.0.1:1/invalid'):
+            ok_(run_read(identity) is get_session())
+
+    def test_lag(self):
+        '''
+        A replica that lags behind too much is not used.
+        '''
+        with changed_config(READ_URL, config['sqlalchemy.url']):
+            replica = get_read_replica()
+            replica._lag_checked_at = 0
+            with mock.patch.object(replica, '_get_lag', return_value=1000):
+                ok_(run_read(identity) is get_session())
+            replica._lag_checked_at = 0
+            with mock.patch.object(replica, '_get_lag', return_value=1):
+                ok_(run_read(identity) is replica.session)
+
+    def test_deadline_statement_timeout(self):
+        '''
+        Statements are limited to the remaining time of the deadline.
+        '''
+        with Deadline(10):
+            timeout = run_read(lambda s: s.execute(
+                               'SHOW statement_timeout').scalar())
+        ok_(timeout != '0', timeout)
+
+    @raises(DeadlineExceeded)
+    def test_deadline_cancels_statement(self):
+        '''
+        Statements that exceed the deadline are cancelled.
+        '''
+        with Deadline(0.1):
+            run_read(lambda s: s.execute('SELECT pg_sleep(5)').scalar())
+
+    @raises(DeadlineExceeded)
+    def test_expired_deadline(self):
+        '''
+        No reads are started once the deadline has expired.
+        '''
+        with Deadline(0.001) as deadline:
+            while not deadline.expired():
+                pass
+            run_read(identity)
@@ -0,0 +1,159 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.prefetch``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import threading
+import time
+
+import mock
+from nose.tools import eq_, ok_, raises
+
+from ..prefetch import Prefetch, prefetchable, PrefetchTimeout, shutdown
+from ..tracing import span, traced
+from . import changed_config
+
+
+WORKERS = 'ckanext.discovery.prefetch.workers'
+TIMEOUT = 'ckanext.discovery.prefetch.timeout'
+SAMPLE_RATE = 'ckanext.discovery.tracing.sample_rate'
+
+
+class TestPrefetch(object):
+    '''
+    Tests for ``Prefetch``.
+    '''
+    def test_result(self):
+        prefetch = Prefetch(lambda x, y: x + y, (1,), {'y': 2})
+        prefetch.run()
+        ok_(prefetch.done())
+        eq_(prefetch.result(), 3)
+
+    @raises(ValueError)
+    def test_exception(self):
+        def fail():
+            raise ValueError()
+        prefetch = Prefetch(fail, (), {})
+        prefetch.run()
+        prefetch.result()
+
+    @raises(PrefetchTimeout)
+    def test_timeout(self):
+        Prefetch(lambda: None, (), {}).result(0.01)
+
+    def test_cancel(self):
+        func = mock.Mock()
+        prefetch = Prefetch(func, (), {})
+        ok_(prefetch.cancel())
+        prefetch.run()
+        ok_(not func.called)
+
+    def test_cancel_started(self):
+        prefetch = Prefetch(lambda: 1, (), {})
+        prefetch.run()
+        ok_(not prefetch.cancel())
+        eq_(prefetch.result(), 1)
+
+
+class TestPrefetchable(object):
+    '''
+    Tests for ``prefetchable``.
+    '''
+    def setup(self):
+        self.calls = []
+        self.prefetches = {}
+        self.patcher = mock.patch('ckanext.discovery.prefetch.'
+                                  + '_get_prefetches',
+                                  return_value=self.prefetches)
+        self.patcher.start()
+
+        @prefetchable('add', default='default')
+        def add(x, y=2):
+            self.calls.append((x, y, threading.current_thread()))
+            return x + y
+
+        self.add = add
+
+    def teardown(self):
+        self.patcher.stop()
+        shutdown()
+
+    def test_prefetch(self):
+        ok_(self.add.prefetch(1))
+        eq_(self.add(1, y=2), 3)
+        eq_(len(self.calls), 1)
+        ok_(self.calls[0][2] is not threading.current_thread())
+        eq_(self.prefetches, {})
+        # Later calls are not prefetched
+        eq_(self.add(1), 3)
+        eq_(len(self.calls), 2)
+
+    def test_different_arguments(self):
+        self.add.prefetch(1)
+        eq_(self.add(2), 4)
+        eq_(self.calls[-1][:2], (2, 2))
+
+    def test_duplicate_prefetch(self):
+        ok_(self.add.prefetch(1))
+        ok_(not self.add.prefetch(1, 2))
+
+    def test_concurrency(self):
+        @prefetchable('sleep')
+        def sleep(x):
+            time.sleep(0.2)
+            return x
+
+        start = time.time()
+        for i in range(3):
+            sleep.prefetch(i)
+        eq_([sleep(i) for i in range(3)], [0, 1, 2])
+        ok_(time.time() - start < 0.5)
+
+    def test_timeout(self):
+        event = threading.Event()
+
+        @prefetchable('wait', default='default')
+        def wait():
+            event.wait(1)
+
+        with changed_config(TIMEOUT, 0.01):
+            wait.prefetch()
+            eq_(wait(), 'default')
+        event.set()
+
+    @mock.patch('ckanext.discovery.tracing._finish')
+    def test_traced(self, finish):
+        '''
+        Prefetched calls are traced on the thread that executes them.
+        '''
+        @prefetchable('traced')
+        @traced('traced')
+        def func(x):
+            with span('stage'):
+                self.calls.append(threading.current_thread())
+                return x
+
+        with changed_config(SAMPLE_RATE, '1'):
+            ok_(func.prefetch(1))
+            eq_(func(x=1), 1)
+        eq_(len(self.calls), 1)
+        ok_(self.calls[0] is not threading.current_thread())
+        eq_(finish.call_count, 1)
+        t = finish.call_args[0][0]
+        eq_(t.name, 'traced')
+        eq_([s.name for s in t.spans], ['stage'])
+
+    def test_disabled(self):
+        with changed_config(WORKERS, 0):
+            ok_(not self.add.prefetch(1))
+        eq_(self.add(1), 3)
+
+    def test_outside_of_request(self):
+        with mock.patch('ckanext.discovery.prefetch._get_prefetches',
+                        return_value=None):
+            ok_(not self.add.prefetch(1))
+            eq_(self.add(1), 3)
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.profiling``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import pstats
+import shutil
+import tempfile
+
+import mock
+from nose.tools import eq_, ok_, raises
+
+import ckan.tests.factories as factories
+import ckan.tests.helpers as helpers
+from ckan.logic import NotAuthorized
+
+from ..profiling import profile, profiled
+from . import call_action_with_auth, changed_config
+
+
+SAMPLE_RATE = 'ckanext.discovery.profiling.sample_rate'
+DIRECTORY = 'ckanext.discovery.profiling.directory'
+MAX_FILES = 'ckanext.discovery.profiling.max_files'
+
+
+def work():
+    return sum(range(100))
+
+
+class TestProfile(object):
+    '''
+    Tests for ``profile`` and ``profiled``.
+    '''
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self, extension):
+        return sorted(f for f in os.listdir(self.directory)
+                      if f.endswith(extension))
+
+    def test_forced(self):
+        with changed_config(DIRECTORY, self.directory):
+            with profile('test', force=True, q='cät') as capture:
+                work()
+        eq_(os.path.basename(capture.filename), self.files('.prof')[0])
+        stats = pstats.Stats(capture.filename)
+        ok_(any(func[2] == 'work' for func in stats.stats))
+        with open(capture.filename[:-len('.prof')] + '.json', 'rb') as f:
+            metadata = json.load(f)
+        eq_(metadata['name'], 'test')
+        eq_(metadata['metadata'], {'q': 'cät'})
+        ok_(metadata['forced'])
+        ok_(metadata['duration'] > 0)
+
+    def test_not_sampled(self):
+        with changed_config(DIRECTORY, self.directory):
+            with changed_config(SAMPLE_RATE, '0'):
+                with profile('test') as capture:
+                    work()
+        ok_(capture is None)
+        eq_(self.files('.prof'), [])
+
+    def test_sampled(self):
+        with changed_config(DIRECTORY, self.directory):
+            with changed_config(SAMPLE_RATE, '0.5'):
+                with mock.patch('random.random', return_value=0.3):
+                    with profile('test') as capture:
+                        work()
+        ok_(capture.filename)
+        eq_(len(self.files('.json')), 1)
+
+    def test_nested(self):
+        with changed_config(DIRECTORY, self.directory):
+            with profile('outer', force=True):
+                with profile('inner', force=True) as inner:
+                    work()
+        ok_(inner is None)
+        eq_(len(self.files('.prof')), 1)
+
+    def test_profiled(self):
+        @profiled('my_function')
+        def f():
+            return work()
+
+        with changed_config(DIRECTORY, self.directory):
+            with changed_config(SAMPLE_RATE, '1'):
+                eq_(f(), work())
+        ok_(self.files('.prof')[0].startswith('my_function-'))
+
+
+    def test_max_files(self):
+        with changed_config(DIRECTORY, self.directory):
+            with changed_config(MAX_FILES, '2'):
+                for i in range(3):
+                    with profile('test{}'.format(i), force=True):
+                        work()
+                    # Make sure that the modification times differ
+                    for filename in os.listdir(self.directory):
+                        path = os.path.join(self.directory, filename)
+                        mtime = os.path.getmtime(path)
+                        os.utime(path, (mtime - 1, mtime - 1))
+        eq_([f.split('-')[0] for f in self.files('.prof')],
+            ['test1', 'test2'])
+        eq_(len(self.files('.json')), 2)
+
+
+class TestSearchSuggestProfiling(helpers.FunctionalTestBase):
+    '''
+    Test profiling of ``discovery_search_suggest``.
+    '''
+    def setup(self):
+        super(TestSearchSuggestProfiling, self).setup()
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sysadmin(self):
+        user = factories.Sysadmin()
+        with changed_config(DIRECTORY, self.directory):
+            call_action_with_auth('discovery_search_suggest',
+                                  {'user': user['name']}, q='cat',
+                                  profile=True)
+        files = os.listdir(self.directory)
+        ok_(any(f.startswith('discovery_search_suggest-') for f in files))
+
+    @raises(NotAuthorized)
+    def test_other_users(self):
+        user = factories.User()
+        with changed_config(DIRECTORY, self.directory):
+            call_action_with_auth('discovery_search_suggest',
+                                  {'user': user['name']}, q='cat',
+                                  profile=True)
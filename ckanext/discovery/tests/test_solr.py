@@ -0,0 +1,135 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.solr``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import mock
+from nose.tools import eq_, ok_, raises
+
+from ..solr import (CircuitBreaker, get_circuit_breaker, get_client,
+                    is_public, query, reset, Results, SolrUnavailable)
+from . import changed_config
+
+
+class TestCircuitBreaker(object):
+    '''
+    Tests for ``CircuitBreaker``.
+    '''
+    def test_opens_after_max_failures(self):
+        breaker = CircuitBreaker(max_failures=3, cool_down=10)
+        for i in range(2):
+            breaker.record_failure()
+            ok_(breaker.allow())
+        breaker.record_failure()
+        eq_(breaker.state, CircuitBreaker.OPEN)
+        ok_(not breaker.allow())
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(max_failures=2, cool_down=10)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        eq_(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(max_failures=1, cool_down=10)
+        with mock.patch('time.time', return_value=100):
+            breaker.record_failure()
+        with mock.patch('time.time', return_value=111):
+            eq_(breaker.state, CircuitBreaker.HALF_OPEN)
+            # Only a single trial query is allowed
+            ok_(breaker.allow())
+            ok_(not breaker.allow())
+            breaker.record_failure()
+            eq_(breaker.state, CircuitBreaker.OPEN)
+        with mock.patch('time.time', return_value=122):
+            ok_(breaker.allow())
+            breaker.record_success()
+            eq_(breaker.state, CircuitBreaker.CLOSED)
+            ok_(breaker.allow())
+            ok_(breaker.allow())
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(max_failures=0)
+        for i in range(100):
+            breaker.record_failure()
+        ok_(breaker.allow())
+
+
+def test_results():
+    results = Results({
+        'response': {'docs': [{'id': 'a'}], 'numFound': 1},
+        'moreLikeThis': {'a': {'docs': [{'id': 'b'}]}},
+    })
+    eq_(results.docs, [{'id': 'a'}])
+    eq_(results.more_like_this, {'a': {'docs': [{'id': 'b'}]}})
+
+
+def test_is_public():
+    doc = {'site_id': 'x', 'dataset_type': 'dataset', 'state': 'active',
+           'capacity': 'public'}
+    with changed_config('ckan.site_id', 'x'):
+        ok_(is_public(doc))
+        ok_(not is_public(dict(doc, capacity='private')))
+        ok_(not is_public(dict(doc, state='deleted')))
+    with changed_config('ckan.site_id', 'y'):
+        ok_(not is_public(doc))
+
+
+@mock.patch('ckanext.discovery.solr.make_connection')
+class TestQuery(object):
+    '''
+    Tests for ``query``.
+    '''
+    def setup(self):
+        reset()
+
+    def teardown(self):
+        reset()
+
+    def test_connections_are_reused(self, make_connection):
+        make_connection.side_effect = lambda: mock.Mock()
+        ok_(get_client(5) is get_client(5))
+        ok_(get_client(5) is not get_client(10))
+        eq_(make_connection.call_count, 2)
+        eq_(get_client(10).timeout, 10)
+
+    def test_query(self, make_connection):
+        client = make_connection.return_value
+        client.search.return_value = 'result'
+        with changed_config('ckanext.discovery.solr.timeout', 3):
+            eq_(query('search', '*:*', rows=0), 'result')
+        client.search.assert_called_once_with('*:*', rows=0)
+        eq_(client.timeout, 3)
+
+    def test_timeout(self, make_connection):
+        query('search', '*:*', timeout=1)
+        eq_(make_connection.return_value.timeout, 1)
+
+    @raises(SolrUnavailable)
+    def test_failure(self, make_connection):
+        make_connection.return_value.search.side_effect = IOError()
+        query('search', '*:*')
+
+    def test_circuit_breaker(self, make_connection):
+        client = make_connection.return_value
+        client.search.side_effect = IOError()
+        with changed_config('ckanext.discovery.solr.max_failures', 2):
+            for i in range(2):
+                try:
+                    query('search', '*:*')
+                except SolrUnavailable:
+                    pass
+            eq_(get_circuit_breaker().state, CircuitBreaker.OPEN)
+            client.search.reset_mock()
+            try:
+                query('search', '*:*')
+            except SolrUnavailable:
+                pass
+            else:
+                raise AssertionError('Query was not skipped')
+            ok_(not client.search.called)
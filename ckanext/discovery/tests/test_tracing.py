@@ -0,0 +1,202 @@
+# encoding: utf-8
+
+'''
+Tests for ``ckanext.discovery.tracing``.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import shutil
+import tempfile
+import time
+
+import mock
+from nose.tools import eq_, ok_
+
+import ckan.tests.helpers as helpers
+
+from ..instrumentation import record_statement
+from ..tracing import (clear_traces, get_active_trace, get_slow_traces,
+                       load_traces, save_slow_traces, SlowTraces, span,
+                       trace, Trace, traced)
+from . import changed_config, paster
+
+
+SAMPLE_RATE = 'ckanext.discovery.tracing.sample_rate'
+DIRECTORY = 'ckanext.discovery.tracing.directory'
+SAVE_DELAY = 'ckanext.discovery.tracing.save_delay'
+GET_DIRECTORY = 'ckanext.discovery.tracing.get_directory'
+
+
+def make_trace(duration, name='test'):
+    return Trace(name, timestamp=0, duration=duration)
+
+
+class TracingTestBase(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        get_slow_traces().clear()
+
+    def teardown(self):
+        # Don't leave a pending save behind
+        with changed_config(DIRECTORY, self.directory):
+            save_slow_traces()
+        shutil.rmtree(self.directory)
+
+
+class TestTrace(TracingTestBase):
+    '''
+    Tests for ``trace`` and ``span``.
+    '''
+    def test_not_sampled(self):
+        with changed_config(SAMPLE_RATE, '0'):
+            with trace('test') as t:
+                with span('stage'):
+                    ok_(get_active_trace() is None)
+        ok_(t is None)
+        eq_(get_slow_traces().traces(), [])
+
+    def test_sampled(self):
+        with changed_config(SAMPLE_RATE, '1'):
+            with changed_config(DIRECTORY, self.directory):
+                with trace('test', q='cat') as t:
+                    with span('outer'):
+                        record_statement(1, 0)
+                        with span('inner'):
+                            record_statement(1, 0)
+                    with span('other'):
+                        pass
+        ok_(get_active_trace() is None)
+        eq_(t.name, 'test')
+        eq_(t.tags, {'q': 'cat'})
+        ok_(t.duration > 0)
+        eq_([(s.name, s.depth, s.statements) for s in t.spans],
+            [('outer', 0, 2), ('inner', 1, 1), ('other', 0, 0)])
+        eq_(get_slow_traces().traces(), [t])
+
+    def test_sample_rate(self):
+        with changed_config(SAMPLE_RATE, '0.5'):
+            with mock.patch('random.random', return_value=0.7):
+                with trace('test') as t:
+                    pass
+        ok_(t is None)
+
+    def test_nested_trace_is_span(self):
+        with changed_config(SAMPLE_RATE, '1'):
+            with changed_config(DIRECTORY, self.directory):
+                with trace('outer') as outer:
+                    with trace('inner') as inner:
+                        pass
+        ok_(inner is outer)
+        eq_([s.name for s in outer.spans], ['inner'])
+
+    def test_traced(self):
+        @traced('my_function')
+        def f(x):
+            return get_active_trace()
+
+        with changed_config(SAMPLE_RATE, '1'):
+            with changed_config(DIRECTORY, self.directory):
+                t = f(1)
+        eq_(t.name, 'my_function')
+
+    def test_traces_are_saved_after_delay(self):
+        with changed_config(SAMPLE_RATE, '1'):
+            with changed_config(DIRECTORY, self.directory):
+                with changed_config(SAVE_DELAY, '0.1'):
+                    with trace('test'):
+                        pass
+                    time.sleep(0.5)
+        eq_(len(load_traces(self.directory)), 1)
+
+    def test_format(self):
+        t = make_trace(0.5)
+        t.tags = {'q': 'cat'}
+        with t.span('stage'):
+            pass
+        lines = t.format().splitlines()
+        ok_(lines[0].startswith('500.0ms test q="cat" ('))
+        ok_(lines[1].endswith('stage (0 statements)'))
+
+    def test_traces_are_saved(self):
+        with changed_config(SAMPLE_RATE, '1'):
+            with changed_config(DIRECTORY, self.directory):
+                with trace('test', q='cät'):
+                    with span('stage'):
+                        pass
+                # Traces are saved in the background
+                eq_(load_traces(self.directory), [])
+                save_slow_traces()
+        traces = load_traces(self.directory)
+        eq_(len(traces), 1)
+        eq_(traces[0].tags, {'q': 'cät'})
+        eq_(traces[0].spans[0].name, 'stage')
+        eq_(clear_traces(self.directory), 1)
+        eq_(load_traces(self.directory), [])
+
+
+class TestSlowTraces(object):
+    '''
+    Tests for ``SlowTraces``.
+    '''
+    def test_slowest_are_kept(self):
+        buf = SlowTraces(2)
+        ok_(buf.add(make_trace(2)))
+        ok_(buf.add(make_trace(1)))
+        ok_(buf.add(make_trace(3)))
+        ok_(not buf.add(make_trace(0.5)))
+        eq_([t.duration for t in buf.traces()], [3, 2])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            buf = SlowTraces(2)
+            buf.add(make_trace(1))
+            buf.add(make_trace(2))
+            buf.save(directory)
+            eq_([t.duration for t in load_traces(directory)], [2, 1])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestPaster(TracingTestBase):
+    '''
+    Tests for the ``discovery`` paster command.
+    '''
+    def test_traces(self):
+        buf = SlowTraces(3)
+        for duration in [1, 2, 3]:
+            buf.add(make_trace(duration, 'trace_{}'.format(duration)))
+        buf.save(self.directory)
+        with mock.patch(GET_DIRECTORY, return_value=self.directory):
+            stdout = paster('discovery', 'traces', '2')[1]
+        ok_('trace_3' in stdout)
+        ok_('trace_2' in stdout)
+        ok_('trace_1' not in stdout)
+
+    def test_clear_traces(self):
+        buf = SlowTraces(1)
+        buf.add(make_trace(1))
+        buf.save(self.directory)
+        with mock.patch(GET_DIRECTORY, return_value=self.directory):
+            paster('discovery', 'clear-traces')
+            stdout = paster('discovery', 'traces')[1]
+        ok_('No traces' in stdout)
+
+
+class TestPluginTraces(TracingTestBase):
+    '''
+    Test that the plugins record traces.
+    '''
+    def test_search_suggest(self):
+        with changed_config(SAMPLE_RATE, '1'):
+            with changed_config(DIRECTORY, self.directory):
+                helpers.call_action('discovery_search_suggest', q='cat d')
+        t = get_slow_traces().traces()[0]
+        eq_(t.name, 'discovery_search_suggest')
+        eq_(t.tags, {'q': 'cat d'})
+        names = [s.name for s in t.spans]
+        for name in ['tokenize', 'context_terms', 'autocomplete',
+                     'extension', 'scoring', 'formatting']:
+            ok_(name in names, name)
@@ -0,0 +1,392 @@
+# encoding: utf-8
+
+'''
+Sampled tracing of requests.
+
+A trace records the duration of the stages (spans) of a single request,
+for example of a call to ``discovery_search_suggest``. Requests are
+traced with the probability ``ckanext.discovery.tracing.sample_rate``
+(see ``trace``). Code that runs outside of a sampled trace only pays for
+checking whether a trace is active.
+
+The slowest traces of each process are kept in a ``SlowTraces`` buffer
+and are saved to a directory, so that they can be displayed by the
+``discovery traces`` paster command. Saving happens in the background
+(see ``save_slow_traces``) so that it doesn't slow down the traced
+requests.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import atexit
+import contextlib
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from .instrumentation import measure
+from .plugins import get_config
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_sample_rate():
+    '''
+    The probability with which a request is traced.
+    '''
+    return float(get_config('tracing.sample_rate', 0))
+
+
+def get_save_delay():
+    '''
+    The delay in seconds after which new slow traces are saved.
+    '''
+    return float(get_config('tracing.save_delay', 10))
+
+
+def get_directory():
+    '''
+    The directory in which the slowest traces are saved.
+    '''
+    return get_config('tracing.directory', os.path.join(
+                      tempfile.gettempdir(), 'ckanext-discovery-traces'))
+
+
+class Span(object):
+    '''
+    A stage of a traced request.
+
+    ``start`` is the offset from the start of the trace and ``duration``
+    the duration of the span, both in seconds. ``depth`` is the nesting
+    level of the span, ``statements`` is the number of SQL statements
+    executed during the span (see ``instrumentation``).
+    '''
+    def __init__(self, name, depth, start, duration=0, statements=0):
+        self.name = name
+        self.depth = depth
+        self.start = start
+        self.duration = duration
+        self.statements = statements
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'depth': self.depth,
+            'start': self.start,
+            'duration': self.duration,
+            'statements': self.statements,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
+class Trace(object):
+    '''
+    A traced request.
+
+    ``tags`` is a dict of additional information about the request, for
+    example the search query. ``timestamp`` is the time at which the
+    request started (as returned by ``time.time``).
+    '''
+    def __init__(self, name, tags=None, timestamp=None, duration=0,
+                 spans=None, pid=None):
+        self.name = name
+        self.tags = tags or {}
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.duration = duration
+        self.spans = spans or []
+        self.pid = os.getpid() if pid is None else pid
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def span(self, name):
+        '''
+        Context manager that records a span of this trace.
+        '''
+        start = time.time()
+        span = Span(name, self._depth, start - self.timestamp)
+        self.spans.append(span)
+        self._depth += 1
+        try:
+            with measure(name) as stats:
+                yield span
+        finally:
+            self._depth -= 1
+            span.duration = time.time() - start
+            span.statements = stats.statements
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'tags': self.tags,
+            'timestamp': self.timestamp,
+            'duration': self.duration,
+            'spans': [span.to_dict() for span in self.spans],
+            'pid': self.pid,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        d['spans'] = [Span.from_dict(span) for span in d['spans']]
+        return cls(**d)
+
+    def format(self):
+        '''
+        Format the trace as human-readable text.
+        '''
+        timestamp = datetime.datetime.fromtimestamp(self.timestamp)
+        tags = ''.join(' {}="{}"'.format(k, v)
+                       for k, v in sorted(self.tags.iteritems()))
+        lines = ['{:.1f}ms {}{} ({:%Y-%m-%d %H:%M:%S}, PID {})'.format(
+                 self.duration * 1000, self.name, tags, timestamp, self.pid)]
+        for span in self.spans:
+            lines.append('  {:8.1f}ms {:8.1f}ms  {}{} ({} statements)'
+                         .format(span.start * 1000, span.duration * 1000,
+                         '  ' * span.depth, span.name, span.statements))
+        return '\n'.join(lines)
+
+
+class SlowTraces(object):
+    '''
+    Buffer that keeps the ``size`` slowest traces.
+    '''
+    def __init__(self, size=20):
+        self.size = size
+        self._lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count()
+
+    def add(self, trace):
+        '''
+        Add a trace.
+
+        Returns True if the trace was kept and False if it is faster than
+        all buffered traces and the buffer is full.
+        '''
+        item = (trace.duration, next(self._counter), trace)
+        with self._lock:
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, item)
+                return True
+            if trace.duration <= self._heap[0][0]:
+                return False
+            heapq.heapreplace(self._heap, item)
+            return True
+
+    def traces(self):
+        '''
+        Get the buffered traces, slowest first.
+        '''
+        with self._lock:
+            items = sorted(self._heap, reverse=True)
+        return [trace for _, _, trace in items]
+
+    def clear(self):
+        '''
+        Remove all buffered traces.
+        '''
+        with self._lock:
+            del self._heap[:]
+
+    def save(self, directory):
+        '''
+        Save the buffered traces to a file in a directory.
+
+        Each process uses its own file, see ``load_traces``.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, 'traces-{}.json'.format(
+                                os.getpid()))
+        # Write to a temporary file first so that readers never see a
+        # partially written file
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            json.dump([trace.to_dict() for trace in self.traces()], f)
+        os.rename(tmp_filename, filename)
+
+
+def load_traces(directory):
+    '''
+    Load the traces saved by all processes.
+
+    Returns a list of ``Trace`` instances, slowest first.
+    '''
+    traces = []
+    if not os.path.isdir(directory):
+        return traces
+    for filename in os.listdir(directory):
+        if not (filename.startswith('traces-') and filename.endswith('.json')):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            with open(path, 'rb') as f:
+                traces.extend(Trace.from_dict(d) for d in json.load(f))
+        except (IOError, ValueError) as e:
+            log.warning('Could not read traces from "%s": %s', path, e)
+    return sorted(traces, key=lambda trace: trace.duration, reverse=True)
+
+
+def clear_traces(directory):
+    '''
+    Delete the traces saved by all processes.
+
+    Returns the number of deleted files.
+    '''
+    num = 0
+    if not os.path.isdir(directory):
+        return num
+    for filename in os.listdir(directory):
+        if filename.startswith('traces-') and filename.endswith('.json'):
+            os.remove(os.path.join(directory, filename))
+            num += 1
+    return num
+
+
+_slow_traces = None
+
+
+def get_slow_traces():
+    '''
+    Get the buffer of the slowest traces of this process.
+
+    The buffer is re-created if its configured size changes.
+    '''
+    global _slow_traces
+    size = int(get_config('tracing.slow_traces', 20))
+    if _slow_traces is None or _slow_traces.size != size:
+        _slow_traces = SlowTraces(size)
+    return _slow_traces
+
+
+def get_active_trace():
+    '''
+    Get the trace that is active in the current thread, or None.
+    '''
+    return getattr(_local, 'trace', None)
+
+
+_save_lock = threading.Lock()
+_save_timer = None
+_save_pid = None
+
+
+def save_slow_traces():
+    '''
+    Save the slowest traces of this process.
+
+    Called automatically in a background thread ``get_save_delay``
+    seconds after a new slow trace has been recorded, and when the
+    process exits.
+    '''
+    global _save_timer
+    with _save_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+            _save_timer = None
+    if _slow_traces is None:
+        return
+    try:
+        _slow_traces.save(get_directory())
+    except (IOError, OSError) as e:
+        log.warning('Could not save traces: %s', e)
+
+
+def _schedule_save():
+    global _save_timer, _save_pid
+    with _save_lock:
+        # Timers don't survive forking, so a timer inherited from the
+        # parent process is ignored
+        if _save_timer is not None and _save_pid == os.getpid():
+            return
+        _save_timer = threading.Timer(get_save_delay(), save_slow_traces)
+        _save_timer.daemon = True
+        _save_timer.start()
+        _save_pid = os.getpid()
+
+
+@atexit.register
+def _save_at_exit():
+    if _save_timer is not None and _save_pid == os.getpid():
+        save_slow_traces()
+
+
+def _finish(trace):
+    if get_slow_traces().add(trace):
+        _schedule_save()
+
+
+@contextlib.contextmanager
+def trace(name, **tags):
+    '''
+    Context manager for tracing a request.
+
+    The request is traced with the configured sampling rate. If a trace
+    is already active in the current thread then a span of that trace is
+    recorded instead. Keyword arguments are stored as tags of the trace.
+
+    Returns the ``Trace`` instance or None if the request is not traced.
+    '''
+    active = get_active_trace()
+    if active is not None:
+        with active.span(name):
+            yield active
+        return
+    rate = get_sample_rate()
+    if rate <= 0 or random.random() >= rate:
+        yield None
+        return
+    t = _local.trace = Trace(name, tags)
+    try:
+        yield t
+    finally:
+        _local.trace = None
+        t.duration = time.time() - t.timestamp
+        _finish(t)
+
+
+@contextlib.contextmanager
+def span(name):
+    '''
+    Context manager for recording a span of the active trace.
+
+    Does nothing if no trace is active in the current thread.
+    '''
+    active = get_active_trace()
+    if active is None:
+        yield
+        return
+    with active.span(name):
+        yield
+
+
+def traced(name):
+    '''
+    Decorator for tracing the calls of a function.
+
+    See ``trace``.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            with trace(name):
+                return f(*args, **kwargs)
+        # As in Python 3, see ``prefetch.prefetchable``
+        wrapped.__wrapped__ = f
+        return wrapped
+    return decorator
@@ -68,7 +68,7 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
+    packages=find_packages(exclude=['benchmarks', 'contrib', 'docs', 'tests*']),
     namespace_packages=['ckanext'],
 
     install_requires=[
@@ -106,7 +106,10 @@ setup(
         ckan = ckan.lib.extract:extract_ckan
 
         [paste.paster_command]
+        discovery = ckanext.discovery.paster:DiscoveryCommand
         search_suggestions = ckanext.discovery.plugins.search_suggestions.paster:SearchSuggestionsCommand
+        similar_datasets = ckanext.discovery.plugins.similar_datasets.paster:SimilarDatasetsCommand
+        tag_cloud = ckanext.discovery.plugins.tag_cloud.paster:TagCloudCommand
     ''',
 
     # If you are changing from the default layout of your extension, you may